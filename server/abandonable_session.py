@@ -0,0 +1,73 @@
+import socket
+import threading
+
+import requests
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+class AbandonableSession(requests.Session):
+    """
+    requests.Session whose requests can be abandoned from another thread. Session.close() only closes the connections
+    that are idle, so a request that is waiting for its response keeps running until it times out. abandon() shuts down
+    the connections that are in use as well, so that the waiting request fails right away with a ConnectionError.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.abandoned = threading.Event()
+        self.connections = set()
+        self.lock = threading.Lock()
+        adapter = TrackingAdapter(self)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def track(self, connection):
+        with self.lock:
+            self.connections.add(connection)
+
+    def abandon(self):
+        """
+        Stops every request of the session. Requests made after this are still sent, so callers should check
+        self.abandoned before starting one.
+        """
+        self.abandoned.set()
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            sock = getattr(connection, 'sock', None)
+            if sock is None:  # Not connected yet or already closed
+                continue
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.close()
+
+
+class TrackingAdapter(requests.adapters.HTTPAdapter):
+    """
+    Adapter that reports every connection it hands out to the AbandonableSession it is mounted on.
+    """
+
+    def __init__(self, session: AbandonableSession):
+        self.session = session
+        super().__init__()
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        session = self.session
+
+        class TrackingHTTPConnectionPool(HTTPConnectionPool):
+            def _get_conn(self, timeout=None):
+                connection = super()._get_conn(timeout)
+                session.track(connection)
+                return connection
+
+        class TrackingHTTPSConnectionPool(HTTPSConnectionPool):
+            def _get_conn(self, timeout=None):
+                connection = super()._get_conn(timeout)
+                session.track(connection)
+                return connection
+
+        self.poolmanager.pool_classes_by_scheme = {'http': TrackingHTTPConnectionPool,
+                                                   'https': TrackingHTTPSConnectionPool}
@@ -0,0 +1,118 @@
+import os
+from typing import Union
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
+
+from dependency import UniversalMLImage, TrainingResult
+
+# --------------------------------------------------------------------------------
+#                              Async Database Objects
+# --------------------------------------------------------------------------------
+#
+# Functions in this file mirror those of the same name in db_connection.py, for use
+# by async route handlers. They use Motor rather than PyMongo, so that waiting on
+# the database does not block the event loop. Route handlers that are not async run
+# in a thread pool, and keep using db_connection.py.
+#
+# --------------------------------------------------------------------------------
+
+client = AsyncIOMotorClient(os.getenv("DB_HOST", default="database"), 27017)
+database = client["server_database"]
+image_collection = database["images"]
+model_collection = database["models"]
+training_collection = database["training"]
+
+
+# ---------------------------
+# Image Database Interactions
+# ---------------------------
+
+
+async def get_image_by_md5_hash_db(image_hash) -> Union[UniversalMLImage, None]:
+    """
+    Locates an image data by its md5 hash, and then creates a UniversalMLImage object with that data.
+
+    :param image_hash: md5 hash of image to search for
+    :return: UniversalMLImage object of image with a md5 hash, or None if not found
+    """
+    result = await image_collection.find_one({"hash_md5": image_hash}, {'_id': 0})
+    if not result:
+        return None
+
+    return UniversalMLImage(**result)
+
+
+# ---------------------------
+# Model Database Interactions
+# ---------------------------
+
+
+async def get_models_db():
+    """
+    Creates a list of all registered models and their classes. The return value is of the format
+    {modelName: [modelClass1, modelClass2, ...], ...}
+
+    :return: List of all models and their classes. [] if no models registered.
+    """
+    all_models = model_collection.find({'model_fields': {'$exists': True}}, {'model_name': 1, 'model_fields': 1})
+    model_list = {model['model_name']: model['model_fields'] async for model in all_models}
+    return model_list
+
+
+# ------------------------------
+# Training Database Interactions
+# ------------------------------
+
+async def add_training_result_db(tr: TrainingResult):
+    try:
+        await training_collection.update_one({'training_id': tr.training_id},
+                                             {'$setOnInsert': tr.dict(exclude={'training_id'})}, upsert=True)
+    except DuplicateKeyError:  # Inserted by another request between the query and the insert
+        pass
+
+
+async def update_training_result_db(tr: TrainingResult):
+    await training_collection.replace_one({'training_id': tr.training_id}, tr.dict(), upsert=True)
+
+
+async def get_training_result_by_training_id(training_id: str):
+    res = await training_collection.find_one({'training_id': training_id}, {'_id': 0})
+    if not res:
+        return None
+
+    return TrainingResult(**res)
+
+
+async def get_bulk_training_results_reverse_order_db(limit: int = -1, username: str = ''):
+    """
+    Gets the last <limit> results for submitted training requests. If a username is specified, it will find the last
+    requests by that user, otherwise it will be system-wide.
+
+    :param limit: Limit the number of training results (in descending order). If -1 will return all training results
+    :param username: Optional username. If provided will only return training results user has submitted.
+    :return: list of objects in the format of the TrainingResult.
+    """
+
+    query = {'username': username} if len(username) > 0 else {}
+    res = training_collection.find(query, {'_id': False}).sort([('_id', -1)])
+    if limit > 0:
+        res = res.limit(limit)
+
+    return await res.to_list(length=None)
+
+
+async def get_training_statistics_db(username: str = None):
+    """
+    Query the database for information on the number of jobs pending and completed.
+
+    :param username: Optional username. If provided will only find jobs that a user has submitted.
+    :return: 2-tuple of jobs pending, jobs finished
+    """
+    query = {'username': username} if username is not None else {}
+    counts = {group['_id']: group['count'] async for group in training_collection.aggregate([
+        {'$match': query},
+        {'$group': {'_id': '$complete', 'count': {'$sum': 1}}}
+    ])}
+
+    return counts.get(False, 0), counts.get(True, 0)
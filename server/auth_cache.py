@@ -0,0 +1,197 @@
+import hashlib
+import time
+from typing import Union
+
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+
+from cache import TTLCache
+from db_connection import get_user_by_name_db, get_api_key_by_key_db
+from dependency import redis, logger, User, APIKeyData, USER_CACHE_SIZE, USER_CACHE_TTL, API_KEY_CACHE_SIZE, \
+    API_KEY_CACHE_TTL, API_KEY_NEGATIVE_CACHE_TTL, TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL
+
+# --------------------------------------------------------------------------------
+#                          Authenticated User Cache
+# --------------------------------------------------------------------------------
+#
+# Every authenticated request needs the User of its token, and every microservice call
+# needs the APIKeyData of its key, so recently used users and keys are cached in each
+# server process. Changes to a user, such as a role change or the account being
+# disabled, and changes to a key are published on AUTH_INVALIDATION_CHANNEL so that
+# every process drops its copy. A process that misses messages while disconnected
+# from redis clears its whole cache, and the TTL of each cache bounds how long any
+# copy is used. The claims of verified bearer tokens are cached as well, so that the
+# signature of a token is only checked the first time it is seen.
+#
+# --------------------------------------------------------------------------------
+
+AUTH_INVALIDATION_CHANNEL = 'auth:invalidate'
+CLEAR_ALL_MESSAGE = '*'
+
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# API keys are cached by their digest, so that keys are never sent over pub/sub. Unknown keys are cached separately
+# for a shorter time, so that requests with many bad keys do not evict valid ones.
+api_key_cache = TTLCache(API_KEY_CACHE_SIZE, API_KEY_CACHE_TTL)
+missing_api_key_cache = TTLCache(API_KEY_CACHE_SIZE, API_KEY_NEGATIVE_CACHE_TTL)
+
+# Claims of bearer tokens whose signature was verified, by the digest of the token. Tokens are never changed, so they
+# are not invalidated, but each is only kept until its exp claim.
+token_cache = TTLCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+_listener = None  # Thread that receives invalidation messages, see start_auth_cache_listener
+
+
+def get_cached_user(username: str) -> Union[User, None]:
+    """
+    Cached version of db_connection.get_user_by_name_db. Users that do not exist are not cached.
+
+    :param username: username of user
+    :return: User object if user with given username exists, else None
+    """
+    user = user_cache.get(username)
+    if user is None:
+        user = get_user_by_name_db(username)
+        if user is not None:
+            user_cache.set(username, user)
+    return user
+
+
+def invalidate_user(username: str):
+    """
+    Removes a user from the cache of every server process. Must be called after every change to a user.
+
+    :param username: username of user that changed
+    """
+    user_cache.pop(username)
+    publish_invalidation('user:' + username)
+
+
+def publish_invalidation(message: str):
+    """
+    Sends an invalidation message to the other server processes. The change that is invalidated has already been
+    saved, so if redis is unavailable this is only logged, and the other processes drop their copy once it expires.
+
+    :param message: Invalidation message, such as "user:<username>". See handle_invalidation
+    """
+    try:
+        redis.publish(AUTH_INVALIDATION_CHANNEL, message)
+    except (RedisConnectionError, RedisTimeoutError) as e:
+        logger.warning('Unable to publish auth cache invalidation ' + message + ': ' + str(e))
+
+
+def secret_digest(secret: str) -> str:
+    """
+    :param secret: API key string or bearer token
+    :return: sha256 digest of the secret, which it is cached by
+    """
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+
+def get_cached_api_key(key: str) -> Union[APIKeyData, None]:
+    """
+    Cached version of db_connection.get_api_key_by_key_db. Keys that do not exist are cached for
+    API_KEY_NEGATIVE_CACHE_TTL seconds.
+
+    :param key: API key string to lookup
+    :return: APIKeyData if key with given ID exists, else NoneType if no API key for a given key string exists.
+    """
+    digest = secret_digest(key)
+    api_key = api_key_cache.get(digest)
+    if api_key is None and not missing_api_key_cache.get(digest):
+        api_key = get_api_key_by_key_db(key)
+        if api_key is not None:
+            api_key_cache.set(digest, api_key)
+        else:
+            missing_api_key_cache.set(digest, True)
+    return api_key
+
+
+def invalidate_api_key(key: str):
+    """
+    Removes an API key from the cache of every server process. Must be called after an API key is added or changed.
+
+    :param key: API key string that changed
+    """
+    digest = secret_digest(key)
+    api_key_cache.pop(digest)
+    missing_api_key_cache.pop(digest)
+    publish_invalidation('key:' + digest)
+
+
+def get_cached_token_claims(token: str) -> Union[dict, None]:
+    """
+    :param token: Bearer token
+    :return: Claims of the token if its signature was verified recently and it has not expired, else None
+    """
+    claims = token_cache.get(secret_digest(token))
+    if claims is not None and 'exp' in claims and claims['exp'] <= time.time():
+        return None
+    return claims
+
+
+def cache_token_claims(token: str, claims: dict):
+    """
+    Caches the claims of a token whose signature was verified, until the token expires or for at most
+    TOKEN_CACHE_TTL seconds.
+
+    :param token: Bearer token
+    :param claims: Decoded claims of the token
+    """
+    ttl = TOKEN_CACHE_TTL
+    if 'exp' in claims:
+        ttl = min(ttl, claims['exp'] - time.time())
+    if ttl > 0:
+        token_cache.set(secret_digest(token), claims, ttl=ttl)
+
+
+def clear_auth_caches():
+    """
+    Removes every user and API key from the caches of this process.
+    """
+    user_cache.clear()
+    api_key_cache.clear()
+    missing_api_key_cache.clear()
+
+
+def handle_invalidation(message: dict):
+    """
+    Removes the entry named by an invalidation message from the cache.
+
+    :param message: Redis pub/sub message, with the data "user:<username>", "key:<digest>" or CLEAR_ALL_MESSAGE
+    """
+    data = message['data'].decode() if isinstance(message['data'], bytes) else str(message['data'])
+    if data == CLEAR_ALL_MESSAGE:
+        clear_auth_caches()
+    elif data.startswith('user:'):
+        user_cache.pop(data[len('user:'):])
+    elif data.startswith('key:'):
+        api_key_cache.pop(data[len('key:'):])
+        missing_api_key_cache.pop(data[len('key:'):])
+
+
+def handle_listener_error(error: Exception, pubsub, thread):
+    """
+    Clears the cache when the connection to redis is lost, since any invalidations sent in the meantime are missed.
+    The listener reconnects and subscribes again on its next read.
+    """
+    logger.warning('Lost auth cache invalidation subscription: ' + str(error))
+    clear_auth_caches()
+    time.sleep(1)  # Wait before reconnecting, rather than retrying in a tight loop while redis is down
+
+
+def start_auth_cache_listener():
+    """
+    Starts a background thread that applies the invalidation messages of other processes to the cache.
+    """
+    global _listener
+    pubsub = redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(**{AUTH_INVALIDATION_CHANNEL: handle_invalidation})
+    _listener = pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=handle_listener_error)
+
+
+def stop_auth_cache_listener():
+    """
+    Stops the background thread started by start_auth_cache_listener.
+    """
+    if _listener is not None:
+        _listener.stop()
@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+class TTLCache:
+    """
+    Thread-safe in-memory cache with least recently used eviction and a time to live for every entry. The memory
+    used by the cache is bounded by max_size, where each entry counts as get_size(value). By default every entry
+    has a size of 1, so max_size is the maximum number of entries. Entries larger than max_size are not cached.
+
+    Hits, misses, evictions and expirations are counted, and reported by stats.
+    """
+
+    def __init__(self, max_size: int, ttl: float, get_size: Callable[[Any], int] = None):
+        """
+        :param max_size: Maximum total size of the entries in the cache
+        :param ttl: Default seconds an entry is kept for
+        :param get_size: Function that returns the size of a cached value
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.get_size = get_size or (lambda value: 1)
+        self.entries = OrderedDict()  # Key to (value, size, expiry time), from least to most recently used
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        :param key: Key of the entry
+        :param default: Value to return if the key is not cached or has expired
+        :return: Cached value of the key, else default
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, size, expires = entry
+            if time.monotonic() >= expires:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: float = None):
+        """
+        Caches a value, evicting the least recently used entries if the cache is over its size.
+
+        :param key: Key of the entry
+        :param value: Value to cache
+        :param ttl: Seconds the entry is kept for. Uses the default of the cache if None
+        """
+        size = self.get_size(value)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if size > self.max_size:
+                return
+
+            self.entries[key] = (value, size, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self.size += size
+            while self.size > self.max_size:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def pop(self, key: Hashable):
+        """
+        Removes an entry from the cache if it is cached.
+
+        :param key: Key of the entry
+        """
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        """
+        Removes every entry from the cache. Statistics are kept.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        """
+        :return: Number of entries, size, hits, misses, evictions and expirations of the cache, and its hit rate
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+    def _remove(self, key: Hashable):
+        value, size, expires = self.entries.pop(key)
+        self.size -= size
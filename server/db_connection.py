@@ -2,9 +2,54 @@ from typing import Union, List
 
 from dependency import User, user_collection, image_collection, PAGINATION_PAGE_SIZE, UniversalMLImage, Roles, \
     APIKeyData, \
-    api_key_collection, model_collection, TrainingResult, training_collection, logger
+    api_key_collection, model_collection, TrainingResult, training_collection, logger, SEARCH_COUNT_LIMIT
+from search_counts import image_count_key, get_cached_count, update_image_counts, update_search_versions, send_update, \
+    reconcile_search_counts
+import base64
+import binascii
 import math
-import json
+import re
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import OperationFailure, DuplicateKeyError
+
+
+# Indexes that every lookup of the server relies on, as (collection, keys, create_index options). These are created
+# on startup by ensure_indexes_db.
+REQUIRED_INDEXES = [
+    (user_collection, [('username', 1)], {'unique': True}),
+    (api_key_collection, [('key', 1)], {'unique': True}),
+    (api_key_collection, [('user', 1), ('enabled', 1)], {}),
+    (image_collection, [('hash_md5', 1)], {'unique': True}),
+    (image_collection, [('users', 1), ('hash_md5', 1)], {}),
+    (image_collection, [('users', 1), ('_id', 1)], {}),  # Pages of a single user's images
+    (image_collection, [('search_terms', 1)], {}),
+    (image_collection, [('labels.model', 1), ('labels.class', 1), ('labels.score', -1)], {}),
+    (model_collection, [('model_name', 1)], {'unique': True}),
+    (training_collection, [('training_id', 1)], {'unique': True}),
+    (training_collection, [('username', 1), ('_id', -1)], {}),  # Training history of a user, newest first
+    (training_collection, [('username', 1), ('complete', 1)], {}),
+]
+
+
+def insert_if_missing(collection, query: dict, document: dict) -> bool:
+    """
+    Inserts a document unless one matching the query already exists, in a single round trip to the database.
+
+    :param collection: Collection to insert the document into
+    :param query: Filter that finds an existing copy of the document, such as {'username': username}
+    :param document: Document to insert
+    :return: True if the document was inserted, else False if it already existed
+    """
+    # Fields of the query are set by the upsert itself, and may not also be set by $setOnInsert
+    document = {field: value for field, value in document.items() if field not in query}
+    try:
+        result = collection.update_one(query, {'$setOnInsert': document}, upsert=True)
+    except DuplicateKeyError:  # Inserted by another request between the query and the insert
+        return False
+    return result.upserted_id is not None
 
 
 # ---------------------------
@@ -24,11 +69,8 @@ def add_user_db(user: User) -> bool:
     if user.roles is None:
         roles = []
 
-    if not user_collection.find_one({"username": user.username}):
-        user_collection.insert_one(user.dict())
-        return True
-
-    return False  # This means there is already a user in the database with this name.
+    # False means there is already a user in the database with this name.
+    return insert_if_missing(user_collection, {"username": user.username}, user.dict())
 
 
 def get_user_by_name_db(username: str) -> Union[User, None]:
@@ -38,10 +80,10 @@ def get_user_by_name_db(username: str) -> Union[User, None]:
     :param username: username of user
     :return: User object if user with given username exists, else None
     """
-    if not user_collection.find_one({"username": username}):
+    database_result = user_collection.find_one({"username": username}, {'_id': 0})
+    if not database_result:
         return None
 
-    database_result = user_collection.find_one({"username": username})
     user_object = User(**database_result)
     return user_object
 
@@ -54,11 +96,32 @@ def set_user_roles_db(username: str, updated_roles: list) -> bool:
     :param updated_roles: Array of roles that user will now have
     :return: Success: True or False
     """
-    if not user_collection.find_one({"username": username}):
-        return False
+    result = user_collection.update_one({'username': username}, {'$set': {'roles': updated_roles}})
+    return result.matched_count > 0
 
-    user_collection.update_one({'username': username}, {'$set': {'roles': updated_roles}})
-    return True
+
+def set_user_password_db(username: str, hashed_password: str) -> bool:
+    """
+    Replaces the password hash of a user, such as when the hash is updated to a new cost.
+
+    :param username: Username of user whose password hash is replaced
+    :param hashed_password: New password hash
+    :return: Success: True or False
+    """
+    result = user_collection.update_one({'username': username}, {'$set': {'password': hashed_password}})
+    return result.matched_count > 0
+
+
+def set_user_disabled_db(username: str, disabled: bool) -> bool:
+    """
+    Disables or enables a user account. Disabled users are no longer able to use endpoints that require a login.
+
+    :param username: Username of user that will be disabled or enabled
+    :param disabled: User will be disabled (True) or enabled (False)
+    :return: Success: True or False
+    """
+    result = user_collection.update_one({'username': username}, {'$set': {'disabled': disabled}})
+    return result.matched_count > 0
 
 
 # ---------------------------
@@ -73,8 +136,7 @@ def add_api_key_db(key: APIKeyData) -> dict:
     :return: {'status': 'success'} if added, else {'status': 'failure'}
     """
 
-    if not api_key_collection.find_one({"key": key.key}):
-        api_key_collection.insert_one(key.dict())
+    if insert_if_missing(api_key_collection, {"key": key.key}, key.dict()):
         return {'status': 'success', 'detail': 'API key successfully added.'}
     else:
         return {'status': 'failure', 'detail': 'API key with desired key already exists.'}
@@ -87,10 +149,10 @@ def get_api_key_by_key_db(key: str) -> Union[APIKeyData, None]:
     :param key: API key string to lookup
     :return: APIKeyData if key with given ID exists, else NoneType if no API key for a given key string exists.
     """
-    if not api_key_collection.find_one({"key": key}):
+    database_result = api_key_collection.find_one({"key": key}, {'_id': 0})
+    if not database_result:
         return None
 
-    database_result = api_key_collection.find_one({"key": key})
     api_key_object = APIKeyData(**database_result)
     return api_key_object
 
@@ -102,10 +164,7 @@ def get_api_keys_by_user_db(user: User) -> List[APIKeyData]:
     :param user: User object to find API keys associated with it
     :return: List of APIKeyData for all keys associated with user. Returns [] if no keys found.
     """
-    if not api_key_collection.find_one({"user": user.username}):
-        return []
-
-    database_results = list(api_key_collection.find({"user": user.username, 'enabled': True}))
+    database_results = list(api_key_collection.find({"user": user.username, 'enabled': True}, {'_id': 0}))
     user_keys = [APIKeyData(**res) for res in database_results]
     return user_keys
 
@@ -118,11 +177,8 @@ def set_api_key_enabled_db(key: APIKeyData, enabled: bool) -> bool:
     :param enabled: Key will be enabled (True) or disabled (False)
     :return: Success: True or False
     """
-    if not api_key_collection.find_one({"key": key.key}):
-        return False
-
-    api_key_collection.update_one({'key': key.key}, {'$set': {'enabled': enabled}})
-    return True
+    result = api_key_collection.update_one({'key': key.key}, {'$set': {'enabled': enabled}})
+    return result.matched_count > 0
 
 
 # ---------------------------
@@ -130,15 +186,20 @@ def set_api_key_enabled_db(key: APIKeyData, enabled: bool) -> bool:
 # ---------------------------
 
 
-def add_image_db(image: UniversalMLImage):
+def add_image_db(image: UniversalMLImage) -> bool:
     """
     Adds a new image to the database based on the UniversalMLImage model.
 
     :param image: UniversalMLImage to add to database.
+    :return: True if added, else False if an image with the same hash already exists
     """
 
-    if not image_collection.find_one({"hash_md5": image.hash_md5}):
-        image_collection.insert_one(image.dict())
+    if not insert_if_missing(image_collection, {"hash_md5": image.hash_md5}, image.dict()):
+        return False
+
+    update_image_counts(image.users, images=1, labels=get_label_counts(image.labels))
+    update_search_versions(image.users, all_images=True)
+    return True
 
 
 def add_user_to_image(image: UniversalMLImage, username: str):
@@ -148,50 +209,114 @@ def add_user_to_image(image: UniversalMLImage, username: str):
     :param image: UniversalMLImage to update
     :param username: Username of user who is accessing image
     """
-    if image_collection.find_one({"hash_md5": image.hash_md5}):
-        existing_users = list(image_collection.find_one({"hash_md5": image.hash_md5})['users'])
-        if username not in existing_users:  # Only update if not in list already
-            existing_users.append(username)
-            image_collection.update_one(
-                {"hash_md5": image.hash_md5},
-                {'$set': {'users': existing_users}}
-            )
+    result = image_collection.update_one({"hash_md5": image.hash_md5, 'users': {'$ne': username}},
+                                         {'$push': {'users': username}})
+    if result.modified_count:
+        update_image_counts([username], images=1, labels=get_label_counts(image.labels), include_all=False)
+        update_search_versions([username])
 
 
 def add_filename_to_image(image: UniversalMLImage, filename: str):
     """
     Adds a filename to a UniversalMLImage record. This is used to track all file names that an image is uploaded to
-    the server under. An image file is considered "the same" if their md5 hashes are identical.
+    the server under. An image file is considered "the same" if their md5 hashes are identical. The image can then be
+    searched for by the file name.
 
     :param image: UniversalMLImage to update
     :param filename: file name with extension
     """
-    if image_collection.find_one({"hash_md5": image.hash_md5}):
-        current_names = list(image_collection.find_one({"hash_md5": image.hash_md5})['file_names'])
-        if filename not in current_names:  # Only update if not in list already
-            current_names.append(filename)
-            image_collection.update_one(
-                {"hash_md5": image.hash_md5},
-                {'$set': {'file_names': current_names}}
-            )
+    previous = image_collection.find_one_and_update({"hash_md5": image.hash_md5, 'file_names': {'$ne': filename}}, {
+        '$push': {'file_names': filename},
+        '$addToSet': {'search_terms': {'$each': get_search_terms(filename)}}
+    }, projection={'users': 1})
+    if previous:
+        update_search_versions(previous.get('users', []), all_images=True)
 
 
 def add_model_to_image_db(image: UniversalMLImage, model_name, result):
     """
     Adds prediction data to a UniversalMLImage object. This is normally called when a prediction microservice
-    returns data to the server with the results of a prediction request. The 'metadata' field is always updated.
-    in this method as a string to enable easy querying of nested model results.
+    returns data to the server with the results of a prediction request. The labels of the model replace any it had
+    for the image before, and the model and class names are added to the search terms of the image. The update is
+    done by the database in a single write, so only the new result is sent.
 
     :param image: UniversalMLImage to add prediction data to
     :param model_name: Name of model that was run on the image.
     :param result: JSON results of the training
     """
 
-    new_metadata = [list(image.dict().values()), model_name, result]
-    image_collection.update_one({'hash_md5': image.hash_md5}, {'$set': {
-        'models.' + model_name: result,
-        'metadata': json.dumps(new_metadata)
-    }})
+    labels = get_image_labels(model_name, result)
+    previous = image_collection.find_one_and_update({'hash_md5': image.hash_md5}, [{'$set': {
+        'models.' + model_name: {'$literal': result},
+        'labels': {'$concatArrays': [
+            {'$filter': {'input': {'$ifNull': ['$labels', []]}, 'cond': {'$ne': ['$$this.model', model_name]}}},
+            {'$literal': labels}
+        ]},
+        'search_terms': {'$setUnion': [
+            {'$ifNull': ['$search_terms', []]},
+            {'$literal': get_label_search_terms(labels)}
+        ]}
+    }}], projection={'users': 1, 'labels': 1}, return_document=ReturnDocument.BEFORE)
+
+    # Update the cached label counts with the classes that the model result added or removed
+    if previous:
+        previous_labels = [label for label in previous.get('labels', []) if label['model'] == model_name]
+        label_changes = get_label_counts(labels)
+        for label, number in get_label_counts(previous_labels).items():
+            label_changes[label] = label_changes.get(label, 0) - number
+        update_image_counts(previous.get('users', []), labels=label_changes)
+        update_search_versions(previous.get('users', []), model_name=model_name)
+
+
+def get_label_counts(labels: List[dict]) -> dict:
+    """
+    :param labels: Labels of an image. See get_image_labels
+    :return: Number of times each label appears, as {(modelName, className): 1, ...}
+    """
+    return {(label['model'], label['class']): 1 for label in labels}
+
+
+def get_image_labels(model_name: str, result) -> List[dict]:
+    """
+    Creates the labels of an image from the result of a model. Every class with a positive score is a label.
+
+    :param model_name: Name of model that was run on the image.
+    :param result: JSON results of the model, as {className: score, ...}
+    :return: List of labels, as [{'model': modelName, 'class': className, 'score': score}, ...]
+    """
+    if not isinstance(result, dict):
+        return []
+
+    return [{'model': model_name, 'class': str(model_class), 'score': score}
+            for model_class, score in result.items()
+            if isinstance(score, (int, float)) and not isinstance(score, bool) and score > 0]
+
+
+def get_label_search_terms(labels: List[dict]) -> List[str]:
+    """
+    :param labels: Labels of an image. See get_image_labels
+    :return: Search terms for the model and class names of the labels, including a "model:class" term for each
+    """
+    terms = set()
+    for label in labels:
+        terms.update(get_search_terms(label['model'], label['class'], label['model'] + ':' + label['class']))
+    return sorted(terms)
+
+
+def get_search_terms(*texts: str) -> List[str]:
+    """
+    Splits text into the lowercase terms it can be searched by. Each text is a term as a whole, as is each of its
+    words. For example "Dog_01.JPG" has the terms "dog_01.jpg", "dog", "01" and "jpg".
+
+    :param texts: Text to split, such as file names or class names
+    :return: List of unique search terms
+    """
+    terms = set()
+    for text in texts:
+        text = text.lower()
+        terms.add(text)
+        terms.update(word for word in re.split(r'[^a-z0-9]+', text) if word)
+    return sorted(terms)
 
 
 def get_images_from_user_db(
@@ -199,74 +324,315 @@ def get_images_from_user_db(
         page: int = -1,
         search_filter: dict = None,
         search_string: str = '',
-        paginate: bool = True
+        paginate: bool = True,
+        min_score: float = 0,
+        page_size: int = PAGINATION_PAGE_SIZE,
+        cursor: str = None,
+        estimate: bool = False,
+        count: bool = True
 ):
     """
     Returns a list of image hashes associated with a username. This method also has pagination support and if a page
-    number is provided, then it will return dependency.PAGINATION_PAGE_SIZE image hashes. If the username of the user
-    in this request is an administrator, then all images in the server will be queried. Otherwise, only UniversalMLImage
-    objects that contain the username will be included in the results.
+    number is provided, then it will return page_size image hashes. If the username of the user in this request is an
+    administrator, then all images in the server will be queried. Otherwise, only UniversalMLImage objects that
+    contain the username will be included in the results.
+
+    Pages may also be requested with a cursor instead of a page number. A cursor page is found with an index range
+    scan starting after the last image of the previous page, so every page is as fast as the first, and images that
+    are added while paging do not shift the pages. Results are always in the order the images were added.
 
     This method also has unique functionality to allow for filtering of image results. If these values are provided,
     the mongo query will be filtered based on the fields available in search_filter and search_string.
 
     :param username: Username of user to get images for
     :param page: Page to return of results. Will return all images if page is -1
-    :param search_filter Optional filter to narrow down query
-    :param search_string String that will be matched against image metadata
+    :param search_filter Optional filter to narrow down query, as {modelName: [className, ...], ...}
+    :param search_string Words that must each start a search term of the image, such as a file name or class
     :param paginate Return all results or only page
-    :return: Array of image hashes, total pages
+    :param min_score Score a class in search_filter must be over for an image to match
+    :param page_size Number of image hashes per page
+    :param cursor Return the page after this cursor instead of a page number. '' for the first page
+    :param estimate Count at most dependency.SEARCH_COUNT_LIMIT images, if the count of the search is not cached
+    :param count Count the images matching the search. If False, the result has no image or page totals
+    :return: Array of image hashes, total pages. In cursor mode, also the cursor of the next page, or None if this is
+             the last page
+    :raises ValueError: If the cursor is not valid
     """
 
     user = get_user_by_name_db(username)
     if not user:  # If user does not exist, return empty
         return [], 0
 
-    # If there is a filter, start with the correct dataset that has been filtered already
-    # Generate the result of the query in this step
-    if search_filter or search_string:
-        # List comprehension to take the inputted filter and make it into a pymongo query-compatible expression
-        search_params = []
-        if search_filter:  # Append search filter
-            flat_model_filter = (
-                [{'models.' + model + '.' + str(model_class): {'$gt': 0}} for model in search_filter for model_class in
-                 search_filter[model]])
-            search_params.append({'$or': flat_model_filter})
-        if search_string:  # Append search string
-            search_params.append({"metadata": {'$regex': search_string, '$options': 'i'}})
-        if Roles.admin.name not in user.roles:  # Add username to limit results if not admin
-            search_params.append({'users': username})
-
-        result = image_collection.find({'$and': search_params}, {"hash_md5"})
-    else:
-        if Roles.admin.name in user.roles:
-            result = image_collection.find({}, {"hash_md5"})
-        else:
-            result = image_collection.find({'users': username}, {"hash_md5"})
+    query = get_search_query(user, search_filter, search_string, min_score)
 
     # If we are getting a specific page of images, then generate the list of hashes
     final_hash_list = []
-    if page > 0 and paginate:
+    next_cursor = None
+    if cursor is not None:
+        page_query = {'$and': [query, {'_id': {'$gt': decode_search_cursor(cursor)}}]} if cursor else query
+        result = list(image_collection.find(page_query, {"hash_md5"}).sort('_id', 1).limit(page_size + 1))
+        if len(result) > page_size:  # There is at least one more page
+            next_cursor = encode_search_cursor(result[page_size - 1]['_id'])
+        final_hash_list = [image_map['hash_md5'] for image_map in result[:page_size]]
+    elif page > 0 and paginate:
         # We use this for actual db queries. Page 1 = index 0
         page_index = page - 1
-        final_hash_list = result.skip(PAGINATION_PAGE_SIZE * page_index).limit(PAGINATION_PAGE_SIZE)
+        result = image_collection.find(query, {"hash_md5"}).sort('_id', 1).skip(page_size * page_index).limit(page_size)
 
         # After query, convert the result to a list
-        final_hash_list = [image_map['hash_md5'] for image_map in list(final_hash_list)]
-    elif not paginate:  # Return all results
         final_hash_list = [image_map['hash_md5'] for image_map in list(result)]
-
-    num_images = result.count()
-    return_value = {
-        "hashes": final_hash_list,
-        "num_images": num_images
-    }
-    if paginate:
-        return_value["num_pages"] = math.ceil(num_images / PAGINATION_PAGE_SIZE)
+    elif not paginate:  # Return all results
+        final_hash_list = [image_map['hash_md5'] for image_map in image_collection.find(query, {"hash_md5"})]
+
+    return_value = {"hashes": final_hash_list}
+    if count:
+        num_images, estimated = count_images_db(query, None if Roles.admin.name in user.roles else username,
+                                                search_filter, search_string, min_score, estimate)
+        return_value["num_images"] = num_images
+        return_value["num_images_estimated"] = estimated
+        if paginate:
+            return_value["num_pages"] = math.ceil(num_images / page_size)
+    if cursor is not None:
+        return_value["next_cursor"] = next_cursor
 
     return return_value
 
 
+def iterate_images_from_user_db(
+        username: str,
+        search_filter: dict = None,
+        search_string: str = '',
+        min_score: float = 0,
+        fields: List[str] = (),
+        batch_size: int = 1000,
+        attributes: List[str] = ()
+):
+    """
+    Yields every image that matches a search, reading them from the database in batches. Unlike
+    get_images_from_user_db, the results are never held in memory all at once, so this is used to export searches
+    of any size. See get_images_from_user_db for the search parameters.
+
+    :param username: Username of user to get images for
+    :param search_filter: Optional filter to narrow down query, as {modelName: [className, ...], ...}
+    :param search_string: Words that must each start a search term of the image, such as a file name or class
+    :param min_score: Score a class in search_filter must be over for an image to match
+    :param fields: Model results to include, as "modelName" or "modelName.className"
+    :param batch_size: Number of images read from the database at once
+    :param attributes: Other attributes of the images to include, such as 'file_names' or 'users'
+    :return: Generator of images, as {'hash_md5': ..., 'models': {...}}. models only holds the requested fields
+    """
+    user = get_user_by_name_db(username)
+    if not user:  # If user does not exist, return empty
+        return
+
+    projection = {'_id': 0, 'hash_md5': 1}
+    projection.update({'models.' + field: 1 for field in fields})
+    projection.update({attribute: 1 for attribute in attributes})
+    query = get_search_query(user, search_filter, search_string, min_score)
+    for image in image_collection.find(query, projection, batch_size=batch_size):
+        image.setdefault('models', {})
+        yield image
+
+
+def get_search_query(user: User, search_filter: dict = None, search_string: str = '', min_score: float = 0) -> dict:
+    """
+    Creates the query of an image search. Users who are not administrators only search their own images.
+
+    :param user: User who is searching
+    :param search_filter: Optional filter to narrow down query, as {modelName: [className, ...], ...}
+    :param search_string: Words that must each start a search term of the image, such as a file name or class
+    :param min_score: Score a class in search_filter must be over for an image to match
+    :return: Query for the image collection
+    """
+    search_params = []
+    if search_filter:  # Append search filter
+        search_params.append(get_search_filter_query(search_filter, min_score))
+    if search_string:  # Append search string
+        search_params.extend(get_search_string_query(search_string))
+    if Roles.admin.name not in user.roles:  # Add username to limit results if not admin
+        search_params.append({'users': user.username})
+    return {'$and': search_params} if search_params else {}
+
+
+def count_search_db(username: str, search_filter: dict = None, search_string: str = '', min_score: float = 0,
+                    estimate: bool = False) -> (int, bool):
+    """
+    Counts the images matching a search, without finding a page of them. See get_images_from_user_db for the
+    parameters.
+
+    :return: Number of images, and whether the number is a lower bound because the count stopped at the limit
+    """
+    user = get_user_by_name_db(username)
+    if not user:  # If user does not exist, there are no images
+        return 0, False
+
+    query = get_search_query(user, search_filter, search_string, min_score)
+    return count_images_db(query, None if Roles.admin.name in user.roles else username, search_filter, search_string,
+                           min_score, estimate)
+
+
+def count_images_db(query: dict, username: Union[str, None], search_filter: dict, search_string: str,
+                    min_score: float, estimate: bool = False) -> (int, bool):
+    """
+    Counts the images matching a search. The counts of every image of a user, and of the images of a user labeled
+    with a single class, are cached. Other searches are counted by the database, which reads every matching index
+    entry. In estimate mode, the database stops counting after dependency.SEARCH_COUNT_LIMIT images.
+
+    :param query: Query of the search
+    :param username: User whose images are searched, or None for every image
+    :param search_filter: Filter of the search, as {modelName: [className, ...], ...}
+    :param search_string: Search string of the search
+    :param min_score: Score a class in search_filter must be over for an image to match
+    :param estimate: Count at most dependency.SEARCH_COUNT_LIMIT images, if the count is not cached
+    :return: Number of images, and whether the number is a lower bound because the count stopped at the limit
+    """
+    search_filter = search_filter or {}
+    filtered_classes = [(model_name, model_class) for model_name in search_filter
+                        for model_class in search_filter[model_name]]
+
+    count_key = None
+    if not search_filter and not search_string:
+        count_key = image_count_key(username)
+    elif len(filtered_classes) == 1 and not search_string and min_score <= 0:
+        count_key = image_count_key(username, *filtered_classes[0])
+
+    if count_key:
+        return get_cached_count(count_key, lambda: image_collection.count_documents(query)), False
+
+    if estimate:
+        num_images = image_collection.count_documents(query, limit=SEARCH_COUNT_LIMIT)
+        return num_images, num_images >= SEARCH_COUNT_LIMIT
+
+    return image_collection.count_documents(query), False
+
+
+def encode_search_cursor(image_id: ObjectId) -> str:
+    """
+    :param image_id: Database ID of the last image on a page
+    :return: Opaque cursor of the next page
+    """
+    return base64.urlsafe_b64encode(image_id.binary).decode()
+
+
+def decode_search_cursor(cursor: str) -> ObjectId:
+    """
+    :param cursor: Cursor created by encode_search_cursor
+    :return: Database ID of the last image on the previous page
+    :raises ValueError: If the cursor is not valid
+    """
+    try:
+        return ObjectId(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, InvalidId, TypeError):
+        raise ValueError('Invalid search cursor: ' + cursor)
+
+
+def get_search_string_query(search_string: str) -> List[dict]:
+    """
+    Creates the query conditions for a search string. Every word of the search string must be the start of one of
+    the search terms of an image. The regular expressions are anchored and case-sensitive, so that the search_terms
+    index is scanned only over the range of terms that start with the word, instead of over every term.
+
+    :param search_string: Words to search for, separated by whitespace
+    :return: List of query conditions, one per word
+    """
+    return [{'search_terms': {'$regex': '^' + re.escape(word)}} for word in search_string.lower().split()]
+
+
+def get_search_filter_query(search_filter: dict, min_score: float = 0) -> dict:
+    """
+    Creates the query condition for a search filter. An image matches if it has a label for any of the classes in
+    the filter with a score over min_score. Each model is matched with a single $elemMatch on the labels, which is
+    answered by the labels index no matter which model or class is filtered on.
+
+    :param search_filter: Classes to search for, as {modelName: [className, ...], ...}
+    :param min_score: Score a class must be over for an image to match
+    :return: Query condition
+    """
+    return {'$or': [
+        {'labels': {'$elemMatch': {
+            'model': model,
+            'class': {'$in': [str(model_class) for model_class in search_filter[model]]},
+            'score': {'$gt': min_score}
+        }}}
+        for model in search_filter
+    ]}
+
+
+def ensure_indexes_db() -> List[dict]:
+    """
+    Creates every index in REQUIRED_INDEXES that does not exist yet. Creating an index that already exists does
+    nothing, so this is run on every server startup. An index that can not be created, such as a unique index over a
+    collection that already holds duplicates, is logged and left out.
+
+    :return: Indexes that are still missing. See get_missing_indexes_db
+    """
+    for collection, keys, options in REQUIRED_INDEXES:
+        try:
+            collection.create_index(keys, **options)
+        except OperationFailure as e:
+            logger.warning('Unable to create index ' + str(keys) + ' on ' + collection.name + ': ' + str(e))
+
+    missing_indexes = get_missing_indexes_db()
+    for index in missing_indexes:
+        logger.warning('Missing index ' + str(index['keys']) + ' on ' + index['collection'])
+    return missing_indexes
+
+
+def get_missing_indexes_db() -> List[dict]:
+    """
+    Creates a report of the indexes in REQUIRED_INDEXES that do not exist in the database. The return value is of
+    the format [{'collection': collectionName, 'keys': [[field, direction], ...], 'unique': bool}, ...]
+
+    :return: List of missing indexes. [] if every index exists.
+    """
+    missing_indexes = []
+    existing_keys = {}
+    for collection, keys, options in REQUIRED_INDEXES:
+        if collection.name not in existing_keys:
+            existing_keys[collection.name] = [[(field, direction if isinstance(direction, str) else int(direction))
+                                               for field, direction in index['key']]
+                                              for index in collection.index_information().values()]
+
+        if keys not in existing_keys[collection.name]:
+            missing_indexes.append({
+                'collection': collection.name,
+                'keys': [list(key) for key in keys],
+                'unique': options.get('unique', False)
+            })
+    return missing_indexes
+
+
+def migrate_image_labels_db(batch_size: int = 1000):
+    """
+    Converts images that were stored with a 'metadata' string, which held a copy of the whole image, to labels and
+    search terms. Images that were already converted are not touched, so this is safe to run on every startup.
+
+    :param batch_size: Number of images to update per write
+    """
+    updates = []
+    migrated = False
+    for image in image_collection.find({'metadata': {'$exists': True}}, {'file_names': 1, 'models': 1}):
+        labels = [label for model_name, result in image.get('models', {}).items()
+                  for label in get_image_labels(model_name, result)]
+        search_terms = set(get_label_search_terms(labels)).union(get_search_terms(*image.get('file_names', [])))
+        updates.append(UpdateOne({'_id': image['_id']}, {
+            '$set': {'labels': labels, 'search_terms': sorted(search_terms)},
+            '$unset': {'metadata': ''}
+        }))
+
+        if len(updates) >= batch_size:
+            image_collection.bulk_write(updates, ordered=False)
+            updates = []
+            migrated = True
+
+    if updates:
+        image_collection.bulk_write(updates, ordered=False)
+        migrated = True
+
+    if migrated:  # Counts and search results that were cached during the migration are out of date
+        send_update(reconcile_search_counts)
+
+
 def get_models_from_image_db(image: UniversalMLImage, model_name: str = ""):
     """
     Creates a dictionary of all models with prediction results for a given image. This is returned
@@ -279,17 +645,17 @@ def get_models_from_image_db(image: UniversalMLImage, model_name: str = ""):
 
     projection = {
         "_id": 0,
-        "models": 1
+        "models" + ("." + model_name if model_name != "" else ""): 1
     }
 
-    if not image_collection.find_one({"hash_md5": image.hash_md5}):
+    results = image_collection.find_one({"hash_md5": image.hash_md5}, projection)
+    if not results:
         return {}
 
     if model_name != "":
-        results = image_collection.find_one({"hash_md5": image.hash_md5}, projection)
         return {model_name: results['models'][model_name]}
     else:
-        return image_collection.find_one({"hash_md5": image.hash_md5}, projection)['models']
+        return results['models']
 
 
 def get_image_by_md5_hash_db(image_hash) -> Union[UniversalMLImage, None]:
@@ -299,11 +665,10 @@ def get_image_by_md5_hash_db(image_hash) -> Union[UniversalMLImage, None]:
     :param image_hash: md5 hash of image to search for
     :return: UniversalMLImage object of image with a md5 hash, or None if not found
     """
-    if not image_collection.find_one({"hash_md5": image_hash}):
+    result = image_collection.find_one({"hash_md5": image_hash}, {'_id': 0})
+    if not result:
         return None
 
-    result = image_collection.find_one({"hash_md5": image_hash})
-    result.pop('_id')
     return UniversalMLImage(**result)
 
 
@@ -320,11 +685,12 @@ def add_model_db(model_name: str, model_fields: List[str]):
     :param model_name: Name of model
     :param model_fields: List of all possible classes model may return
     """
-    if not model_collection.find_one({'model_name': model_name}):
-        model_collection.insert_one({
-            'model_name': model_name,
-            'model_fields': model_fields
-        })
+    # Fields that were already stored are kept
+    model_collection.update_one(
+        {'model_name': model_name},
+        [{'$set': {'model_fields': {'$ifNull': ['$model_fields', {'$literal': model_fields}]}}}],
+        upsert=True
+    )
 
 
 def get_models_db():
@@ -334,33 +700,130 @@ def get_models_db():
 
     :return: List of all models and their classes. [] if no models registered.
     """
-    all_models = list(model_collection.find())
+    all_models = list(model_collection.find({'model_fields': {'$exists': True}}))
     model_list = {model['model_name']: model['model_fields'] for model in all_models}
     return model_list
 
 
+def set_model_socket_db(model_name: str, socket: str):
+    """
+    Persists the socket that a model microservice registered with. This allows the server to restore its
+    available models on startup without waiting for every model microservice to register again. The socket is also
+    added to the replicas of the model.
+
+    :param model_name: Name of model
+    :param socket: Socket the model is running on
+    """
+    model_collection.update_one(
+        {'model_name': model_name},
+        {'$set': {'socket': socket}, '$addToSet': {'replicas': socket}},
+        upsert=True
+    )
+
+
+def set_model_capacity_db(model_name: str, capacity: dict):
+    """
+    Persists the limits a model microservice advertised when it registered, such as its maximum batch size and
+    concurrency. See MicroserviceConnection.capacity.
+
+    :param model_name: Name of model
+    :param capacity: Dictionary of the limits of the model
+    """
+    model_collection.update_one({'model_name': model_name}, {'$set': {'capacity': capacity}}, upsert=True)
+
+
+def get_model_capacity_db(model_name: str) -> dict:
+    """
+    :param model_name: Name of model
+    :return: Dictionary of the limits the model advertised when it registered. {} if it did not advertise any.
+    """
+    model = model_collection.find_one({'model_name': model_name}, {'capacity': 1})
+    return model.get('capacity', {}) if model else {}
+
+
+def get_model_capacities_db() -> dict:
+    """
+    Creates a dictionary of the advertised limits of every model that has them. The return value is of the format
+    {modelName: {maxBatchSize: ..., ...}, ...}
+
+    :return: Dictionary of model names and limits. {} if no model has advertised limits.
+    """
+    known_models = model_collection.find({'capacity': {'$exists': True}}, {'model_name': 1, 'capacity': 1})
+    return {model['model_name']: model['capacity'] for model in known_models}
+
+
+def add_model_replica_db(model_name: str, socket: str):
+    """
+    Persists the socket of an additional replica of a model that is already registered.
+
+    :param model_name: Name of model
+    :param socket: Socket the replica is running on
+    """
+    model_collection.update_one({'model_name': model_name}, {'$addToSet': {'replicas': socket}})
+
+
+def remove_model_replica_db(model_name: str, socket: str):
+    """
+    Removes the persisted socket of a single replica of a model.
+
+    :param model_name: Name of model
+    :param socket: Socket the replica was running on
+    """
+    model_collection.update_one({'model_name': model_name}, {'$pull': {'replicas': socket}})
+
+
+def remove_model_socket_db(model_name: str):
+    """
+    Removes the persisted socket and replicas of a model. This is called once a model stops responding, so that it
+    will not be restored on the next server startup.
+
+    :param model_name: Name of model
+    """
+    model_collection.update_one({'model_name': model_name}, {'$unset': {'socket': '', 'replicas': ''}})
+
+
+def get_model_sockets_db():
+    """
+    Creates a dictionary of every model with a persisted socket. The return value is of the format
+    {modelName: modelSocket, ...}
+
+    :return: Dictionary of model names and sockets. {} if no models have been registered.
+    """
+    known_models = model_collection.find({'socket': {'$exists': True}}, {'model_name': 1, 'socket': 1})
+    return {model['model_name']: model['socket'] for model in known_models}
+
+
+def get_model_replicas_db():
+    """
+    Creates a dictionary of every model with a persisted socket, and the sockets of all of its replicas. The
+    return value is of the format {modelName: [modelSocket, replicaSocket1, ...], ...}
+
+    :return: Dictionary of model names and sockets. {} if no models have been registered.
+    """
+    known_models = model_collection.find({'socket': {'$exists': True}}, {'model_name': 1, 'socket': 1, 'replicas': 1})
+    return {
+        model['model_name']: [model['socket']] + [s for s in model.get('replicas', []) if s != model['socket']]
+        for model in known_models
+    }
+
+
 # ------------------------------
 # Training Database Interactions
 # ------------------------------
 
 def add_training_result_db(tr: TrainingResult):
-    if not training_collection.find_one({'training_id': tr.training_id}):
-        training_collection.insert_one(tr.dict())
+    insert_if_missing(training_collection, {'training_id': tr.training_id}, tr.dict())
 
 
 def update_training_result_db(tr: TrainingResult):
-    if not training_collection.find_one({'training_id': tr.training_id}):
-        add_training_result_db(tr)
-    else:
-        training_collection.replace_one({'training_id': tr.training_id}, tr.dict())
+    training_collection.replace_one({'training_id': tr.training_id}, tr.dict(), upsert=True)
 
 
 def get_training_result_by_training_id(training_id: str):
-    if not training_collection.find_one({'training_id': training_id}):
+    res = training_collection.find_one({'training_id': training_id}, {'_id': 0})
+    if not res:
         return None
 
-    res = training_collection.find_one({'training_id': training_id})
-
     return TrainingResult(**res)
 
 
@@ -376,9 +839,9 @@ def get_bulk_training_results_reverse_order_db(limit: int = -1, username: str =
 
     query = {'username': username} if len(username) > 0 else {}
     if limit > 0:
-        res = training_collection.find(query, {'_id': False}).sort([('$natural', -1)]).limit(limit)
+        res = training_collection.find(query, {'_id': False}).sort([('_id', -1)]).limit(limit)
     else:
-        res = training_collection.find(query, {'_id': False}).sort([('$natural', -1)])
+        res = training_collection.find(query, {'_id': False}).sort([('_id', -1)])
 
     return list(res)
 
@@ -390,12 +853,10 @@ def get_training_statistics_db(username: str = None):
     :param username: Optional username. If provided will only find jobs that a user has submitted.
     :return: 2-tuple of jobs pending, jobs finished
     """
-    if username is not None:
-        u = get_user_by_name_db(username)
-        finished = training_collection.find({'username': username, 'complete': True})
-        pending = training_collection.find({'username': username, 'complete': False})
-    else:
-        finished = training_collection.find({'complete': True})
-        pending = training_collection.find({'complete': False})
+    query = {'username': username} if username is not None else {}
+    counts = {group['_id']: group['count'] for group in training_collection.aggregate([
+        {'$match': query},
+        {'$group': {'_id': '$complete', 'count': {'$sum': 1}}}
+    ])}
 
-    return pending.count(), finished.count()
+    return counts.get(False, 0), counts.get(True, 0)
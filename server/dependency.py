@@ -1,8 +1,10 @@
+import json
 import logging
 from concurrent.futures.thread import ThreadPoolExecutor
 from enum import Enum
 from typing import Optional, List
 
+import httpx
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.security import APIKeyHeader
 from passlib.context import CryptContext
@@ -32,7 +34,19 @@ training_collection = database[
     "training"
 ]  # Create collection for training status and results
 
-PAGINATION_PAGE_SIZE = 15
+PAGINATION_PAGE_SIZE = int(os.getenv('PAGINATION_PAGE_SIZE', default=15))  # Default number of images per search page
+MAX_PAGINATION_PAGE_SIZE = int(os.getenv('MAX_PAGINATION_PAGE_SIZE', default=1000))
+SEARCH_COUNT_TTL = 60 * 60 * 24  # Seconds a cached count of search results is kept for
+SEARCH_COUNT_LIMIT = int(os.getenv('SEARCH_COUNT_LIMIT', default=10000))  # Images counted at most in estimate mode
+SEARCH_CACHE_MAX_HASHES = int(os.getenv('SEARCH_CACHE_MAX_HASHES', default=500000))  # Hashes cached per process
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', default=300))  # Seconds a cached search result is kept for
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', default=10000))  # Authenticated users cached per process
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', default=60))  # Seconds an authenticated user is cached for
+API_KEY_CACHE_SIZE = int(os.getenv('API_KEY_CACHE_SIZE', default=10000))  # API keys cached per process
+API_KEY_CACHE_TTL = int(os.getenv('API_KEY_CACHE_TTL', default=60))  # Seconds a validated API key is cached for
+API_KEY_NEGATIVE_CACHE_TTL = int(os.getenv('API_KEY_NEGATIVE_CACHE_TTL', default=10))  # Seconds unknown keys are kept
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', default=10000))  # Verified bearer tokens cached per process
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', default=300))  # Seconds a verified token is cached for at most
 
 
 # --------------------------------------------------------------------------------
@@ -46,6 +60,8 @@ class Settings(BaseSettings):
     """
 
     available_models = {}
+    model_replicas = {}  # Sockets of every running replica of each model, including the one in available_models
+    model_capacities = {}  # Limits advertised by each model when it registered. See MicroserviceConnection
     available_datasets = {}
 
 
@@ -53,11 +69,63 @@ settings = Settings()
 
 pool = ThreadPoolExecutor(10)
 WAIT_TIME = 10
+STATUS_TIMEOUT = 5  # Seconds to wait for a microservice to respond to a status check
+HTTP_TIMEOUT = 30  # Seconds that async route handlers wait for a microservice to respond
+
+# HTTP client for async route handlers, which must not block the event loop with requests
+async_http_client = httpx.AsyncClient(timeout=HTTP_TIMEOUT)
 shutdown = False  # Signal used to shutdown running threads on restart
 
 # Redis Queue for model-prediction jobs
-redis = rd.Redis(host="redis", port=6379)
+redis = rd.Redis(host=os.getenv("REDIS_HOST", default="redis"), port=6379)
 prediction_queue = Queue("model_prediction", connection=redis)
+export_queue = Queue("bulk_export", connection=redis)  # Bulk exports of prediction results, processed by export_worker
+PREDICTION_JOB_TIMEOUT = 600  # Maximum seconds a single prediction job may run for
+CONCURRENCY_POLL_INTERVAL = 0.05  # Seconds between checks for a free request slot on a busy model replica
+SUBMISSION_TTL = 60 * 60 * 24 * 7  # Seconds the jobs of a prediction submission are tracked for cancellation
+
+# Seconds a prediction job may wait before it expires and is skipped by the workers. Jobs have no deadline by default,
+# which can be changed for every model with DEFAULT_PREDICTION_DEADLINE, for specific models with
+# MODEL_DEADLINES='{"modelName": seconds}', or for a single request with the deadline parameter of /model/predict.
+DEFAULT_PREDICTION_DEADLINE = int(os.getenv("DEFAULT_PREDICTION_DEADLINE", default=0))
+MODEL_DEADLINES = json.loads(os.getenv("MODEL_DEADLINES", default="{}"))
+
+# Interactive prediction jobs are sent to a second model replica if the first has not answered within the observed p95
+# latency of the model. At most this fraction of recent jobs of a model may be hedged. 0 disables hedging.
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", default=0.05))
+
+# Admission control for model-prediction jobs. Requests over these limits are rejected with HTTP 429.
+MAX_QUEUE_DEPTH_PER_MODEL = int(os.getenv("MAX_QUEUE_DEPTH_PER_MODEL", default=20000))
+MAX_OUTSTANDING_JOBS_PER_USER = int(os.getenv("MAX_OUTSTANDING_JOBS_PER_USER", default=10000))
+# Seconds after being enqueued that a job stops counting towards those limits if it was never seen to finish, such as
+# when its worker was killed or its queue was emptied by hand
+IN_FLIGHT_JOB_TTL = int(os.getenv("IN_FLIGHT_JOB_TTL", default=60 * 60 * 24))
+THROUGHPUT_WINDOW = 300  # Seconds of completed jobs used to estimate model throughput
+DEFAULT_RETRY_AFTER = 60  # Retry-After seconds sent when a model has no recent throughput
+
+# Fair-share weights of prediction jobs, keyed by "role:<role>" or "agency:<agency>". Users have a weight of 1 if no
+# entry applies. Example: FAIR_SHARE_WEIGHTS='{"role:admin": 2, "agency:State Police": 4}'
+FAIR_SHARE_WEIGHTS = json.loads(os.getenv("FAIR_SHARE_WEIGHTS", default="{}"))
+
+# Priority lanes of prediction jobs are drained either in "strict" priority order, or are "weighted" so that lower
+# priority lanes are served LANE_WEIGHTS jobs per round and never fully starve.
+LANE_SCHEDULING = os.getenv("LANE_SCHEDULING", default="strict")
+LANE_WEIGHTS = json.loads(os.getenv("LANE_WEIGHTS", default='{"interactive": 8, "normal": 4, "backfill": 1}'))
+LATENCY_SAMPLES = 1000  # Number of recent job latencies kept per priority lane
+
+# Uploaded images are stored here by md5 hash, so that queued jobs survive a server restart
+IMAGE_STORE_PATH = "/app/images/"
+
+# Copies of stored images converted to the input spec of a model are cached here. The least recently used copies are
+# deleted once the cache is larger than DERIVED_IMAGE_CACHE_BYTES.
+DERIVED_IMAGE_PATH = IMAGE_STORE_PATH + "derived/"
+DERIVED_IMAGE_CACHE_BYTES = int(os.getenv('DERIVED_IMAGE_CACHE_BYTES', default=2 * 1024 ** 3))
+
+# Bulk exports of prediction results are written here, and may be downloaded until they are EXPORT_TTL seconds old
+EXPORT_PATH = "/app/exports/"
+EXPORT_TTL = 60 * 60 * 24
+EXPORT_JOB_TIMEOUT = 60 * 60 * 3
+EXPORT_ROW_GROUP_SIZE = 100000  # Images written per Parquet row group or Arrow record batch
 
 
 class UniversalMLImage(BaseModel):
@@ -70,8 +138,41 @@ class UniversalMLImage(BaseModel):
     hash_sha1: str  # Image sha1 hash
     hash_perceptual: str  # Image perceptual hash
     users: list = []  # All users who have uploaded the image
-    metadata: str = ""  # All image information stored as a string
     models: dict = {}  # ML Model results
+    labels: list = []  # Every positive model result, as {'model': ..., 'class': ..., 'score': ...}
+    search_terms: List[str] = []  # Lowercase file name, model and class terms that the image can be searched by
+
+
+class PredictionPriority(Enum):
+    """
+    Enum that contains valid priority lanes for model prediction jobs, from highest to lowest priority. Each lane has
+    its own prediction queues, so that bulk work never adds latency to interactive requests.
+    """
+
+    interactive = "interactive"
+    normal = "normal"
+    backfill = "backfill"
+
+
+class ExportFormat(Enum):
+    """
+    Enum that contains valid formats for downloading search results. json returns every hash in a single response,
+    while ndjson and csv stream one image per line.
+    """
+
+    json = "json"
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+class BulkExportFormat(Enum):
+    """
+    Enum that contains valid file formats for bulk exports of prediction results. Both are columnar formats, which
+    require the optional pyarrow package.
+    """
+
+    parquet = "parquet"
+    arrow = "arrow"  # Arrow IPC file
 
 
 class MicroserviceConnection(BaseModel):
@@ -82,9 +183,21 @@ class MicroserviceConnection(BaseModel):
     name: str = Field(alias="modelName")
     socket: str = Field(alias="modelSocket")
 
+    # Limits a model microservice may advertise when it registers. These are stored with the model record.
+    max_batch_size: int = Field(1, alias="maxBatchSize")
+    max_concurrency: int = Field(0, alias="maxConcurrency")  # Requests a replica may handle at once. 0 for no limit
+    input_resolution: Optional[List[int]] = Field(None, alias="inputResolution")  # [width, height]
+    accepted_formats: List[str] = Field([], alias="acceptedFormats")  # "jpeg", "png", "raw" for uint8 RGB... [] for any
+
     class Config:
         allow_population_by_field_name = True
 
+    def capacity(self) -> dict:
+        """
+        :return: Dictionary of the limits advertised by the model microservice
+        """
+        return self.dict(include={'max_batch_size', 'max_concurrency', 'input_resolution', 'accepted_formats'})
+
 
 class SearchFilter(BaseModel):
     search_filter: dict
@@ -94,8 +207,15 @@ class SearchFilter(BaseModel):
 #                             Authentication Objects
 # --------------------------------------------------------------------------------
 
+# Password hashes are checked and created on a separate pool of processes, so that a burst of logins does not hold the
+# GIL of the server. At most PASSWORD_HASH_WORKERS run at once, and requests beyond PASSWORD_HASH_QUEUE_LIMIT waiting
+# for a worker are rejected. Hashes with a cost other than BCRYPT_ROUNDS are updated on the next successful login.
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', default=12))
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', default=2))
+PASSWORD_HASH_QUEUE_LIMIT = int(os.getenv('PASSWORD_HASH_QUEUE_LIMIT', default=64))
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 api_key_header_auth = APIKeyHeader(name="api_key", auto_error=False)
 
 
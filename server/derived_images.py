@@ -0,0 +1,215 @@
+import hashlib
+import io
+import json
+import os
+import time
+from typing import Union
+
+from PIL import Image
+
+import dependency
+from dependency import redis, DERIVED_IMAGE_CACHE_BYTES
+
+DERIVED_IMAGES_KEY = 'images:derived'  # Sorted set of derived image file names by the time they were last used
+DERIVED_IMAGE_SIZES_KEY = 'images:derived:sizes'  # Hash of derived image file name to its size in bytes
+DERIVED_IMAGES_BYTES_KEY = 'images:derived:bytes'  # Total size of every derived image in bytes
+
+RAW_FORMAT = 'raw'  # Uncompressed uint8 RGB pixels in row-major (height, width, channel) order
+
+
+# --------------------------------------------------------------------------------
+#                                 Image Specs
+# --------------------------------------------------------------------------------
+#
+# Models advertise the input resolution and image formats they accept when they
+# register. Images that do not fit this spec are converted before being sent to the
+# model, which saves both network bytes and decode time on the model side. Images
+# that already fit are sent as they were uploaded.
+#
+# --------------------------------------------------------------------------------
+
+
+def normalize_image_format(image_format: str) -> str:
+    """
+    :param image_format: Name of an image format, such as "JPG" or "jpeg"
+    :return: Lowercase name of the format, as used by Pillow
+    """
+    image_format = image_format.lower()
+    return 'jpeg' if image_format == 'jpg' else image_format
+
+
+def get_image_spec(capacity: dict) -> Union[dict, None]:
+    """
+    :param capacity: Limits advertised by a model. See MicroserviceConnection.capacity
+    :return: Input resolution and accepted formats of the model, or None if the model accepts any image
+    """
+    resolution = capacity.get('input_resolution')
+    formats = [normalize_image_format(f) for f in capacity.get('accepted_formats') or []]
+    if not resolution and not formats:
+        return None
+    return {'resolution': list(resolution) if resolution else None, 'formats': formats}
+
+
+def get_target_format(image: Image.Image, spec: dict) -> Union[str, None]:
+    """
+    :param image: Opened image. Only the image header needs to have been read
+    :param spec: Image spec of a model. See get_image_spec
+    :return: Format the image must be converted to for the model, or None if it can be sent as it is
+    """
+    image_format = normalize_image_format(image.format or '')
+    resolution = spec['resolution']
+    if spec['formats'] and image_format not in spec['formats']:
+        return spec['formats'][0]
+
+    if image_format == RAW_FORMAT:
+        return None
+
+    if resolution and (image.width > resolution[0] or image.height > resolution[1]):
+        return image_format
+    return None
+
+
+def derive_image(image: Image.Image, image_format: str, spec: dict) -> bytes:
+    """
+    Converts an image to the spec of a model. Images larger than the input resolution are scaled down to fit within
+    it, keeping their aspect ratio. Raw images are always scaled to exactly the input resolution, since the model has
+    no other way of knowing their size.
+
+    :param image: Opened image
+    :param image_format: Format to convert the image to
+    :param spec: Image spec of a model. See get_image_spec
+    :return: Bytes of the converted image
+    """
+    resolution = spec['resolution']
+    if image_format == RAW_FORMAT:
+        return image.convert('RGB').resize(tuple(resolution)).tobytes()
+
+    if resolution:
+        image.thumbnail(tuple(resolution))
+    if image_format == 'jpeg' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    derived_file = io.BytesIO()
+    image.save(derived_file, format=image_format)
+    return derived_file.getvalue()
+
+
+# --------------------------------------------------------------------------------
+#                             Derived Image Cache
+# --------------------------------------------------------------------------------
+#
+# Converted images are kept on disk in DERIVED_IMAGE_PATH, named by the md5 hash of
+# the original image and a digest of the spec, so that an image sent to many models
+# with the same spec, or sent to the same model again, is only converted once. The
+# last use of every derived image is tracked in redis, and the least recently used
+# images are deleted once their total size goes over DERIVED_IMAGE_CACHE_BYTES.
+#
+# --------------------------------------------------------------------------------
+
+
+def derived_image_name(image_hash: str, spec: dict, image_format: str) -> str:
+    """
+    :param image_hash: md5 hash of the original image
+    :param spec: Image spec of a model. See get_image_spec
+    :param image_format: Format the image is converted to
+    :return: File name of the derived image in DERIVED_IMAGE_PATH
+    """
+    spec_digest = hashlib.md5(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+    return image_hash + '-' + spec_digest + '.' + image_format
+
+
+def open_image_for_model(image_hash: str, file_name: str, capacity: dict):
+    """
+    Opens an image from the image store in a form the model accepts, converting it and caching the result if
+    needed.
+
+    :param image_hash: md5 hash of the image file
+    :param file_name: Name the image was uploaded under
+    :param capacity: Limits advertised by the model. See MicroserviceConnection.capacity
+    :return: Tuple of the file name to send the image under, and a file object of the image
+    """
+    image_file = open(dependency.IMAGE_STORE_PATH + image_hash, 'rb')
+    spec = get_image_spec(capacity)
+    if not spec:
+        return file_name, image_file
+
+    image = Image.open(image_file)  # Only reads the image header
+    image_format = get_target_format(image, spec)
+    if not image_format:
+        image_file.seek(0)
+        return file_name, image_file
+
+    derived_name = derived_image_name(image_hash, spec, image_format)
+    derived_file_name = os.path.splitext(file_name)[0] + '.' + image_format
+    try:
+        derived_file = open(dependency.DERIVED_IMAGE_PATH + derived_name, 'rb')
+        image_file.close()
+        track_derived_image(derived_name, os.fstat(derived_file.fileno()).st_size)
+        return derived_file_name, derived_file
+    except FileNotFoundError:
+        pass
+
+    try:
+        store_derived_image(derived_name, derive_image(image, image_format, spec))
+    finally:
+        image_file.close()
+
+    # Open the derived image before evicting, so that an image larger than the whole cache can still be sent
+    derived_file = open(dependency.DERIVED_IMAGE_PATH + derived_name, 'rb')
+    evict_derived_images()
+    return derived_file_name, derived_file
+
+
+def store_derived_image(derived_name: str, data: bytes):
+    """
+    Saves a derived image to the cache. Images are moved into place after being fully written so that a worker never
+    reads a partial file.
+
+    :param derived_name: File name of the derived image
+    :param data: Bytes of the derived image
+    """
+    os.makedirs(dependency.DERIVED_IMAGE_PATH, exist_ok=True)
+    temporary_path = dependency.DERIVED_IMAGE_PATH + derived_name + '.' + str(os.getpid()) + '.tmp'
+    with open(temporary_path, 'wb') as derived_file:
+        derived_file.write(data)
+    os.replace(temporary_path, dependency.DERIVED_IMAGE_PATH + derived_name)
+
+    track_derived_image(derived_name, len(data))
+
+
+def track_derived_image(derived_name: str, size: int):
+    """
+    Records that a derived image was used. Images that were not tracked yet are added to the size of the cache.
+
+    :param derived_name: File name of the derived image
+    :param size: Size of the derived image in bytes
+    """
+    pipeline = redis.pipeline()
+    pipeline.zadd(DERIVED_IMAGES_KEY, {derived_name: time.time()})
+    pipeline.hsetnx(DERIVED_IMAGE_SIZES_KEY, derived_name, size)
+    if pipeline.execute()[-1]:
+        redis.incrby(DERIVED_IMAGES_BYTES_KEY, size)
+
+
+def evict_derived_images():
+    """
+    Deletes the least recently used derived images until the cache is no larger than DERIVED_IMAGE_CACHE_BYTES.
+    Workers that already have an evicted image open may keep reading it.
+    """
+    while int(redis.get(DERIVED_IMAGES_BYTES_KEY) or 0) > DERIVED_IMAGE_CACHE_BYTES:
+        evicted = redis.zpopmin(DERIVED_IMAGES_KEY)
+        if not evicted:
+            redis.set(DERIVED_IMAGES_BYTES_KEY, 0)  # Nothing left to evict, so the total has drifted
+            return
+
+        derived_name = evicted[0][0].decode()
+        pipeline = redis.pipeline()
+        pipeline.hget(DERIVED_IMAGE_SIZES_KEY, derived_name)
+        pipeline.hdel(DERIVED_IMAGE_SIZES_KEY, derived_name)
+        size = pipeline.execute()[0]
+        redis.decrby(DERIVED_IMAGES_BYTES_KEY, int(size or 0))
+
+        try:
+            os.remove(dependency.DERIVED_IMAGE_PATH + derived_name)
+        except FileNotFoundError:
+            pass
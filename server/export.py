@@ -0,0 +1,241 @@
+import csv
+import io
+import itertools
+import json
+import os
+import time
+import zlib
+from typing import Iterable, Iterator, List
+
+from rq import get_current_job
+
+import dependency
+from db_connection import iterate_images_from_user_db, get_models_db
+
+try:  # pyarrow is only needed for bulk exports, which are disabled without it
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+EXPORT_CHUNK_SIZE = 65536  # Bytes of rows collected before a chunk of an export is sent
+
+
+def get_field_value(models: dict, field: str):
+    """
+    :param models: Model results of an image
+    :param field: Field to get, as "modelName" or "modelName.className"
+    :return: Value of the field, or None if the image has no such result
+    """
+    value = models
+    for key in field.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def ndjson_rows(images: Iterable[dict]) -> Iterator[str]:
+    """
+    :param images: Images to export, as {'hash_md5': ..., 'models': {...}}
+    :return: Generator of one JSON line per image
+    """
+    for image in images:
+        yield json.dumps(image) + '\n'
+
+
+def csv_rows(images: Iterable[dict], fields: List[str]) -> Iterator[str]:
+    """
+    :param images: Images to export, as {'hash_md5': ..., 'models': {...}}
+    :param fields: Model results to include as columns, as "modelName" or "modelName.className"
+    :return: Generator of a CSV header line, and then one line per image. Results that are not a single value are
+             written as JSON
+    """
+    line = io.StringIO()
+    writer = csv.writer(line)
+
+    def format_row(row: list) -> str:
+        line.seek(0)
+        line.truncate()
+        writer.writerow(row)
+        return line.getvalue()
+
+    yield format_row(['hash_md5'] + list(fields))
+    for image in images:
+        row = [image['hash_md5']]
+        for field in fields:
+            value = get_field_value(image['models'], field)
+            row.append(json.dumps(value) if isinstance(value, (dict, list)) else value)
+        yield format_row(row)
+
+
+def encode_chunks(rows: Iterable[str], compress: bool = False) -> Iterator[bytes]:
+    """
+    Joins rows of an export into chunks of about EXPORT_CHUNK_SIZE bytes, so that the response is not sent one row
+    at a time, and optionally compresses them as a gzip stream.
+
+    :param rows: Rows of the export
+    :param compress: Compress the chunks with gzip
+    :return: Generator of chunks of the export
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31 writes a gzip header
+    chunk = []
+    chunk_size = 0
+    for row in rows:
+        chunk.append(row)
+        chunk_size += len(row)
+        if chunk_size >= EXPORT_CHUNK_SIZE:
+            data = ''.join(chunk).encode()
+            yield compressor.compress(data) if compressor else data
+            chunk = []
+            chunk_size = 0
+
+    data = ''.join(chunk).encode()
+    if compressor:
+        yield compressor.compress(data) + compressor.flush()
+    elif data:
+        yield data
+
+
+# --------------------------------------------------------------------------------
+#                                 Bulk Export
+# --------------------------------------------------------------------------------
+#
+# Bulk exports write every image matching a search to a Parquet or Arrow IPC file,
+# with one row per image. The model results are flattened to one float column per
+# model class, named "modelName.className", which compresses far better than the
+# JSON documents of /model/results. Exports run as jobs on the bulk_export queue, and
+# images are read and written EXPORT_ROW_GROUP_SIZE rows at a time.
+#
+# --------------------------------------------------------------------------------
+
+
+def export_available() -> bool:
+    """
+    :return: True if the pyarrow package needed for bulk exports is installed
+    """
+    return pyarrow is not None
+
+
+def get_export_path(export_id: str, export_format: str) -> str:
+    """
+    :param export_id: ID of the export job
+    :param export_format: dependency.BulkExportFormat of the export, as a string
+    :return: Path of the export file
+    """
+    return dependency.EXPORT_PATH + export_id + '.' + export_format
+
+
+def get_export_schema(models: dict):
+    """
+    :param models: Classes of the models to export, as {modelName: [className, ...], ...}
+    :return: pyarrow schema of an export
+    """
+    columns = [
+        ('hash_md5', pyarrow.string()),
+        ('file_names', pyarrow.list_(pyarrow.string())),
+        ('users', pyarrow.list_(pyarrow.string()))
+    ]
+    columns += [(model_name + '.' + str(model_class), pyarrow.float64())
+                for model_name in models for model_class in models[model_name]]
+    return pyarrow.schema(columns)
+
+
+def get_export_batch(images: List[dict], models: dict, schema):
+    """
+    :param images: Images to export, as {'hash_md5': ..., 'file_names': [...], 'users': [...], 'models': {...}}
+    :param models: Classes of the models to export, as {modelName: [className, ...], ...}
+    :param schema: Schema of the export. See get_export_schema
+    :return: pyarrow RecordBatch of the images
+    """
+    columns = [
+        [image['hash_md5'] for image in images],
+        [image.get('file_names', []) for image in images],
+        [image.get('users', []) for image in images]
+    ]
+    for model_name in models:
+        results = [image['models'].get(model_name) for image in images]
+        for model_class in models[model_name]:
+            column = []
+            for result in results:
+                score = result.get(str(model_class)) if isinstance(result, dict) else None
+                column.append(score if isinstance(score, (int, float)) and not isinstance(score, bool) else None)
+            columns.append(column)
+    return pyarrow.RecordBatch.from_arrays([pyarrow.array(c, type=f.type) for c, f in zip(columns, schema)],
+                                           schema=schema)
+
+
+def export_search_results(username: str, export_format: str, search_filter: dict = None, search_string: str = '',
+                          min_score: float = 0, model_names: List[str] = ()):
+    """
+    Job that writes every image matching a search to a columnar file. The file is written under a temporary name,
+    and moved into place once it is complete. The number of images written so far is kept in the 'rows' meta field
+    of the job.
+
+    :param username: Username of user whose images are exported
+    :param export_format: dependency.BulkExportFormat to write, as a string
+    :param search_filter: Optional filter to narrow down the images, as {modelName: [className, ...], ...}
+    :param search_string: Words that must each start a search term of the image, such as a file name or class
+    :param min_score: Score a class in search_filter must be over for an image to match
+    :param model_names: Models whose results are exported. Every model with known classes if empty
+    :return: Path of the export file
+    """
+    job = get_current_job()
+    export_id = job.id if job else username
+    models = get_models_db()
+    if model_names:
+        models = {model_name: models[model_name] for model_name in model_names if model_name in models}
+
+    schema = get_export_schema(models)
+    images = iterate_images_from_user_db(username, search_filter, search_string, min_score, list(models),
+                                         batch_size=dependency.EXPORT_ROW_GROUP_SIZE,
+                                         attributes=['file_names', 'users'])
+
+    os.makedirs(dependency.EXPORT_PATH, exist_ok=True)
+    export_path = get_export_path(export_id, export_format)
+    temporary_path = export_path + '.tmp'
+    if export_format == dependency.BulkExportFormat.parquet.name:
+        writer = pyarrow.parquet.ParquetWriter(temporary_path, schema, compression='zstd')
+    else:
+        writer = pyarrow.ipc.new_file(temporary_path, schema)
+
+    rows = 0
+    try:
+        while True:
+            batch = list(itertools.islice(images, dependency.EXPORT_ROW_GROUP_SIZE))
+            if not batch:
+                break
+
+            record_batch = get_export_batch(batch, models, schema)
+            if export_format == dependency.BulkExportFormat.parquet.name:
+                writer.write_table(pyarrow.Table.from_batches([record_batch]))  # Each batch is one row group
+            else:
+                writer.write_batch(record_batch)
+
+            rows += len(batch)
+            if job:
+                job.meta['rows'] = rows
+                job.save_meta()
+        writer.close()
+    except BaseException:
+        writer.close()
+        os.remove(temporary_path)
+        raise
+
+    os.replace(temporary_path, export_path)
+    dependency.logger.info('Exported ' + str(rows) + ' images to ' + export_path)
+    return export_path
+
+
+def remove_expired_exports():
+    """
+    Deletes every export file that is older than dependency.EXPORT_TTL seconds.
+    """
+    if not os.path.isdir(dependency.EXPORT_PATH):
+        return
+
+    expired = time.time() - dependency.EXPORT_TTL
+    for entry in os.scandir(dependency.EXPORT_PATH):
+        if entry.is_file() and entry.stat().st_mtime < expired:
+            os.remove(entry.path)
@@ -1,16 +1,20 @@
+import threading
 import time
 
 from fastapi.logger import logger
 
 import dependency
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from starlette import status
 from starlette.responses import JSONResponse
 
+from auth_cache import start_auth_cache_listener, stop_auth_cache_listener
+from passwords import shutdown_password_pool
+from db_connection import ensure_indexes_db, migrate_image_labels_db, get_missing_indexes_db
 from dependency import CredentialException, pool
-from routers.auth import auth_router
-from routers.model import model_router
+from routers.auth import auth_router, current_user_admin
+from routers.model import model_router, restore_registered_models
 from routers.training import training_router
 
 
@@ -112,15 +116,56 @@ async def root():
     }
 
 
+@app.get("/indexes", dependencies=[Depends(current_user_admin)])
+def get_missing_indexes():
+    """
+    Reports the database indexes that the server relies on but that do not exist, such as a unique index that could
+    not be created because the collection already holds duplicates. Missing indexes are created on server startup.
+
+    :return: {'status': 'success', 'missing_indexes': [{'collection': collectionName, 'keys': [[field, direction],
+             ...], 'unique': bool}, ...]}
+    """
+    return {
+        'status': 'success',
+        'missing_indexes': get_missing_indexes_db()
+    }
+
+
+@app.on_event('startup')
+def on_startup():
+    """
+    On server startup, restore every model that was registered before the last shutdown and is still responsive.
+    This allows prediction requests to be served right after a restart, without model microservices re-registering.
+    Any database indexes that are missing are created, and images stored in an older format are converted in the
+    background. Invalidations of cached users sent by other server processes are received from then on.
+    """
+
+    restore_registered_models()
+    ensure_indexes_db()
+    start_auth_cache_listener()
+    # The migration has its own thread, since the shared pool is held by the model health checks
+    threading.Thread(target=migrate_image_labels_db, name='migrate_image_labels', daemon=True).start()
+
+
 @app.on_event('shutdown')
 def on_shutdown():
     """
-    On server shutdown, stop all background model pinging threads, as well as clear
-    the redis model prediction queue. This is necessary to prevent the workers from
-    spawning multiple instances on restart.
+    On server shutdown, stop accepting new prediction requests and stop all background model pinging threads.
+    The redis model prediction queue is left in place, so that pending jobs are resumed by the workers once the
+    server is back up.
     """
 
-    dependency.shutdown = True  # Send shutdown signal to threads
+    dependency.shutdown = True  # Send shutdown signal to threads and stop accepting new jobs
     pool.shutdown()  # Clear any non-processed jobs from thread queue
-    dependency.prediction_queue.empty()  # Removes all pending jobs from the queue
+    stop_auth_cache_listener()
+    shutdown_password_pool()
+
+
+@app.on_event('shutdown')
+async def close_async_clients():
+    """
+    On server shutdown, close the connections of the HTTP client used by async route handlers.
+    """
+
+    await dependency.async_http_client.aclose()
 
@@ -0,0 +1,62 @@
+import io
+import uuid
+
+
+class MultipartFileStream:
+    """
+    File-like multipart/form-data request body with a single file field. The file is read in chunks while the request
+    is being sent, instead of the whole body being built in memory first, so that the memory used to send a file does
+    not depend on its size. The body has a known length, so requests sends it with a Content-Length header.
+
+    Usage: session.post(url, data=stream, headers={'Content-Type': stream.content_type})
+    """
+
+    def __init__(self, field_name: str, file_name: str, file):
+        """
+        :param field_name: Name of the form field the file is sent in
+        :param file_name: Name the file is sent under
+        :param file: File object opened in binary mode. It is read from its current position to its end
+        """
+        self.boundary = uuid.uuid4().hex
+        head = ('--' + self.boundary + '\r\n' +
+                'Content-Disposition: form-data; name="' + quote_header_value(field_name) + '"; ' +
+                'filename="' + quote_header_value(file_name) + '"\r\n\r\n').encode()
+        tail = ('\r\n--' + self.boundary + '--\r\n').encode()
+
+        position = file.tell()
+        file_size = file.seek(0, io.SEEK_END) - position
+        file.seek(position)
+
+        self.parts = [io.BytesIO(head), file, io.BytesIO(tail)]
+        self.length = len(head) + file_size + len(tail)
+
+    @property
+    def content_type(self) -> str:
+        return 'multipart/form-data; boundary=' + self.boundary
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        :param size: Maximum number of bytes to read. Reads the rest of the body if negative
+        :return: Next bytes of the body. b'' once the whole body has been read
+        """
+        chunks = []
+        while self.parts and size != 0:
+            chunk = self.parts[0].read(size)
+            if not chunk:  # Part is fully read, move on to the next
+                self.parts.pop(0)
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+
+def quote_header_value(value: str) -> str:
+    """
+    :param value: Value of a parameter of a multipart header, such as a file name
+    :return: Value with the characters that would end the parameter or header percent-encoded, as browsers do
+    """
+    return value.replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
@@ -0,0 +1,135 @@
+import asyncio
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple, Union
+
+from dependency import pwd_context, PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE_LIMIT
+
+# --------------------------------------------------------------------------------
+#                              Password Hashing Pool
+# --------------------------------------------------------------------------------
+#
+# bcrypt takes hundreds of milliseconds of CPU per password, and holds the GIL while
+# it does. Logins and account creations hash passwords on a dedicated process pool
+# instead, so that a burst of logins only waits on itself. The pool runs at most
+# PASSWORD_HASH_WORKERS hashes at once, and rejects new ones once
+# PASSWORD_HASH_QUEUE_LIMIT are waiting, rather than letting the queue grow
+# without bound.
+#
+# --------------------------------------------------------------------------------
+
+
+class PasswordPoolFull(Exception):
+    """
+    Exception raised when too many password hashes are already waiting for the pool. HTTP 503
+    """
+    pass
+
+
+_executor = None  # Created on first use, see get_executor
+_lock = threading.Lock()
+_stats = {
+    'submitted': 0,
+    'rejected': 0,
+    'completed': 0,
+    'pending': 0,  # Waiting for a worker or running
+    'max_pending': 0,
+    'queue_seconds': 0.0,  # Total time hashes waited for a worker
+    'run_seconds': 0.0  # Total time workers spent hashing
+}
+
+
+def _hash_password(password: str) -> Tuple[str, float]:
+    started = time.perf_counter()
+    return pwd_context.hash(password), time.perf_counter() - started
+
+
+def _verify_password(password: str, hashed_password: str) -> Tuple[Tuple[bool, Union[str, None]], float]:
+    started = time.perf_counter()
+    return pwd_context.verify_and_update(password, hashed_password), time.perf_counter() - started
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """
+    :return: Process pool that hashes passwords. Workers are spawned rather than forked, since the server process
+             holds database connections and background threads.
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(PASSWORD_HASH_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+async def _run(function, *args):
+    """
+    Runs a hashing function on the pool and waits for its result without blocking the event loop.
+
+    :raises PasswordPoolFull: If PASSWORD_HASH_QUEUE_LIMIT hashes are already waiting for a worker
+    """
+    with _lock:
+        if _stats['pending'] >= PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE_LIMIT:
+            _stats['rejected'] += 1
+            raise PasswordPoolFull()
+        _stats['submitted'] += 1
+        _stats['pending'] += 1
+        _stats['max_pending'] = max(_stats['max_pending'], _stats['pending'])
+
+    started = time.perf_counter()
+    run_seconds = 0.0
+    try:
+        result, run_seconds = await asyncio.wrap_future(get_executor().submit(function, *args))
+        return result
+    finally:
+        with _lock:
+            _stats['pending'] -= 1
+            _stats['completed'] += 1
+            _stats['run_seconds'] += run_seconds
+            _stats['queue_seconds'] += max(time.perf_counter() - started - run_seconds, 0)
+
+
+async def hash_password(password: str) -> str:
+    """
+    :param password: Plaintext password
+    :return: Hash of the password with the configured cost
+    :raises PasswordPoolFull: If too many hashes are already waiting for the pool
+    """
+    return await _run(_hash_password, password)
+
+
+async def verify_password(password: str, hashed_password: str) -> Tuple[bool, Union[str, None]]:
+    """
+    Checks a password against its hash. If the hash does not use the configured scheme and cost, a new hash of the
+    password is also returned, which should replace the stored one.
+
+    :param password: Plaintext password
+    :param hashed_password: Stored hash of the password
+    :return: Tuple of whether the password matches, and the new hash of the password or None if it is up to date
+    :raises PasswordPoolFull: If too many hashes are already waiting for the pool
+    """
+    return await _run(_verify_password, password, hashed_password)
+
+
+def get_password_pool_stats() -> dict:
+    """
+    :return: Number of hashes submitted, rejected, completed and pending, the most that were pending at once, and the
+             average seconds a hash waited for a worker and ran for
+    """
+    with _lock:
+        stats = dict(_stats)
+    stats['workers'] = PASSWORD_HASH_WORKERS
+    stats['queue_limit'] = PASSWORD_HASH_QUEUE_LIMIT
+    stats['average_queue_seconds'] = stats['queue_seconds'] / stats['completed'] if stats['completed'] else 0
+    stats['average_run_seconds'] = stats['run_seconds'] / stats['completed'] if stats['completed'] else 0
+    return stats
+
+
+def shutdown_password_pool():
+    """
+    Stops the workers of the pool, if it was started.
+    """
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
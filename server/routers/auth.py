@@ -2,12 +2,16 @@ import datetime
 import uuid
 
 from fastapi.security import OAuth2PasswordRequestForm
+from starlette.concurrency import run_in_threadpool
 from typing import Optional
 from jose import JWTError, jwt
 from starlette import status
 
+import passwords
+from auth_cache import get_cached_user, invalidate_user, invalidate_api_key, user_cache, api_key_cache, \
+    missing_api_key_cache, get_cached_token_claims, cache_token_claims, token_cache
 from db_connection import get_user_by_name_db, add_user_db, set_user_roles_db, add_api_key_db, get_api_keys_by_user_db, \
-    get_api_key_by_key_db, set_api_key_enabled_db
+    get_api_key_by_key_db, set_api_key_enabled_db, set_user_disabled_db, set_user_password_db
 
 from dependency import pwd_context, logger, oauth2_scheme, TokenData, User, CredentialException, Roles, \
     ExternalServices, APIKeyData
@@ -40,15 +44,37 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
-def authenticate_user(username: str, password: str):
-    user = get_user_by_name_db(username)
+def update_password_hash(username: str, hashed_password: str):
+    set_user_password_db(username, hashed_password)
+    invalidate_user(username)
+
+
+async def authenticate_user(username: str, password: str):
+    """
+    Checks the credentials of a user on the password hashing pool. If the stored hash of a valid password does not
+    use the configured cost, it is replaced with a new hash.
+
+    :raises passwords.PasswordPoolFull: If too many passwords are already waiting to be checked
+    """
+    user = await run_in_threadpool(get_user_by_name_db, username)
     if not user:
         return False
-    if not verify_password(password, user.password):
+    verified, new_hash = await passwords.verify_password(password, user.password)
+    if not verified:
         return False
+    if new_hash:
+        await run_in_threadpool(update_password_hash, username, new_hash)
     return user
 
 
+def password_pool_full_exception():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many password checks in progress. Try again shortly.",
+        headers={"Retry-After": "1"},
+    )
+
+
 def create_access_token(data: dict, expires_delta: Optional[datetime.timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -62,14 +88,17 @@ def create_access_token(data: dict, expires_delta: Optional[datetime.timedelta]
 
 def get_current_user(token: str = Depends(oauth2_scheme)):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = get_cached_token_claims(token)
+        if payload is None:  # Only verify the signature of tokens that were not seen recently
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            cache_token_claims(token, payload)
         username: str = payload.get("sub")
         if username is None:
             raise CredentialException()
         token_data = TokenData(username=username)
     except JWTError:
         raise CredentialException()
-    user = get_user_by_name_db(username=token_data.username)
+    user = get_cached_user(token_data.username)
     if user is None:
         raise CredentialException()
     return user
@@ -98,7 +127,7 @@ def current_user_investigator(token: str = Depends(oauth2_scheme)):
     :return: User object if user has correct role, else raise dependency.CredentialException
     """
     user = get_current_user(token)
-    if not any(role in [Roles.admin.name, Roles.investigator.name] for role in user.roles):
+    if user.disabled or not any(role in [Roles.admin.name, Roles.investigator.name] for role in user.roles):
         logger.debug('User Roles')
         logger.debug(user.roles)
 
@@ -117,7 +146,7 @@ def current_user_researcher(token: str = Depends(oauth2_scheme)):
     :return: User object if user has correct role, else raise dependency.CredentialException
     """
     user = get_current_user(token)
-    if not any(role in [Roles.admin.name, Roles.researcher.name] for role in user.roles):
+    if user.disabled or not any(role in [Roles.admin.name, Roles.researcher.name] for role in user.roles):
         raise CredentialException()
 
     return user
@@ -133,7 +162,7 @@ def current_user_admin(token: str = Depends(oauth2_scheme)):
     :return: User object if user has correct role, else raise dependency.CredentialException
     """
     user = get_current_user(token)
-    if Roles.admin.name not in user.roles:
+    if user.disabled or Roles.admin.name not in user.roles:
         raise CredentialException()
 
     return user
@@ -171,6 +200,7 @@ def add_permission_to_user(username, role):
     user_new_role_list = user.roles.copy()
     user_new_role_list.append(role)
     set_user_roles_db(username, user_new_role_list)
+    invalidate_user(username)
     return {'status': 'success',
             'detail': 'User ' + str(username) + ' added to role ' + str(role) + '.'}
 
@@ -201,12 +231,32 @@ def remove_permission_from_user(username: str, role: str):
     user_new_role_list = user.roles.copy()
     user_new_role_list.remove(role)
     set_user_roles_db(username, user_new_role_list)
+    invalidate_user(username)
     return {'status': 'success',
             'detail': 'User ' + str(username) + ' removed from role ' + str(role) + '.'}
 
 
+@auth_router.post('/disable', dependencies=[Depends(current_user_admin)])
+def set_user_disabled(username: str, disabled: bool = True):
+    """
+    Allows administrators to disable a user account, or to enable it again. Disabled users are rejected by every
+    endpoint that requires a login, including with bearer tokens issued before they were disabled.
+
+    :param username: Username of account to modify
+    :param disabled: Account will be disabled (True) or enabled (False)
+    :return: {'status': 'success'} if account modification successful, else {'status': 'failure'}
+    """
+
+    if not set_user_disabled_db(username, disabled):
+        return {'status': 'failure', 'detail': 'User does not exist. Unable to modify account.'}
+
+    invalidate_user(username)
+    return {'status': 'success',
+            'detail': 'User ' + str(username) + (' disabled.' if disabled else ' enabled.')}
+
+
 @auth_router.post("/login")
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
     """
     Logs current user in by validating their credentials and then issuing a new OAuth2 bearer token. This token
     is only valid for a fixed amount of time (ACCESS_TOKEN_EXPIRE_MINUTES) and after this has passed the user
@@ -215,7 +265,10 @@ def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
     :param form_data: HTTP FormData containing login credentials
     :return: {'status': 'success'} with OAuth2 bearer token if login successful, else HTTPException
     """
-    user = authenticate_user(form_data.username, form_data.password)
+    try:
+        user = await authenticate_user(form_data.username, form_data.password)
+    except passwords.PasswordPoolFull:
+        raise password_pool_full_exception()
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -234,7 +287,7 @@ def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
 
 
 @auth_router.post('/new')
-def create_account(username: str, password: str, email: str = None, full_name: str = None, agency: str = None):
+async def create_account(username: str, password: str, email: str = None, full_name: str = None, agency: str = None):
     """
     Creates a new user account with specified information. No permissions are granted upon account creation
     and an administrator must manually add permissions to an account before it is able to access most endpoints.
@@ -246,16 +299,21 @@ def create_account(username: str, password: str, email: str = None, full_name: s
     :param agency: (optional) Agency/Organization associated with the new user as a string
     :return: {'status': 'success'} if account creation successful, else {'status': 'failure'}
     """
+    try:
+        hashed_password = await passwords.hash_password(password)
+    except passwords.PasswordPoolFull:
+        raise password_pool_full_exception()
+
     u = User(
         username=username,
-        password=get_password_hash(password),
+        password=hashed_password,
         email=email,
         full_name=full_name,
         roles=[],
         agency=agency
     )
 
-    result = add_user_db(u)
+    result = await run_in_threadpool(add_user_db, u)
 
     if not result:
         return {'status': 'failure', 'detail': 'Account  with this username already exists'}
@@ -333,6 +391,7 @@ def add_api_key(key_owner_username: str, service: str, detail: str = ""):
     })
 
     result = add_api_key_db(api_key_object)
+    invalidate_api_key(api_key_string)  # In case the new key was looked up and cached as unknown
 
     # If successful, return success message and the API key object
     if result['status'] == 'success':
@@ -389,6 +448,7 @@ def disable_api_key(key: str, current_user: User = Depends(get_current_active_us
         raise CredentialException
 
     set_api_key_enabled_db(key, False)
+    invalidate_api_key(key.key)
     return {
         'status': 'success',
         'detail': 'API key has been removed.',
@@ -403,6 +463,25 @@ def disable_api_key(key: str, current_user: User = Depends(get_current_active_us
 # -------------------------------------------------------------------------------
 
 
+@auth_router.get('/stats', dependencies=[Depends(current_user_admin)])
+def get_auth_stats():
+    """
+    Reports the load on the password hashing pool and the effectiveness of the token, user and API key caches of
+    this server process.
+
+    :return: {'status': 'success', 'password_hashing': {...}, 'token_cache': {...}, 'user_cache': {...},
+             'api_key_cache': {...}, 'missing_api_key_cache': {...}}
+    """
+    return {
+        'status': 'success',
+        'password_hashing': passwords.get_password_pool_stats(),
+        'token_cache': token_cache.stats(),
+        'user_cache': user_cache.stats(),
+        'api_key_cache': api_key_cache.stats(),
+        'missing_api_key_cache': missing_api_key_cache.stats()
+    }
+
+
 @auth_router.post('/create_admin_account')
 def create_admin_account_testing():
 
@@ -1,32 +1,53 @@
 import hashlib
 import os
+import random
 import shutil
+import threading
 import time
-import string
-import random
+import uuid
+from concurrent.futures import wait, as_completed, TimeoutError as FutureTimeoutError
+from concurrent.futures.thread import ThreadPoolExecutor
 
 import imagehash as imagehash
 from PIL import Image
-from rq.registry import StartedJobRegistry
 from starlette import status
-from starlette.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, StreamingResponse, FileResponse
 
+import async_db_connection
 import dependency
 import requests
-from fastapi import File, UploadFile, HTTPException, Depends, APIRouter
+from fastapi import File, UploadFile, HTTPException, Depends, APIRouter, Body, Query, Header
+from rq import get_current_job
+from rq.exceptions import NoSuchJobError
 from rq.job import Job
 
-from routers.auth import current_user_investigator
-from dependency import logger, MicroserviceConnection, settings, prediction_queue, redis, User, pool, UniversalMLImage, \
-    APIKeyData
-from db_connection import add_image_db, add_user_to_image, get_images_from_user_db, get_image_by_md5_hash_db, \
-    get_api_key_by_key_db, add_filename_to_image, add_model_to_image_db, get_models_db, add_model_db
+from routers.auth import current_user_investigator, current_user_admin
+from dependency import logger, MicroserviceConnection, settings, redis, User, pool, UniversalMLImage
+from auth_cache import get_cached_api_key
+from db_connection import add_image_db, add_user_to_image, get_image_by_md5_hash_db, \
+    add_filename_to_image, add_model_to_image_db, add_model_db, \
+    set_model_socket_db, remove_model_socket_db, add_model_replica_db, remove_model_replica_db, get_model_replicas_db, \
+    set_model_capacity_db, get_model_capacity_db, get_model_capacities_db, iterate_images_from_user_db, \
+    get_search_terms
+from scheduler import check_admission, track_enqueued_job, track_finished_job, get_user_queue, \
+    get_lane_statistics, track_cancelled_job, track_submission_job, get_submission_job_ids, get_tracked_models, \
+    get_job_deadline, track_model_latency, get_model_latency, acquire_hedge, acquire_replica_slot, \
+    release_replica_slot, track_job_submitter, remove_job_submitter
+from derived_images import open_image_for_model, RAW_FORMAT
+from multipart_stream import MultipartFileStream
+from abandonable_session import AbandonableSession
+from search_cache import search_images_cached, search_cache
+from export import csv_rows, ndjson_rows, encode_chunks, export_search_results, get_export_path, \
+    remove_expired_exports, export_available
 from typing import (
     List
 )
 
 model_router = APIRouter()
 
+PENDING_JOB_STATUSES = ['queued', 'started', 'deferred', 'scheduled']  # rq statuses of jobs that have not finished
+
 
 @model_router.get("/list", dependencies=[Depends(current_user_investigator)])
 async def get_available_prediction_models():
@@ -42,25 +63,48 @@ async def get_all_prediction_models():
     """
     Returns a list of every model that has ever been seen by the server, as well as the fields available in that model
     """
-    all_models = get_models_db()
+    all_models = await async_db_connection.get_models_db()
     return {'models': all_models}
 
 
 @model_router.post("/predict")
 def create_new_prediction_on_image(images: List[UploadFile] = File(...),
                                    models: List[str] = (),
+                                   partial: bool = False,
+                                   priority: str = dependency.PredictionPriority.normal.name,
+                                   deadline: int = 0,
                                    current_user: User = Depends(current_user_investigator)):
     """
     Create a new prediction request for any number of images on any number of models. This will enqueue the jobs
     and a worker will process them and get the results. Once this is complete, a user may later query the job
     status by the unique key that is returned from this method for each image uploaded.
 
+    If enqueueing the jobs would go over the queue depth limit of a model or the outstanding job limit of the user,
+    then no jobs are enqueued, no images are stored, and HTTP 429 is returned with a Retry-After header. In partial
+    mode, images are instead accepted in order until a limit is reached, and the images that could not be queued are
+    reported and not stored.
+
     :param current_user: User object who is logged in
     :param images: List of file objects that will be used by the models for prediction
     :param models: List of models to run on images
-    :return: Unique keys for each image uploaded in images.
+    :param partial: Queue as many images as the limits allow instead of rejecting the whole request
+    :param priority: dependency.PredictionPriority lane to queue the jobs in, as a string
+    :param deadline: Seconds the jobs may wait before they expire and are skipped. Uses the model default if 0
+    :return: Unique keys for each image uploaded in images, and the ID of the submission. The submission ID may be
+             used to cancel every job of this request.
     """
 
+    # Do not accept new work if server is in process of shutting down. Jobs that are already queued are kept, and
+    # will be processed by the workers once the server is back up.
+    if dependency.shutdown:
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={
+                'status': 'failure',
+                'detail': 'Server is shutting down. Unable to accept new prediction requests.'
+            }
+        )
+
     # Start with error checking on the models list.
     # Ensure that all desired models are valid.
     if not models:
@@ -75,11 +119,17 @@ def create_new_prediction_on_image(images: List[UploadFile] = File(...),
         error_message = "Invalid Models Specified: " + ''.join(invalid_models)
         return HTTPException(status_code=400, detail=error_message)
 
-    # Now we must hash each uploaded image
-    # After hashing, we will store the image file on the server.
+    if priority not in dependency.PredictionPriority.__members__:
+        raise HTTPException(status_code=400, detail="Invalid Priority Specified: " + priority)
+
+    # Now we must hash each uploaded image. Nothing is stored until the request has passed admission control, so that
+    # a rejected request leaves no files or database records behind.
 
     buffer_size = 65536  # Read image data in 64KB Chunks for hashlib
     hashes_md5 = {}
+    uploads = []  # Every uploaded file with its md5 and sha1 hashes
+    image_jobs = {}  # Models that still need to be run on each image, by md5 hash
+    waiting_jobs = {}  # Models that are already queued for each image by another submission, by md5 hash
 
     # Process uploaded images
     for upload_file in images:
@@ -95,48 +145,221 @@ def create_new_prediction_on_image(images: List[UploadFile] = File(...),
 
         # Process image
         hash_md5 = md5.hexdigest()
-        hash_sha1 = sha1.hexdigest()
         hashes_md5[upload_file.filename] = hash_md5
+        uploads.append((upload_file, hash_md5, sha1.hexdigest()))
+        if hash_md5 in image_jobs:  # Same image uploaded twice in this request
+            continue
 
-        if get_image_by_md5_hash_db(hash_md5):
-            image_object = get_image_by_md5_hash_db(hash_md5)
-        else:  # If image does not already exist in db
-
-            # Generate perceptual hash
-            hash_perceptual = str(imagehash.phash(Image.open('/app/images/' + file_name)))
-
-            # Create a UniversalMLImage object to store data
-            image_object = UniversalMLImage(**{
-                'file_names': [upload_file.filename],
-                'hash_md5': hash_md5,
-                'hash_sha1': hash_sha1,
-                'hash_perceptual': hash_perceptual,
-                'users': [current_user.username],
-                'models': {}
-            })
+        # Skip models that already have a result for this image. Models that are already queued for it are not
+        # queued again, and the submission waits for the job that is already queued instead.
+        image_object = get_image_by_md5_hash_db(hash_md5)
+        image_jobs[hash_md5] = []
+        waiting_jobs[hash_md5] = []
+        for model in models:
+            if image_object and model in image_object.models:
+                continue
+            if prediction_is_pending(hash_md5, model):
+                waiting_jobs[hash_md5].append(model)
+            else:
+                image_jobs[hash_md5].append(model)
+
+    # Admission control. Unless the client asked for a partial accept, the request is either fully queued or rejected.
+    if not partial:
+        retry_after = check_admission(current_user.username, [m for h in image_jobs for m in image_jobs[h]])
+        if retry_after:
+            return JSONResponse(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                content={
+                    'status': 'failure',
+                    'detail': 'Prediction queue limit reached. No images were queued.',
+                    'retry_after': retry_after
+                },
+                headers={'Retry-After': str(retry_after)}
+            )
+
+    submission_id = str(uuid.uuid4())
+    rejected_hashes = []
+    retry_after = 0
+    for hash_md5 in image_jobs:
+        if partial:
+            image_retry_after = check_admission(current_user.username, image_jobs[hash_md5])
+            if image_retry_after:
+                rejected_hashes.append(hash_md5)
+                retry_after = max(retry_after, image_retry_after)
+                continue
+
+        # Store the image under every name it was uploaded as
+        for upload_file, upload_md5, upload_sha1 in uploads:
+            if upload_md5 == hash_md5:
+                store_uploaded_image(upload_file, upload_md5, upload_sha1, current_user)
+
+        for model in image_jobs[hash_md5]:
+            enqueue_prediction(hash_md5, model, current_user, priority, submission_id, deadline)
+        for model in waiting_jobs[hash_md5]:
+            track_job_submitter(prediction_job_id(hash_md5, model), current_user.username)
+            track_submission_job(submission_id, prediction_job_id(hash_md5, model))
+
+    if not partial:
+        return {"images": [hashes_md5[key] for key in hashes_md5], "submission_id": submission_id}
 
-            # Add created image object to database
-            add_image_db(image_object)
+    return {
+        "images": [hashes_md5[key] for key in hashes_md5 if hashes_md5[key] not in rejected_hashes],
+        "submission_id": submission_id,
+        "rejected": rejected_hashes,
+        "retry_after": retry_after
+    }
 
-        # Associate the current user with the image that was uploaded
-        add_user_to_image(image_object, current_user.username)
 
-        # Associate the name the file was uploaded under to the object
-        add_filename_to_image(image_object, upload_file.filename)
+def store_uploaded_image(upload_file: UploadFile, hash_md5: str, hash_sha1: str, user: User):
+    """
+    Stores an uploaded image in the image store, so that queued jobs only need to reference it by hash, and adds it
+    to the database. If the image is already in the database, the user and the file name are added to it instead.
 
-        for model in models:
-            random_tail = ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
+    :param upload_file: Uploaded image
+    :param hash_md5: md5 hash of the image
+    :param hash_sha1: sha1 hash of the image
+    :param user: User who uploaded the image
+    """
+    upload_file.file.seek(0)
+    store_image_file(upload_file.file, hash_md5)
+
+    image_object = get_image_by_md5_hash_db(hash_md5)
+    if not image_object:  # If image does not already exist in db
+
+        # Generate perceptual hash
+        hash_perceptual = str(imagehash.phash(Image.open(dependency.IMAGE_STORE_PATH + hash_md5)))
+
+        # Create a UniversalMLImage object to store data
+        image_object = UniversalMLImage(**{
+            'file_names': [upload_file.filename],
+            'hash_md5': hash_md5,
+            'hash_sha1': hash_sha1,
+            'hash_perceptual': hash_perceptual,
+            'users': [user.username],
+            'models': {},
+            'search_terms': get_search_terms(upload_file.filename)
+        })
 
-            job_id = hash_md5 + '---' + model + '---' + random_tail
+        # Add created image object to database. It already holds the user and file name, unless another request
+        # added the image first.
+        if add_image_db(image_object):
+            return
 
-            model_socket = settings.available_models[model]
-            logger.debug('Adding Job For For Image ' + hash_md5 + ' With Model ' + model + ' With ID ' + job_id)
-            # Submit a job to use scene detection model
-            prediction_queue.enqueue(get_model_prediction, model_socket, hash_md5,
-                                     model, upload_file,
-                                     job_id=job_id)
+    # Associate the current user with the image that was uploaded
+    add_user_to_image(image_object, user.username)
 
-    return {"images": [hashes_md5[key] for key in hashes_md5]}
+    # Associate the name the file was uploaded under to the object
+    add_filename_to_image(image_object, upload_file.filename)
+
+
+def prediction_job_id(image_hash: str, model_name: str) -> str:
+    """
+    Job IDs are unique to an image and model, so the same prediction is never queued twice.
+
+    :param image_hash: md5 hash of image
+    :param model_name: Name of model
+    :return: ID of the prediction job for the image and model
+    """
+    return image_hash + '---' + model_name
+
+
+def prediction_is_pending(image_hash: str, model_name: str) -> bool:
+    """
+    :param image_hash: md5 hash of image
+    :param model_name: Name of model
+    :return: True if a prediction job for the image and model is queued or running, else False
+    """
+    try:
+        existing_job = Job.fetch(prediction_job_id(image_hash, model_name), connection=redis)
+    except NoSuchJobError:
+        return False
+    return existing_job.get_status() in PENDING_JOB_STATUSES
+
+
+def enqueue_prediction(image_hash: str, model_name: str, user: User, priority: str, submission_id: str,
+                       deadline: int = 0):
+    """
+    Enqueues a prediction job for an image on a model, and tracks it towards the admission control limits. The job
+    is added to the fair-share queue of the user who submitted it, within the requested priority lane.
+
+    :param image_hash: md5 hash of image
+    :param model_name: Name of model to run on the image
+    :param user: User who submitted the image
+    :param priority: dependency.PredictionPriority lane to queue the job in, as a string
+    :param submission_id: ID of the prediction request the job is part of
+    :param deadline: Seconds the job may wait before it expires. Uses the model default if 0
+    """
+    job_id = prediction_job_id(image_hash, model_name)
+    replicas = settings.model_replicas.get(model_name) or [settings.available_models[model_name]]
+    model_socket = random.choice(replicas)  # Spread jobs over every replica of the model
+    logger.debug('Adding Job For For Image ' + image_hash + ' With Model ' + model_name + ' With ID ' + job_id)
+
+    track_enqueued_job(job_id, user.username, model_name)
+    track_job_submitter(job_id, user.username, new_job=True)
+    track_submission_job(submission_id, job_id)
+    get_user_queue(user, priority).enqueue(get_model_prediction, model_socket, image_hash, model_name,
+                                           job_id=job_id, job_timeout=dependency.PREDICTION_JOB_TIMEOUT,
+                                           meta={'username': user.username, 'priority': priority,
+                                                 'submitted': time.time(),
+                                                 'deadline': get_job_deadline(model_name, deadline),
+                                                 'replicas': [r for r in replicas if r != model_socket]})
+
+
+@model_router.delete("/jobs")
+def cancel_prediction_jobs(md5_hashes: List[str] = Body([]),
+                           submission_id: str = '',
+                           current_user: User = Depends(current_user_investigator)):
+    """
+    Cancels every pending prediction job for a list of images, or for a submission returned by /model/predict.
+    Users may only cancel jobs that they have submitted, unless they are an administrator. A job that other users
+    have also submitted the image for is kept for them, and is only withdrawn for the current user. Jobs that are
+    already running are not interrupted.
+
+    :param md5_hashes: List of image md5 hashes to cancel all pending jobs for
+    :param submission_id: ID of a submission to cancel all pending jobs for
+    :param current_user: User object who is logged in
+    :return: {'status': 'success'} with the IDs of the jobs that were cancelled, and of the jobs that were withdrawn
+             but kept for other users, else {'status': 'failure'}
+    """
+    if not md5_hashes and not submission_id:
+        return {
+            'status': 'failure',
+            'detail': 'You must specify image hashes or a submission ID to cancel jobs for.'
+        }
+
+    job_ids = get_submission_job_ids(submission_id) if submission_id else []
+    tracked_models = get_tracked_models()
+    job_ids += [prediction_job_id(md5_hash, model_name) for md5_hash in md5_hashes for model_name in tracked_models]
+
+    cancelled_jobs = []
+    withdrawn_jobs = []
+    for job_id in set(job_ids):
+        try:
+            job = Job.fetch(job_id, connection=redis)
+        except NoSuchJobError:
+            continue
+
+        if job.get_status() not in ['queued', 'deferred', 'scheduled']:
+            continue
+
+        if dependency.Roles.admin.name not in current_user.roles:
+            remaining_submitters = remove_job_submitter(job_id, current_user.username)
+            if remaining_submitters is None:  # Not submitted by the user
+                continue
+            if remaining_submitters:  # Still needed by other users
+                withdrawn_jobs.append(job.id)
+                continue
+
+        job.cancel()
+        track_cancelled_job(job.id, job.meta.get('username'), job_id.split('---')[1])
+        cancelled_jobs.append(job.id)
+
+    return {
+        'status': 'success',
+        'detail': 'Cancelled ' + str(len(cancelled_jobs)) + ' pending prediction jobs.',
+        'jobs': cancelled_jobs,
+        'withdrawn': withdrawn_jobs
+    }
 
 
 @model_router.post("/results", dependencies=[Depends(current_user_investigator)])
@@ -152,27 +375,21 @@ async def get_jobs(md5_hashes: List[str]):
     if not md5_hashes:
         return []
 
+    # If there are any pending predictions, alert user and return existing ones. The job queues are read from redis
+    # in a thread pool, so that the event loop is not blocked.
+    pending_hashes = await run_in_threadpool(get_pending_image_hashes, md5_hashes)
+
     for md5_hash in md5_hashes:
 
-        # If there are any pending predictions, alert user and return existing ones
-        # Since job_id is a composite hash+model, we must loop and find all jobs that have the
-        # hash we want to find. We must get all running and pending jobs to return the correct value
-        all_jobs = StartedJobRegistry('model_prediction', connection=redis).get_job_ids() + prediction_queue.job_ids
-
-        image = get_image_by_md5_hash_db(md5_hash)  # Get image object
-        found_pending_job = False
-        for job_id in all_jobs:
-            if md5_hash in job_id and Job.fetch(job_id, connection=redis).get_status() != 'finished':
-                found_pending_job = True
-                results.append({
-                    'status': 'success',
-                    'detail': 'Image has pending predictions. Check back later for all model results.',
-                    **image.dict()
-                })
-                break  # Don't look for more jobs since we have found one that is pending
+        image = await async_db_connection.get_image_by_md5_hash_db(md5_hash)  # Get image object
 
         # If we have found a job that is pending, then move on to next image
-        if found_pending_job:
+        if md5_hash in pending_hashes:
+            results.append({
+                'status': 'success',
+                'detail': 'Image has pending predictions. Check back later for all model results.',
+                **image.dict()
+            })
             continue
 
         # If we haven't found a pending job for this image, and it doesn't exist in our database, then that
@@ -193,58 +410,124 @@ async def get_jobs(md5_hashes: List[str]):
     return results
 
 
+def get_pending_image_hashes(md5_hashes: List[str]) -> set:
+    """
+    Finds the images that have predictions which are queued or running. Prediction jobs have deterministic IDs, so
+    the job of every image and tracked model pair is fetched directly, in one round trip, instead of scanning the
+    queues.
+
+    :param md5_hashes: List of image md5 hashes
+    :return: Set of the hashes that have pending predictions
+    """
+    tracked_models = get_tracked_models()  # Includes models that are no longer registered but still have jobs
+    pairs = [(md5_hash, model_name) for md5_hash in md5_hashes for model_name in tracked_models]
+    jobs = Job.fetch_many([prediction_job_id(md5_hash, model_name) for md5_hash, model_name in pairs],
+                          connection=redis)
+
+    pending_hashes = set()
+    for (md5_hash, _), job in zip(pairs, jobs):
+        if job is not None and job.get_status(refresh=False) in PENDING_JOB_STATUSES:
+            pending_hashes.add(md5_hash)
+    return pending_hashes
+
+
+@model_router.get("/lanes", dependencies=[Depends(current_user_investigator)])
+def get_prediction_lane_statistics():
+    """
+    Returns the number of queued jobs and the latency percentiles of each prediction priority lane. Latency is
+    measured from job submission to completion, in seconds.
+
+    :return: {'status': 'success', 'lanes': {laneName: {'queued', 'samples', 'p50', 'p90', 'p99'}, ...}}
+    """
+    return {
+        'status': 'success',
+        'scheduling': dependency.LANE_SCHEDULING,
+        'lanes': get_lane_statistics()
+    }
+
+
 @model_router.post("/search")
 def search_images(
         current_user: User = Depends(current_user_investigator),
         page_id: int = -1,
         search_string: str = '',
         search_filter: dependency.SearchFilter = None,
+        min_score: float = 0,
+        page_size: int = dependency.PAGINATION_PAGE_SIZE,
+        cursor: str = None,
+        estimate: bool = False
 ):
     """
     Returns a list of image hashes of images submitted by a user. Pagination of image hashes as
     well as searching is provided by this method.
 
+    Pages may be requested by number with page_id, or with a cursor. Cursor pages stay fast no matter how deep they
+    are, and are not shifted by images added while paging. To page with a cursor, pass an empty cursor for the first
+    page, and then the next_cursor of each page until it is null.
+
     :param current_user: User currently logged in
     :param page_id: Optional int for individual page of results (From 1...N)
     :param search_filter Optional filter to narrow results by models
-    :param search_string Optional string to narrow results by metadata field
+    :param search_string Optional string to narrow results by file name, model or class
+    :param min_score Optional score that the classes in search_filter must be over
+    :param page_size Optional number of image hashes per page, up to dependency.MAX_PAGINATION_PAGE_SIZE
+    :param cursor Optional next_cursor of the previous page, or an empty string for the first page
+    :param estimate Optional flag to stop counting results at dependency.SEARCH_COUNT_LIMIT, for searches that are
+                    not cached. num_images_estimated is then true if num_images is only a lower bound
     :return: List of hashes user has submitted (by page) and number of total pages. If no page is provided,
              then only the number of pages available is returned.
     """
 
+    if not 0 < page_size <= dependency.MAX_PAGINATION_PAGE_SIZE:
+        return {
+            'status': 'failure',
+            'detail': 'Page size must be between 1 and ' + str(dependency.MAX_PAGINATION_PAGE_SIZE) + '.'
+        }
+
     # Parse the search filter from the request body
     if not search_filter:
         search_filter = {}
     else:
         search_filter = search_filter.search_filter
 
-    db_result = get_images_from_user_db(current_user.username, page_id, search_filter, search_string)
+    try:
+        db_result = search_images_cached(current_user, page_id, search_filter, search_string,
+                                         min_score=min_score, page_size=page_size, cursor=cursor,
+                                         estimate=estimate)
+    except ValueError:
+        return {
+            'status': 'failure',
+            'detail': 'Invalid cursor.'
+        }
+
     num_pages = db_result['num_pages']
     hashes = db_result['hashes'] if 'hashes' in db_result else []
-    num_images = db_result['num_images']
-    page_size = dependency.PAGINATION_PAGE_SIZE
+    counts = {'num_pages': num_pages, 'page_size': page_size, 'num_images': db_result['num_images']}
+    if estimate:
+        counts['num_images_estimated'] = db_result['num_images_estimated']
 
-    if page_id <= 0:
+    if cursor is not None:
         return {
             'status': 'success',
-            'num_pages': num_pages,
-            'page_size': page_size,
-            'num_images': num_images
+            **counts,
+            'hashes': hashes,
+            'next_cursor': db_result['next_cursor']
         }
-    elif page_id > num_pages:
+    elif page_id <= 0:
+        return {
+            'status': 'success',
+            **counts
+        }
+    elif page_id > num_pages and not db_result.get('num_images_estimated'):
         return {
             'status': 'failure',
             'detail': 'Page does not exist.',
-            'num_pages': num_pages,
-            'page_size': page_size,
-            'num_images': num_images,
+            **counts,
             'current_page': page_id}
 
     return {
         'status': 'success',
-        'num_pages': num_pages,
-        'page_size': page_size,
-        'num_images': num_images,
+        **counts,
         'current_page': page_id,
         'hashes': hashes
     }
@@ -254,15 +537,27 @@ def search_images(
 def download_search_image_hashes(
         current_user: User = Depends(current_user_investigator),
         search_string: str = '',
-        search_filter: dependency.SearchFilter = None
+        search_filter: dependency.SearchFilter = None,
+        min_score: float = 0,
+        format: str = dependency.ExportFormat.json.name,
+        fields: List[str] = Query([]),
+        accept_encoding: str = Header('')
 ):
     """
     Returns a list of all image hashes that match a search criteria. This is used for downloading on the client-side
     bulk image information.
 
+    In the ndjson and csv formats, the images are streamed from the database one batch at a time, so that searches
+    of any size can be downloaded. Each line then also holds the requested model result fields of the image. The
+    stream is compressed with gzip if the client accepts it.
+
     :param current_user: Currently logged in user
-    :param search_string: String to search metadata field of UniversalMLImage object
+    :param search_string: String to search file names, models and classes of UniversalMLImage objects
     :param search_filter: Model JSON search for matching fields
+    :param min_score: Score that the classes in search_filter must be over
+    :param format: dependency.ExportFormat to download the results in, as a string
+    :param fields: Model results to include in ndjson and csv downloads, as "modelName" or "modelName.className"
+    :param accept_encoding: Accept-Encoding header of the request
     :return: List of image hashes associated with user
     """
     if search_string == '' and not search_filter:
@@ -271,16 +566,36 @@ def download_search_image_hashes(
             'detail': 'You must specify a search string or search filter'
         }
 
+    if format not in dependency.ExportFormat.__members__:
+        return {
+            'status': 'failure',
+            'detail': 'Invalid Format Specified: ' + format
+        }
+
     if not search_filter:
         filter_to_use = {}
     else:
         filter_to_use = search_filter.search_filter
 
-    db_result = get_images_from_user_db(
-        current_user.username,
+    if format != dependency.ExportFormat.json.name:
+        images = iterate_images_from_user_db(current_user.username, filter_to_use, search_string, min_score, fields)
+        if format == dependency.ExportFormat.csv.name:
+            rows, media_type = csv_rows(images, fields), 'text/csv'
+        else:
+            rows, media_type = ndjson_rows(images), 'application/x-ndjson'
+
+        compress = 'gzip' in accept_encoding.lower()
+        headers = {'Content-Disposition': 'attachment; filename="search.' + format + '"'}
+        if compress:
+            headers['Content-Encoding'] = 'gzip'
+        return StreamingResponse(encode_chunks(rows, compress), media_type=media_type, headers=headers)
+
+    db_result = search_images_cached(
+        current_user,
         search_filter=filter_to_use,
         search_string=search_string,
-        paginate=False
+        paginate=False,
+        min_score=min_score
     )
     hashes = db_result['hashes']
 
@@ -290,6 +605,98 @@ def download_search_image_hashes(
     }
 
 
+@model_router.post('/export')
+def create_bulk_export(
+        current_user: User = Depends(current_user_admin),
+        format: str = dependency.BulkExportFormat.parquet.name,
+        search_string: str = '',
+        search_filter: dependency.SearchFilter = None,
+        min_score: float = 0,
+        models: List[str] = Query([])
+):
+    """
+    Starts a background job that exports the prediction results of every image matching a search to a Parquet or
+    Arrow IPC file, with one row per image and one column per model class. The status of the export is found with
+    the returned export ID, and the file may be downloaded once the export has finished.
+
+    :param current_user: Currently logged in administrator
+    :param format: dependency.BulkExportFormat to export to, as a string
+    :param search_string: Optional string to narrow the images by file name, model or class
+    :param search_filter: Optional filter to narrow the images by models
+    :param min_score: Optional score that the classes in search_filter must be over
+    :param models: Models whose results are exported. Every model with known classes if empty
+    :return: {'status': 'success', 'export_id': ...} if the export was started, else {'status': 'failure'}
+    """
+    if not export_available():
+        return {
+            'status': 'failure',
+            'detail': 'Bulk exports require the pyarrow package to be installed.'
+        }
+
+    if format not in dependency.BulkExportFormat.__members__:
+        return {
+            'status': 'failure',
+            'detail': 'Invalid Format Specified: ' + format
+        }
+
+    remove_expired_exports()
+    job = dependency.export_queue.enqueue(export_search_results, current_user.username, format,
+                                          search_filter.search_filter if search_filter else {}, search_string,
+                                          min_score, models, job_timeout=dependency.EXPORT_JOB_TIMEOUT,
+                                          result_ttl=dependency.EXPORT_TTL,
+                                          meta={'username': current_user.username, 'format': format, 'rows': 0})
+    return {
+        'status': 'success',
+        'export_id': job.id
+    }
+
+
+@model_router.get('/export/{export_id}', dependencies=[Depends(current_user_admin)])
+def get_bulk_export(export_id: str, download: bool = False):
+    """
+    Returns the status of a bulk export, and the number of images it has written so far. Once the export has
+    finished, the file is returned instead if download is true.
+
+    :param export_id: ID of the export returned by /model/export
+    :param download: Download the file of a finished export
+    :return: Status of the export, or the export file
+    """
+    try:
+        job = Job.fetch(export_id, connection=redis)
+    except NoSuchJobError:
+        return {
+            'status': 'failure',
+            'detail': 'Unknown or expired export.',
+            'export_id': export_id
+        }
+
+    export_status = job.get_status()
+    export_path = get_export_path(export_id, job.meta.get('format', ''))
+    if download and export_status == 'finished' and os.path.exists(export_path):
+        return FileResponse(export_path, media_type='application/octet-stream',
+                            filename='export-' + export_id + '.' + job.meta['format'])
+
+    return {
+        'status': 'success',
+        'export_id': export_id,
+        'export_status': export_status,
+        'rows': job.meta.get('rows', 0)
+    }
+
+
+@model_router.get('/search/cache', dependencies=[Depends(current_user_admin)])
+def get_search_cache_statistics():
+    """
+    Returns the size and hit rate of the search result cache of this server process.
+
+    :return: Statistics of the search result cache
+    """
+    return {
+        'status': 'success',
+        'cache': search_cache.stats()
+    }
+
+
 def get_api_key(api_key_header: str = Depends(dependency.api_key_header_auth)):
     """
     Validates an API key contained in the header. This also ensures that the API key is authorized to
@@ -299,7 +706,7 @@ def get_api_key(api_key_header: str = Depends(dependency.api_key_header_auth)):
     :return: APIKeyData object on success, else will raise HTTP CredentialException
     """
 
-    api_key_data = get_api_key_by_key_db(api_key_header)
+    api_key_data = get_cached_api_key(api_key_header)
     if not api_key_data or not api_key_data.enabled or api_key_data.type != dependency.ExternalServices.predict_microservice.name:
         raise dependency.CredentialException
     return api_key_data
@@ -326,8 +733,22 @@ def register_model(model: MicroserviceConnection):
             }
         )
 
-    # Do not add duplicates of running models to server
-    if model.name in settings.available_models:
+    # Ensure that the advertised limits are usable
+    if model.max_batch_size < 1 or model.max_concurrency < 0 or \
+            (model.input_resolution is not None and
+             (len(model.input_resolution) != 2 or min(model.input_resolution) < 1)) or \
+            (RAW_FORMAT in model.accepted_formats and model.input_resolution is None):
+        return {
+            "status": "failure",
+            'model': model.name,
+            'detail': 'Invalid model limits. maxBatchSize must be at least 1, maxConcurrency must not be negative, '
+                      'and inputResolution must be a positive [width, height] that is given if raw images are '
+                      'accepted.'
+        }
+
+    # Do not add duplicates of running models to server. A model that registers again may change its limits.
+    if model.socket in settings.model_replicas.get(model.name, []):
+        set_model_capacity(model)
         return {
             "status": "success",
             'model': model.name,
@@ -345,8 +766,25 @@ def register_model(model: MicroserviceConnection):
             'detail': 'Unable to establish successful connection to model.'
         }
 
+    # A model that is already running under a different socket is registered as another replica of the model
+    if model.name in settings.available_models:
+        settings.model_replicas.setdefault(model.name, []).append(model.socket)
+        set_model_capacity(model)
+        add_model_replica_db(model.name, model.socket)  # Checked by the health check task of the model
+
+        logger.debug("Model " + model.name + " replica at " + model.socket + " successfully registered to server.")
+
+        return {
+            "status": "success",
+            'model': model.name,
+            'detail': 'Model replica has been successfully registered to server.'
+        }
+
     # Register model to server and create thread to ensure model is responsive
     settings.available_models[model.name] = model.socket
+    settings.model_replicas[model.name] = [model.socket]
+    set_model_socket_db(model.name, model.socket)
+    set_model_capacity(model)
     pool.submit(ping_model, model.name)
 
     logger.debug("Model " + model.name + " successfully registered to server.")
@@ -358,27 +796,112 @@ def register_model(model: MicroserviceConnection):
     }
 
 
-def get_model_prediction(socket: str, image_hash: str, model_name: str, image_file: UploadFile = File(...)):
+def set_model_capacity(model: MicroserviceConnection):
+    """
+    Saves the limits advertised by a model microservice, so that they are followed by the workers for every job of
+    the model that has not started yet.
+
+    :param model: MicroserviceConnection object of the registering model
+    """
+    settings.model_capacities[model.name] = model.capacity()
+    set_model_capacity_db(model.name, model.capacity())
+
+
+def store_image_file(file, image_hash: str):
+    """
+    Saves an uploaded image to the image store, named by its md5 hash. Images are only written once, and are moved
+    into place after being fully written so that a worker never reads a partial file.
+
+    :param file: File object of the uploaded image
+    :param image_hash: md5 hash of the image file
+    """
+    image_path = dependency.IMAGE_STORE_PATH + image_hash
+    if os.path.exists(image_path):
+        return
+
+    os.makedirs(dependency.IMAGE_STORE_PATH, exist_ok=True)
+    temporary_path = image_path + '.' + str(os.getpid()) + '.tmp'
+    image_file = open(temporary_path, 'wb+')
+    shutil.copyfileobj(file, image_file)
+    image_file.close()
+    os.replace(temporary_path, image_path)
+
+
+def get_model_prediction(socket: str, image_hash: str, model_name: str):
     """
     Helper method that a worker will use to generate a prediction for a given model. This will be run in a task
-    by any redis queue worker that is registered.
+    by any redis queue worker that is registered. The image is read from the image store by its hash, so jobs may
+    be resumed after a restart. If the image already has a result for the model, then the model is not called again
+    and no result is written.
 
-    :param host: Model server host. If running locally then "localhost" or "host.docker.internal"
     :param socket: Socket the model is running on
-    :param filename: Name of the image file that a prediction is being generated on
     :param image_hash: md5 hash of the image file that is having a prediction done
     :param model_name: Name of the model that is being used.
     :return: Model prediction results
     """
-    # Receive Prediction from Model
+    job = get_current_job()
+    meta = job.meta if job else {}
+
+    # Skip jobs that expired while they were waiting in the queue
+    deadline = meta.get('deadline')
+    if deadline and time.time() >= deadline:
+        print('Skipping expired job for image ' + image_hash + ' on model ' + model_name)
+        track_cancelled_job(job.id, meta.get('username'), model_name)
+        return
+
+    # Only interactive jobs are hedged to another replica, since they are the ones a user is waiting on
+    hedge_sockets = []
+    if meta.get('priority') == dependency.PredictionPriority.interactive.name and dependency.HEDGE_BUDGET > 0:
+        hedge_sockets = meta.get('replicas', [])
 
-    args = {'file': image_file}
     try:
-        request = requests.post(socket + '/predict', files=args)
-        request.raise_for_status()  # Ensure model connection is successful
-        if request.json()['status'] == 'success':
-            model_result = request.json()['result']['result']
-            model_classes = request.json()['result']['classes']
+        timeout = deadline - time.time() if deadline else dependency.PREDICTION_JOB_TIMEOUT
+        return request_model_prediction(socket, image_hash, model_name, timeout, hedge_sockets)
+    finally:
+        if job:
+            track_finished_job(job.id, meta.get('username'), model_name, meta.get('priority'), meta.get('submitted'))
+
+
+def request_model_prediction(socket: str, image_hash: str, model_name: str, timeout: float,
+                             hedge_sockets: List[str] = ()):
+    """
+    Sends an image from the image store to a model microservice, and saves the prediction result to the database.
+    This is a helper method for get_model_prediction that is not directly exposed via HTTP.
+
+    :param socket: Socket the model is running on
+    :param image_hash: md5 hash of the image file that is having a prediction done
+    :param model_name: Name of the model that is being used.
+    :param timeout: Seconds to wait for the model to respond
+    :param hedge_sockets: Sockets of other replicas of the model that the request may be hedged to
+    :return: Model prediction results
+    """
+    image_object = get_image_by_md5_hash_db(image_hash)
+    if not image_object:
+        print('Unknown image ' + image_hash + ' for prediction on model ' + model_name)
+        return
+
+    if model_name in image_object.models:  # Job was already completed before an interruption
+        return image_object.models[model_name]
+
+    if not os.path.exists(dependency.IMAGE_STORE_PATH + image_hash):
+        print('Unable to open stored image ' + image_hash + ' for prediction on model ' + model_name)
+        return
+
+    # Receive Prediction from Model
+    file_name = image_object.file_names[0] if image_object.file_names else image_hash
+    capacity = get_model_capacity_db(model_name)  # Read for every job, so that new limits apply to queued jobs
+    try:
+        started = time.time()
+        if hedge_sockets:
+            response = post_image_hedged(model_name, socket, hedge_sockets[0], image_hash, file_name, timeout,
+                                         capacity)
+        else:
+            response = post_image_to_model(socket, image_hash, file_name, timeout, capacity)
+        track_model_latency(model_name, time.time() - started)
+
+        if response['status'] == 'success':
+            model_result = response['result']['result']
+            model_classes = response['result']['classes']
             print("\n\n\n", model_result, "\n\n\n")
         else:
             print('Failure on predicting image ' + image_hash + ' on model ' + model_name)
@@ -388,43 +911,200 @@ def get_model_prediction(socket: str, image_hash: str, model_name: str, image_fi
         return
 
     # Store result of model prediction into database
-    if dependency.image_collection.find_one({"hash_md5": image_hash}):
-        image_object = get_image_by_md5_hash_db(image_hash)
-        add_model_to_image_db(image_object, model_name, model_result)
-        add_model_db(model_name, model_classes)
-    try:
-        os.remove('/app/images/'+filename)
-    except OSError:
-        pass
+    add_model_to_image_db(image_object, model_name, model_result)
+    add_model_db(model_name, model_classes)
     return model_result
 
 
-def ping_model(model_name):
+def post_image_to_model(socket: str, image_hash: str, file_name: str, timeout: float, capacity: dict = None,
+                        session=requests, abandoned: threading.Event = None) -> dict:
     """
-    Periodically ping a model's service to make sure that it is active. If it's not, remove the model from the
-    available_models BaseSetting in dependency.py
+    Sends an image from the image store to the /predict endpoint of a model microservice. The image is converted to
+    the input resolution and formats the model advertised, and the request waits for a free slot if the replica is
+    already handling as many requests as it advertised.
 
-    :param model_name: Name of model to ping. This is the name the model registered to the server with.
+    :param socket: Socket the model is running on
+    :param image_hash: md5 hash of the image file to send
+    :param file_name: Name the image file is sent under
+    :param timeout: Seconds to wait for the model to respond
+    :param capacity: Limits advertised by the model. See MicroserviceConnection.capacity
+    :param session: Optional requests.Session to send the request with
+    :param abandoned: Optional event that is set when the response is no longer needed, to stop waiting for a slot
+    :return: JSON response of the model
     """
+    capacity = capacity or {}
+    give_up = time.time() + timeout
+
+    slot = acquire_replica_slot(socket, capacity.get('max_concurrency', 0))
+    while slot is None:
+        if time.time() >= give_up:
+            raise requests.exceptions.Timeout('No free request slot on model replica ' + socket)
+        if abandoned is not None and abandoned.is_set():
+            raise requests.exceptions.ConnectionError('Request to model replica ' + socket + ' was abandoned')
+        time.sleep(dependency.CONCURRENCY_POLL_INTERVAL)
+        slot = acquire_replica_slot(socket, capacity.get('max_concurrency', 0))
 
-    model_is_alive = True
+    try:
+        if abandoned is not None and abandoned.is_set():
+            raise requests.exceptions.ConnectionError('Request to model replica ' + socket + ' was abandoned')
+        file_name, image_file = open_image_for_model(image_hash, file_name, capacity)
+        try:
+            body = MultipartFileStream('file', file_name, image_file)  # Streams the image instead of copying it
+            request = session.post(socket + '/predict', data=body, headers={'Content-Type': body.content_type},
+                                   timeout=max(give_up - time.time(), 0.001))
+            request.raise_for_status()  # Ensure model connection is successful
+            return request.json()
+        finally:
+            image_file.close()
+    finally:
+        release_replica_slot(socket, slot)
+
+
+def post_image_hedged(model_name: str, socket: str, hedge_socket: str, image_hash: str, file_name: str,
+                      timeout: float, capacity: dict = None) -> dict:
+    """
+    Sends an image to a model replica, and if the replica has not answered within the p95 latency of the model, sends
+    the same image to a second replica. The first answer is used and the connection of the other request is dropped,
+    which frees its replica slot right away. Hedges are only sent while the model is within dependency.HEDGE_BUDGET, so
+    hedging can not double the load on a model.
 
-    def kill_model():
-        settings.available_models.pop(model_name)
-        nonlocal model_is_alive
-        model_is_alive = False
-        logger.debug("Model " + model_name + " is not responsive. Removing the model from available services...")
+    :param model_name: Name of the model that is being used.
+    :param socket: Socket of the replica the request is sent to first
+    :param hedge_socket: Socket of the replica the request is hedged to
+    :param image_hash: md5 hash of the image file to send
+    :param file_name: Name the image file is sent under
+    :param timeout: Seconds to wait for the model to respond
+    :param capacity: Limits advertised by the model. See MicroserviceConnection.capacity
+    :return: JSON response of whichever replica answered first
+    """
+    hedge_delay = get_model_latency(model_name, 95)
+    if hedge_delay is None or hedge_delay >= timeout:  # Not enough latency data to know when to hedge
+        return post_image_to_model(socket, image_hash, file_name, timeout, capacity)
 
-    while model_is_alive and not dependency.shutdown:
+    sessions = [AbandonableSession(), AbandonableSession()]
+    executor = ThreadPoolExecutor(2)
+    try:
+        calls = [executor.submit(post_image_to_model, socket, image_hash, file_name, timeout, capacity,
+                                 sessions[0], sessions[0].abandoned)]
+        done, _ = wait(calls, timeout=hedge_delay)
+        if not done and acquire_hedge(model_name):
+            logger.debug('Hedging prediction of image ' + image_hash + ' on model ' + model_name)
+            calls.append(executor.submit(post_image_to_model, hedge_socket, image_hash, file_name,
+                                         timeout - hedge_delay, capacity, sessions[1], sessions[1].abandoned))
+
+        error = requests.exceptions.Timeout()
         try:
-            r = requests.get('http://host.docker.internal:' + str(settings.available_models[model_name]) + '/status')
-            r.raise_for_status()
-            for increment in range(dependency.WAIT_TIME):
-                if not dependency.shutdown:  # Check between increments to stop hanging on shutdown
-                    time.sleep(1)
-        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError):
-            kill_model()
+            for call in as_completed(calls, timeout=timeout):
+                try:
+                    return call.result()
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                        requests.exceptions.HTTPError) as e:
+                    error = e
+        except FutureTimeoutError:
+            pass
+        raise error
+    finally:
+        for session in sessions:  # Drop the request that did not answer first, which releases its replica slot
+            session.abandon()
+        executor.shutdown(wait=False)
+
+
+def model_is_responsive(socket: str) -> bool:
+    """
+    Checks whether a model microservice is able to receive requests at a given socket. This is a helper method that
+    is not directly exposed via HTTP.
+
+    :param socket: Socket the model is running on
+    :return: True if the model responded to a status check, else False
+    """
+    try:
+        r = requests.get(socket + '/status', timeout=dependency.STATUS_TIMEOUT)
+        r.raise_for_status()
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError):
+        return False
+    return True
+
+
+def restore_registered_models():
+    """
+    Re-validates every model socket that was persisted in the database by a previous registration, and adds all
+    responsive models back into available_models. This is run on server startup so that prediction requests can be
+    served immediately, instead of waiting for every model microservice to notice the restart and register again.
+    All status checks are run in parallel, so startup is delayed by at most dependency.STATUS_TIMEOUT seconds.
+    """
+    known_models = get_model_replicas_db()
+    capacities = get_model_capacities_db()
+    known_sockets = list(set(socket for replicas in known_models.values() for socket in replicas))
+    if not known_sockets:
+        return
+
+    with ThreadPoolExecutor(min(len(known_sockets), 32)) as executor:
+        responsive = dict(zip(known_sockets, executor.map(model_is_responsive, known_sockets)))
+
+    for model_name, replicas in known_models.items():
+        replicas = [socket for socket in replicas if responsive[socket]]
+        if not replicas:
+            logger.debug("Model " + model_name + " is not responsive. Skipping restore on startup.")
+            continue
+
+        if model_name in settings.available_models:  # Model registered itself while we were checking
+            continue
+
+        settings.available_models[model_name] = replicas[0]
+        settings.model_replicas[model_name] = replicas
+        settings.model_capacities[model_name] = capacities.get(model_name, {})
+        pool.submit(ping_model, model_name)
+        logger.debug("Model " + model_name + " restored from previous registration.")
+
+
+def ping_model(model_name):
+    """
+    Periodically ping every replica of a model's service to make sure that it is active. Replicas that are not are
+    removed from the model_replicas BaseSetting in dependency.py. Once no replica of the model is active, the model is
+    removed from the available_models BaseSetting and the health check ends. Replicas that register while the model
+    is being checked are included from the next round on, so that every model has a single health check task.
+
+    :param model_name: Name of model to ping. This is the name the model registered to the server with.
+    """
+
+    while not dependency.shutdown:
+        for socket in list(settings.model_replicas.get(model_name, [])):
+            if not model_is_responsive(socket):
+                remove_model_replica(model_name, socket)
+
+        if model_name not in settings.available_models:  # Every replica was removed
             return
 
+        for increment in range(dependency.WAIT_TIME):
+            if not dependency.shutdown:  # Check between increments to stop hanging on shutdown
+                time.sleep(1)
+
     if dependency.shutdown:
         logger.debug("Model [" + model_name + "] Healthcheck Thread Terminated.")
+
+
+def remove_model_replica(model_name, socket):
+    """
+    Removes a replica of a model that is no longer responsive. If the replica was the one in available_models,
+    another replica takes its place, or the model is removed if it has no other replicas.
+
+    :param model_name: Name of model the replica belongs to
+    :param socket: Socket of the replica to remove
+    """
+    replicas = settings.model_replicas.get(model_name, [])
+    if socket in replicas:
+        replicas.remove(socket)
+    remove_model_replica_db(model_name, socket)
+    logger.debug("Model " + model_name + " replica at " + socket + " is not responsive. Removing replica...")
+
+    if settings.available_models.get(model_name) != socket:
+        return
+
+    if replicas:
+        settings.available_models[model_name] = replicas[0]
+        set_model_socket_db(model_name, replicas[0])
+    else:
+        settings.available_models.pop(model_name)
+        settings.model_replicas.pop(model_name, None)
+        remove_model_socket_db(model_name)
+        logger.debug("Model " + model_name + " is not responsive. Removing the model from available services...")
@@ -2,15 +2,18 @@ import os
 import shutil
 import time
 
+import httpx
 import requests
 from fastapi import Depends, APIRouter, UploadFile, File
 from starlette import status
+from starlette.concurrency import run_in_threadpool
 from starlette.responses import JSONResponse, FileResponse
 
 import dependency
-from db_connection import get_api_key_by_key_db, update_training_result_db, get_training_result_by_training_id, \
+from async_db_connection import update_training_result_db, get_training_result_by_training_id, \
     add_training_result_db, get_training_statistics_db, get_bulk_training_results_reverse_order_db
-from dependency import logger, MicroserviceConnection, settings, pool, APIKeyData
+from auth_cache import get_cached_api_key
+from dependency import logger, MicroserviceConnection, settings, pool, async_http_client
 from routers.auth import current_user_researcher, current_user_admin
 
 training_router = APIRouter()
@@ -39,9 +42,9 @@ async def get_training_stats(u: dependency.User = Depends(current_user_researche
     """
 
     if dependency.Roles.admin.name in u.roles:
-        pending, finished = get_training_statistics_db()
+        pending, finished = await get_training_statistics_db()
     else:
-        pending, finished = get_training_statistics_db(u.username)
+        pending, finished = await get_training_statistics_db(u.username)
 
     return {
         'status': 'success',
@@ -70,7 +73,7 @@ async def send_training_request(training_data: dependency.TrainingRequestHttpBod
         }
 
     try:
-        r = requests.post(
+        r = await async_http_client.post(
             'http://host.docker.internal:' + str(settings.available_datasets[training_data.dataset]) + '/train',
             json={
                 'model_structure': training_data.model_structure,
@@ -93,9 +96,9 @@ async def send_training_request(training_data: dependency.TrainingRequestHttpBod
             'save': training_data.save_training_results
         })
 
-        add_training_result_db(training_result)
+        await add_training_result_db(training_result)
 
-    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError):
+    except httpx.HTTPError:
         return {
             'status': 'failure',
             'detail': 'Unable to establish connection with dataset server.'
@@ -128,7 +131,7 @@ async def get_training_result(training_id: str = '', user=Depends(current_user_r
         }
 
     # Lookup training result
-    training_result = get_training_result_by_training_id(training_id)
+    training_result = await get_training_result_by_training_id(training_id)
 
     # If it doesn't exist or user can't access it
     if not training_result or (
@@ -167,9 +170,9 @@ async def get_bulk_training_results(limit: int = -1, u: dependency.User = Depend
     """
 
     if dependency.Roles.admin.name in u.roles:
-        results = get_bulk_training_results_reverse_order_db(limit)
+        results = await get_bulk_training_results_reverse_order_db(limit)
     else:
-        results = get_bulk_training_results_reverse_order_db(limit, u.username)
+        results = await get_bulk_training_results_reverse_order_db(limit, u.username)
 
     return {
         'status': 'success',
@@ -187,7 +190,7 @@ async def download_trained_model_data(training_id: str):
     :param training_id: Training ID of job to download
     :return: application/octet-stream with .zip file containing SavedModel object
     """
-    result = get_training_result_by_training_id(training_id)
+    result = await get_training_result_by_training_id(training_id)
     if not result:
         return {
             'status': 'failure',
@@ -209,7 +212,7 @@ async def download_trained_model_data(training_id: str):
             'training_id': training_id
         }
 
-    if not os.path.exists('/app/training_results/'+training_id+'.zip'):
+    if not await run_in_threadpool(os.path.exists, '/app/training_results/'+training_id+'.zip'):
         return {
             'status': 'failure',
             'detail': 'Unable to locate trained model files.',
@@ -234,7 +237,7 @@ def get_api_key(api_key_header: str = Depends(dependency.api_key_header_auth)):
     :param api_key_header: Header of HTTP request containing {'API_KEY': 'keyGoesHere'}
     :return: APIKeyData object on success, else will raise CredentialException
     """
-    api_key_data = get_api_key_by_key_db(api_key_header)
+    api_key_data = get_cached_api_key(api_key_header)
     if not api_key_data or not api_key_data.enabled or api_key_data.type != dependency.ExternalServices.dataset_microservice.name:
         raise dependency.CredentialException
     return api_key_data
@@ -249,13 +252,13 @@ async def save_training_result(r: dependency.TrainingResultHttpBody):
     :param r:  Training Result with updated fields sent by dataset microservice
     :return: {'status': 'success'} if successful update, else http error.
     """
-    tr = get_training_result_by_training_id(r.training_id)
+    tr = await get_training_result_by_training_id(r.training_id)
     tr.training_accuracy = r.results['training_accuracy']
     tr.validation_accuracy = r.results['validation_accuracy']
     tr.training_loss = r.results['training_loss']
     tr.validation_loss = r.results['validation_loss']
     tr.complete = True
-    update_training_result_db(tr)
+    await update_training_result_db(tr)
     return {
         'status': 'success',
         'detail': 'Training data successfully updated.'
@@ -275,16 +278,14 @@ async def save_model_to_disk(training_id: str = '', model: UploadFile = File(...
     """
     logger.debug('Training ID: ' + training_id)
 
-    if not get_training_result_by_training_id(training_id):
+    if not await get_training_result_by_training_id(training_id):
         return {
             'status': 'failure',
             'detail': 'Unable to find training result with specified ID',
             'training_id': training_id
         }
 
-    upload_folder = open(os.path.join('/app/training_results', model.filename), 'wb+')
-    shutil.copyfileobj(model.file, upload_folder)
-    upload_folder.close()
+    await run_in_threadpool(save_file, model.file, os.path.join('/app/training_results', model.filename))
     return {
         'status': 'success',
         'detail': 'Training results uploaded successfully',
@@ -292,6 +293,17 @@ async def save_model_to_disk(training_id: str = '', model: UploadFile = File(...
     }
 
 
+def save_file(file, path: str):
+    """
+    Copies an uploaded file to disk. This is run in a thread pool by async route handlers.
+
+    :param file: File object of the upload
+    :param path: Path to save the file to
+    """
+    with open(path, 'wb+') as saved_file:
+        shutil.copyfileobj(file, saved_file)
+
+
 @training_router.post("/register", dependencies=[Depends(get_api_key)])
 def register_dataset(dataset: MicroserviceConnection):
     """
@@ -0,0 +1,492 @@
+import math
+import time
+import uuid
+from typing import List, Union
+
+from rq import Queue
+
+from dependency import redis, prediction_queue, User, PredictionPriority, MAX_QUEUE_DEPTH_PER_MODEL, \
+    MAX_OUTSTANDING_JOBS_PER_USER, THROUGHPUT_WINDOW, DEFAULT_RETRY_AFTER, FAIR_SHARE_WEIGHTS, LATENCY_SAMPLES, \
+    SUBMISSION_TTL, MODEL_DEADLINES, DEFAULT_PREDICTION_DEADLINE, HEDGE_BUDGET, \
+    PREDICTION_JOB_TIMEOUT, IN_FLIGHT_JOB_TTL
+
+PREDICTION_QUEUES_KEY = 'prediction:queues'  # Set of names of every per-user prediction queue
+PREDICTION_WEIGHTS_KEY = 'prediction:weights'  # Hash of per-user prediction queue name to fair-share weight
+
+
+# --------------------------------------------------------------------------------
+#                           Prediction Job Bookkeeping
+# --------------------------------------------------------------------------------
+#
+# Every prediction job that is enqueued is tracked in a redis sorted set for its model
+# and a sorted set for the user who submitted it, scored by the time it was enqueued.
+# Sets are used instead of counters so that a job which is requeued or finished twice
+# is only ever counted once. Jobs that were never seen to finish are pruned from the
+# sets IN_FLIGHT_JOB_TTL seconds after they were enqueued, whenever the sets are read,
+# so that a lost job does not count against a model or user forever. Completed jobs
+# are recorded per model in a sorted set by timestamp, which is used to estimate how
+# quickly a model is able to drain its queue.
+#
+# --------------------------------------------------------------------------------
+
+
+def model_jobs_key(model_name: str) -> str:
+    return 'prediction:inflight:model:' + model_name
+
+
+def user_jobs_key(username: str) -> str:
+    return 'prediction:inflight:user:' + username
+
+
+def model_completions_key(model_name: str) -> str:
+    return 'prediction:completed:model:' + model_name
+
+
+def lane_latency_key(priority: str) -> str:
+    return 'prediction:latency:lane:' + priority
+
+
+def model_latency_key(model_name: str) -> str:
+    return 'prediction:latency:model:' + model_name
+
+
+def model_hedges_key(model_name: str) -> str:
+    return 'prediction:hedged:model:' + model_name
+
+
+def replica_slots_key(socket: str) -> str:
+    return 'prediction:slots:replica:' + socket
+
+
+def track_enqueued_job(job_id: str, username: str, model_name: str):
+    """
+    Records that a prediction job has been enqueued, so that it counts towards the queue depth of the model
+    and the outstanding jobs of the user.
+
+    :param job_id: ID of the enqueued job
+    :param username: Username of user who submitted the job
+    :param model_name: Name of model the job will run on
+    """
+    now = time.time()
+    pipeline = redis.pipeline()
+    pipeline.zadd(model_jobs_key(model_name), {job_id: now})
+    pipeline.zadd(user_jobs_key(username), {job_id: now})
+    pipeline.execute()
+
+
+def track_finished_job(job_id: str, username: str, model_name: str, priority: str = None, submitted: float = None):
+    """
+    Records that a prediction job is no longer queued or running. The completion is added to the throughput
+    window of the model, and old completions are trimmed from it. If the priority lane and submission time of the
+    job are known, the latency of the job is recorded for its lane.
+
+    :param job_id: ID of the finished job
+    :param username: Username of user who submitted the job
+    :param model_name: Name of model the job ran on
+    :param priority: Priority lane the job was submitted to
+    :param submitted: Timestamp the job was submitted at
+    """
+    now = time.time()
+    pipeline = redis.pipeline()
+    pipeline.zrem(model_jobs_key(model_name), job_id)
+    if username:
+        pipeline.zrem(user_jobs_key(username), job_id)
+    pipeline.zadd(model_completions_key(model_name), {job_id + '@' + str(now): now})
+    pipeline.zremrangebyscore(model_completions_key(model_name), 0, now - THROUGHPUT_WINDOW)
+    if priority and submitted:
+        pipeline.lpush(lane_latency_key(priority), now - submitted)
+        pipeline.ltrim(lane_latency_key(priority), 0, LATENCY_SAMPLES - 1)
+    pipeline.execute()
+
+
+def track_cancelled_job(job_id: str, username: str, model_name: str):
+    """
+    Records that a prediction job was removed without running, either because it was cancelled or because its
+    deadline passed. Unlike a finished job, this does not count towards the throughput of the model.
+
+    :param job_id: ID of the cancelled job
+    :param username: Username of user who submitted the job
+    :param model_name: Name of model the job would have run on
+    """
+    pipeline = redis.pipeline()
+    pipeline.zrem(model_jobs_key(model_name), job_id)
+    if username:
+        pipeline.zrem(user_jobs_key(username), job_id)
+    pipeline.delete(job_submitters_key(job_id))
+    pipeline.execute()
+
+
+def get_tracked_models() -> List[str]:
+    """
+    :return: Names of every model that has had a prediction job enqueued
+    """
+    prefix = model_jobs_key('')
+    return [key.decode()[len(prefix):] for key in redis.scan_iter(match=prefix + '*')]
+
+
+def count_in_flight_jobs(key: str) -> int:
+    """
+    :param key: Key of the sorted set of in-flight jobs of a model or user
+    :return: Number of jobs in the set, after jobs enqueued more than IN_FLIGHT_JOB_TTL seconds ago are pruned
+    """
+    pipeline = redis.pipeline()
+    pipeline.zremrangebyscore(key, 0, time.time() - IN_FLIGHT_JOB_TTL)
+    pipeline.zcard(key)
+    return pipeline.execute()[-1]
+
+
+def get_model_queue_depth(model_name: str) -> int:
+    """
+    :param model_name: Name of model
+    :return: Number of jobs that are queued or running for the model
+    """
+    return count_in_flight_jobs(model_jobs_key(model_name))
+
+
+def get_user_outstanding_jobs(username: str) -> int:
+    """
+    :param username: Username of user
+    :return: Number of jobs submitted by the user that are queued or running
+    """
+    return count_in_flight_jobs(user_jobs_key(username))
+
+
+def get_model_throughput(model_name: str) -> float:
+    """
+    Estimates the throughput of a model from the number of jobs completed within the last THROUGHPUT_WINDOW seconds.
+
+    :param model_name: Name of model
+    :return: Jobs completed per second. 0 if no jobs have recently been completed.
+    """
+    now = time.time()
+    completed = redis.zcount(model_completions_key(model_name), now - THROUGHPUT_WINDOW, now)
+    return completed / THROUGHPUT_WINDOW
+
+
+# --------------------------------------------------------------------------------
+#                         Model Latency and Hedging
+# --------------------------------------------------------------------------------
+
+
+def track_model_latency(model_name: str, seconds: float):
+    """
+    Records how long a model took to answer a single prediction request. Only the last LATENCY_SAMPLES requests
+    of each model are kept.
+
+    :param model_name: Name of model
+    :param seconds: Seconds the model took to answer
+    """
+    pipeline = redis.pipeline()
+    pipeline.lpush(model_latency_key(model_name), seconds)
+    pipeline.ltrim(model_latency_key(model_name), 0, LATENCY_SAMPLES - 1)
+    pipeline.execute()
+
+
+def get_model_latency(model_name: str, percent: float) -> Union[float, None]:
+    """
+    :param model_name: Name of model
+    :param percent: Percentile to find, from 0 to 100
+    :return: Percentile of the recent request latencies of the model in seconds, or None if there are none
+    """
+    latencies = sorted(float(latency) for latency in redis.lrange(model_latency_key(model_name), 0, -1))
+    return percentile(latencies, percent)
+
+
+def acquire_hedge(model_name: str) -> bool:
+    """
+    Checks whether a prediction request to a model may be hedged without going over HEDGE_BUDGET, which is the
+    fraction of jobs completed by the model within the last THROUGHPUT_WINDOW seconds that may be hedged. If it may,
+    the hedge is recorded.
+
+    :param model_name: Name of model
+    :return: True if the request may be hedged, else False
+    """
+    now = time.time()
+    completed = redis.zcount(model_completions_key(model_name), now - THROUGHPUT_WINDOW, now)
+    hedged = redis.zcount(model_hedges_key(model_name), now - THROUGHPUT_WINDOW, now)
+    if hedged + 1 > HEDGE_BUDGET * completed:
+        return False
+
+    pipeline = redis.pipeline()
+    pipeline.zadd(model_hedges_key(model_name), {str(now): now})
+    pipeline.zremrangebyscore(model_hedges_key(model_name), 0, now - THROUGHPUT_WINDOW)
+    pipeline.execute()
+    return True
+
+
+# --------------------------------------------------------------------------------
+#                              Replica Concurrency
+# --------------------------------------------------------------------------------
+
+
+def acquire_replica_slot(socket: str, limit: int) -> Union[str, None]:
+    """
+    Tries to take one of the request slots of a model replica, so that no more than limit requests are sent to the
+    replica at once across every worker. Slots held for longer than PREDICTION_JOB_TIMEOUT are assumed to belong to
+    a worker that died, and are freed.
+
+    :param socket: Socket of the model replica
+    :param limit: Number of requests the replica may handle at once. 0 for no limit
+    :return: Token of the slot that was taken, to be passed to release_replica_slot, or None if every slot is taken
+    """
+    token = str(uuid.uuid4())
+    if limit <= 0:
+        return token
+
+    now = time.time()
+    pipeline = redis.pipeline()
+    pipeline.zremrangebyscore(replica_slots_key(socket), 0, now - PREDICTION_JOB_TIMEOUT)
+    pipeline.zadd(replica_slots_key(socket), {token: now})
+    pipeline.zrank(replica_slots_key(socket), token)
+    rank = pipeline.execute()[-1]
+
+    if rank >= limit:
+        redis.zrem(replica_slots_key(socket), token)
+        return None
+    return token
+
+
+def release_replica_slot(socket: str, token: str):
+    """
+    Frees a request slot of a model replica that was taken with acquire_replica_slot.
+
+    :param socket: Socket of the model replica
+    :param token: Token of the slot
+    """
+    redis.zrem(replica_slots_key(socket), token)
+
+
+# --------------------------------------------------------------------------------
+#                          Submissions and Deadlines
+# --------------------------------------------------------------------------------
+
+
+def submission_jobs_key(submission_id: str) -> str:
+    return 'prediction:submission:' + submission_id
+
+
+def track_submission_job(submission_id: str, job_id: str):
+    """
+    Records that a prediction job was enqueued as part of a submission, so that every job of the submission can be
+    cancelled at once. Submissions are only tracked for SUBMISSION_TTL seconds.
+
+    :param submission_id: ID of the submission returned by /model/predict
+    :param job_id: ID of the enqueued job
+    """
+    pipeline = redis.pipeline()
+    pipeline.sadd(submission_jobs_key(submission_id), job_id)
+    pipeline.expire(submission_jobs_key(submission_id), SUBMISSION_TTL)
+    pipeline.execute()
+
+
+def job_submitters_key(job_id: str) -> str:
+    return 'prediction:submitters:' + job_id
+
+
+def track_job_submitter(job_id: str, username: str, new_job: bool = False):
+    """
+    Records that a user submitted an image for a prediction job. Job IDs are shared by every user who submits the
+    same image to the same model, so a job is only cancelled once none of these users still needs it. Submitters are
+    only tracked for SUBMISSION_TTL seconds.
+
+    :param job_id: ID of the job
+    :param username: Username of user who submitted the image
+    :param new_job: True if the job was just enqueued, so that the submitters of a previous run are forgotten
+    """
+    pipeline = redis.pipeline()
+    if new_job:
+        pipeline.delete(job_submitters_key(job_id))
+    pipeline.sadd(job_submitters_key(job_id), username)
+    pipeline.expire(job_submitters_key(job_id), SUBMISSION_TTL)
+    pipeline.execute()
+
+
+def remove_job_submitter(job_id: str, username: str) -> Union[int, None]:
+    """
+    Records that a user no longer needs a prediction job.
+
+    :param job_id: ID of the job
+    :param username: Username of user who submitted the image
+    :return: Number of other users who still need the job, or None if the user had not submitted it
+    """
+    pipeline = redis.pipeline()
+    pipeline.srem(job_submitters_key(job_id), username)
+    pipeline.scard(job_submitters_key(job_id))
+    removed, remaining = pipeline.execute()
+    return remaining if removed else None
+
+
+def get_submission_job_ids(submission_id: str) -> List[str]:
+    """
+    :param submission_id: ID of the submission returned by /model/predict
+    :return: IDs of every job enqueued as part of the submission
+    """
+    return [job_id.decode() for job_id in redis.smembers(submission_jobs_key(submission_id))]
+
+
+def get_job_deadline(model_name: str, deadline: int = 0) -> Union[float, None]:
+    """
+    Finds the time at which a new prediction job expires. A deadline given with the request is used first, then the
+    deadline configured for the model, then the default deadline.
+
+    :param model_name: Name of model the job will run on
+    :param deadline: Seconds the job may wait, as given with the request. 0 if not given
+    :return: Timestamp the job expires at, or None if the job has no deadline
+    """
+    seconds = deadline or MODEL_DEADLINES.get(model_name, DEFAULT_PREDICTION_DEADLINE)
+    return time.time() + seconds if seconds > 0 else None
+
+
+# --------------------------------------------------------------------------------
+#                               Admission Control
+# --------------------------------------------------------------------------------
+
+
+def estimate_wait(excess_jobs: int, throughput: float) -> int:
+    """
+    Estimates how many seconds it will take until a number of jobs have drained from a queue.
+
+    :param excess_jobs: Number of jobs that must finish
+    :param throughput: Jobs completed per second
+    :return: Estimated seconds until the jobs have finished, at least 1
+    """
+    if throughput <= 0:
+        return DEFAULT_RETRY_AFTER
+    return max(1, math.ceil(excess_jobs / throughput))
+
+
+def check_admission(username: str, model_names: List[str]) -> Union[int, None]:
+    """
+    Checks whether a set of new jobs may be enqueued without going over the queue depth limit of any model or the
+    outstanding job limit of the user. If the jobs can not be admitted, the number of seconds the client should wait
+    before retrying is estimated from the recent throughput of the models.
+
+    :param username: Username of user submitting the jobs
+    :param model_names: Model name of each new job. A model is listed once for every job that will run on it
+    :return: None if jobs can be admitted, else the estimated seconds until they could be admitted
+    """
+    if not model_names:
+        return None
+
+    retry_after = 0
+    throughput = {model_name: get_model_throughput(model_name) for model_name in set(model_names)}
+
+    for model_name in throughput:
+        excess = get_model_queue_depth(model_name) + model_names.count(model_name) - MAX_QUEUE_DEPTH_PER_MODEL
+        if excess > 0:
+            retry_after = max(retry_after, estimate_wait(excess, throughput[model_name]))
+
+    excess = get_user_outstanding_jobs(username) + len(model_names) - MAX_OUTSTANDING_JOBS_PER_USER
+    if excess > 0:
+        retry_after = max(retry_after, estimate_wait(excess, sum(throughput.values())))
+
+    return retry_after if retry_after > 0 else None
+
+
+# --------------------------------------------------------------------------------
+#                       Fair-Share Queues and Priority Lanes
+# --------------------------------------------------------------------------------
+#
+# Each user submits prediction jobs to their own queue within a priority lane. Workers
+# drain the lanes in priority order, and serve the queues within a lane with deficit
+# round-robin (see worker.py), so a user with a very large submission can not make
+# every other user wait behind them. The weight of each queue is the number of jobs it
+# is served per round, and is configured by role or agency with FAIR_SHARE_WEIGHTS.
+#
+# --------------------------------------------------------------------------------
+
+
+def get_user_weight(user: User) -> float:
+    """
+    Finds the fair-share weight of a user. FAIR_SHARE_WEIGHTS is keyed by "role:<role>" or "agency:<agency>", and
+    the largest weight that applies to the user is used.
+
+    :param user: User object to find weight of
+    :return: Fair-share weight of user. 1 if no configured weight applies.
+    """
+    keys = ['role:' + role for role in user.roles] + ['agency:' + str(user.agency)]
+    weights = [FAIR_SHARE_WEIGHTS[key] for key in keys if key in FAIR_SHARE_WEIGHTS]
+    return max(weights) if weights else 1
+
+
+def get_user_queue(user: User, priority: str = PredictionPriority.normal.name) -> Queue:
+    """
+    Gets the prediction queue of a user in a priority lane, and registers it with its weight so that workers will
+    start serving it.
+
+    :param user: User object who is submitting jobs
+    :param priority: dependency.PredictionPriority name of the lane, as a string
+    :return: Redis queue for prediction jobs of the user
+    """
+    queue_name = prediction_queue.name + ':' + priority + ':' + user.username
+    pipeline = redis.pipeline()
+    pipeline.sadd(PREDICTION_QUEUES_KEY, queue_name)
+    pipeline.hset(PREDICTION_WEIGHTS_KEY, queue_name, get_user_weight(user))
+    pipeline.execute()
+    return Queue(queue_name, connection=redis)
+
+
+def get_prediction_queues() -> List[Queue]:
+    """
+    Gets every queue that may hold prediction jobs. The shared prediction queue is always included, so that jobs
+    enqueued before per-user queues existed are still processed.
+
+    :return: List of redis queues for prediction jobs
+    """
+    queue_names = sorted(name.decode() for name in redis.smembers(PREDICTION_QUEUES_KEY))
+    return [prediction_queue] + [Queue(name, connection=redis) for name in queue_names]
+
+
+def get_prediction_queue_weights() -> dict:
+    """
+    :return: Dictionary of prediction queue name to fair-share weight
+    """
+    return {name.decode(): float(weight) for name, weight in redis.hgetall(PREDICTION_WEIGHTS_KEY).items()}
+
+
+def get_queue_priority(queue_name: str) -> str:
+    """
+    Finds the priority lane of a prediction queue from its name. Queues that were created without a lane, including
+    the shared prediction queue, are in the normal lane.
+
+    :param queue_name: Name of prediction queue
+    :return: dependency.PredictionPriority name of the lane, as a string
+    """
+    name_parts = queue_name.split(':')
+    if len(name_parts) > 2 and name_parts[1] in PredictionPriority.__members__:
+        return name_parts[1]
+    return PredictionPriority.normal.name
+
+
+def get_lane_statistics() -> dict:
+    """
+    Creates statistics for each priority lane: the number of jobs waiting in the lane, and percentiles of the time
+    from submission to completion over the last LATENCY_SAMPLES jobs of the lane.
+
+    :return: Dictionary of lane name to lane statistics, with latencies in seconds. Latencies are None if no jobs
+             have been completed in a lane.
+    """
+    lanes = {}
+    queues = get_prediction_queues()
+    for priority in PredictionPriority.__members__:
+        latencies = sorted(float(latency) for latency in redis.lrange(lane_latency_key(priority), 0, -1))
+        lanes[priority] = {
+            'queued': sum(len(queue) for queue in queues if get_queue_priority(queue.name) == priority),
+            'samples': len(latencies),
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99)
+        }
+    return lanes
+
+
+def percentile(sorted_values: List[float], percent: float) -> Union[float, None]:
+    """
+    :param sorted_values: Values sorted in ascending order
+    :param percent: Percentile to find, from 0 to 100
+    :return: Nearest-rank percentile of the values. None if there are no values.
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
@@ -0,0 +1,86 @@
+import json
+import math
+from typing import List
+
+from redis.exceptions import RedisError
+
+from cache import TTLCache
+from db_connection import get_images_from_user_db, count_search_db
+from dependency import User, Roles, PAGINATION_PAGE_SIZE, SEARCH_CACHE_MAX_HASHES, SEARCH_CACHE_TTL, logger
+from search_counts import get_search_versions, RESET_VERSION_NAME
+
+# Pages and counts of recent image searches. The size of an entry is the number of hashes in it, plus one.
+search_cache = TTLCache(SEARCH_CACHE_MAX_HASHES, SEARCH_CACHE_TTL,
+                        get_size=lambda result: len(result.get('hashes', [])) + 1)
+
+
+def get_search_version_names(user: User, search_filter: dict, search_string: str) -> List[str]:
+    """
+    :param user: User who is searching
+    :param search_filter: Filter of the search, as {modelName: [className, ...], ...}
+    :param search_string: Search string of the search
+    :return: Names of the version counters that change when the results of the search may change. See
+             search_counts.update_search_versions
+    """
+    if Roles.admin.name not in user.roles:  # Every change to the images of the user changes its version
+        return ['user:' + user.username]
+
+    names = ['all'] + ['model:' + model_name for model_name in search_filter]
+    if search_string:  # Search strings also match the model and class names of labels
+        names.append('labels')
+    return names
+
+
+def search_images_cached(
+        user: User,
+        page: int = -1,
+        search_filter: dict = None,
+        search_string: str = '',
+        paginate: bool = True,
+        min_score: float = 0,
+        page_size: int = PAGINATION_PAGE_SIZE,
+        cursor: str = None,
+        estimate: bool = False
+) -> dict:
+    """
+    Cached version of db_connection.get_images_from_user_db. Results are keyed by the user, the normalized search,
+    and the versions of the images the search covers, so a result is used until an image that could match it is
+    added or changed. See get_images_from_user_db for the parameters.
+
+    The number of images matching the search is cached separately from the pages, so that it is only counted once
+    for every page of the search. If the versions can not be read from redis, the database is searched directly.
+
+    :return: Result of get_images_from_user_db
+    :raises ValueError: If the cursor is not valid
+    """
+    search_filter = {model_name: sorted(set(str(model_class) for model_class in model_classes))
+                     for model_name, model_classes in sorted((search_filter or {}).items())}
+    search_string = ' '.join(search_string.lower().split())
+
+    version_names = get_search_version_names(user, search_filter, search_string) + [RESET_VERSION_NAME]
+    try:
+        versions = tuple(get_search_versions(version_names))
+    except RedisError as e:
+        logger.warning('Unable to read search versions, searching without the cache: ' + str(e))
+        return get_images_from_user_db(user.username, page, search_filter, search_string, paginate, min_score,
+                                       page_size, cursor, estimate)
+    key = (user.username, json.dumps([page, search_filter, search_string, paginate, min_score, page_size, cursor]),
+           versions)
+    count_key = ('count', user.username, json.dumps([search_filter, search_string, min_score, estimate]), versions)
+
+    result = search_cache.get(key)
+    if result is None:
+        result = get_images_from_user_db(user.username, page, search_filter, search_string, paginate, min_score,
+                                         page_size, cursor, estimate, count=False)
+        search_cache.set(key, result)
+
+    counts = search_cache.get(count_key)
+    if counts is None:
+        num_images, estimated = count_search_db(user.username, search_filter, search_string, min_score, estimate)
+        counts = {'num_images': num_images, 'num_images_estimated': estimated}
+        search_cache.set(count_key, counts)
+
+    result = dict(result, **counts)
+    if paginate:
+        result['num_pages'] = math.ceil(counts['num_images'] / page_size)
+    return result
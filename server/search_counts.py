@@ -0,0 +1,182 @@
+from typing import Callable, Dict, List
+
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+
+from dependency import redis, logger, SEARCH_COUNT_TTL
+
+# --------------------------------------------------------------------------------
+#                              Cached Image Counts
+# --------------------------------------------------------------------------------
+#
+# The number of images matching the most common searches is cached in redis, so that
+# showing the page total does not need a scan over every matching image. Counts are
+# kept for every image and for the images of each user, both in total and per model
+# class. A count is computed from the database the first time it is needed, and is
+# then kept up to date as images, users and model results are added. Counters that
+# were never computed are not created by updates, and every counter expires after
+# SEARCH_COUNT_TTL seconds, so that any drift is eventually corrected.
+#
+# Updates are best-effort, so that a redis outage does not fail image writes. A
+# process that could not send an update reconciles once redis is reachable again,
+# by clearing every count and incrementing the reset search version.
+#
+# --------------------------------------------------------------------------------
+
+IMAGE_COUNT_PREFIX = 'images:count:'
+
+_stale = False  # Whether an update could not be sent to redis since the last reconcile
+
+# Increments a counter only if it exists, since a counter that was never computed from the database is unknown
+_increment_existing = redis.register_script("""
+for i, key in ipairs(KEYS) do
+    if redis.call('exists', key) == 1 then
+        redis.call('incrby', key, ARGV[i])
+    end
+end
+""")
+
+
+def image_count_key(username: str = None, model_name: str = None, model_class: str = None) -> str:
+    """
+    :param username: User whose images are counted, or None for every image
+    :param model_name: Model of the class that the images are labeled with, or None for images with any labels
+    :param model_class: Class that the images are labeled with
+    :return: Redis key of the count
+    """
+    key = IMAGE_COUNT_PREFIX + ('user:' + username if username else 'all')
+    if model_name is not None:
+        key += ':label:' + model_name + ':' + str(model_class)
+    return key
+
+
+def get_cached_count(key: str, count: Callable[[], int]) -> int:
+    """
+    :param key: Redis key of the count. See image_count_key
+    :param count: Function that counts the images in the database, used if the count is not cached
+    :return: Number of images
+    """
+    try:
+        cached = redis.get(key)
+    except (RedisConnectionError, RedisTimeoutError):
+        return count()
+    if cached is not None:
+        return int(cached)
+
+    value = count()
+    redis.set(key, value, ex=SEARCH_COUNT_TTL, nx=True)
+    return value
+
+
+def send_update(update: Callable[[], None]):
+    """
+    Sends an update of the cached counts or search versions to redis. If redis is unavailable, the update is
+    dropped and the next update reconciles first. See reconcile_search_counts.
+
+    :param update: Function that sends the update to redis
+    """
+    global _stale
+    try:
+        if _stale:
+            reconcile_search_counts()
+            _stale = False
+        update()
+    except (RedisConnectionError, RedisTimeoutError) as e:
+        _stale = True
+        logger.warning('Unable to update cached search counts: ' + str(e))
+
+
+def reconcile_search_counts():
+    """
+    Corrects the cache after updates were dropped, or after images were changed in bulk. Every cached count is
+    deleted, so that it is counted from the database again, and the reset search version is incremented, so that no
+    cached search result is used again.
+    """
+    clear_image_counts()
+    redis.incr(search_version_key(RESET_VERSION_NAME))
+
+
+def update_image_counts(usernames: List[str], images: int = 0, labels: Dict[tuple, int] = None,
+                        include_all: bool = True):
+    """
+    Updates the cached counts of every image and of the images of each user.
+
+    :param usernames: Users whose counts are updated
+    :param images: Number of images to add to the totals
+    :param labels: Number of images to add per label, as {(modelName, className): number, ...}
+    :param include_all: Whether the counts of every image are updated too. False if the images were already counted
+    """
+    changes = {}
+    for username in ([None] if include_all else []) + list(usernames):
+        if images:
+            changes[image_count_key(username)] = images
+        for (model_name, model_class), number in (labels or {}).items():
+            if number:
+                changes[image_count_key(username, model_name, model_class)] = number
+
+    if changes:
+        send_update(lambda: _increment_existing(keys=list(changes), args=list(changes.values())))
+
+
+def clear_image_counts():
+    """
+    Deletes every cached count, so that they are computed from the database again when next needed.
+    """
+    keys = list(redis.scan_iter(IMAGE_COUNT_PREFIX + '*'))
+    if keys:
+        redis.delete(*keys)
+
+
+# --------------------------------------------------------------------------------
+#                                Search Versions
+# --------------------------------------------------------------------------------
+#
+# Every change to the images that could change the results of a search increments a
+# version counter in redis. Cached search results are keyed by the versions they were
+# found at, so they are no longer used once one of these versions changes:
+#   - user:<username> changes when any image of the user changes.
+#   - all changes when an image is added or gets a new file name.
+#   - model:<modelName> changes when the model adds a result to any image.
+#   - labels changes when any model adds a result to any image.
+#   - reset changes when every cached search result is out of date. Every search
+#     depends on it.
+#
+# --------------------------------------------------------------------------------
+
+SEARCH_VERSION_PREFIX = 'images:version:'
+RESET_VERSION_NAME = 'reset'
+
+
+def search_version_key(name: str) -> str:
+    return SEARCH_VERSION_PREFIX + name
+
+
+def update_search_versions(usernames: List[str] = (), all_images: bool = False, model_name: str = None):
+    """
+    Increments the version counters of a change to images.
+
+    :param usernames: Users who have an image that changed
+    :param all_images: True if an image was added or got a new file name
+    :param model_name: Model that added a result to an image
+    """
+    names = ['user:' + username for username in usernames]
+    if all_images:
+        names.append('all')
+    if model_name is not None:
+        names.extend(['model:' + model_name, 'labels'])
+
+    def increment_versions():
+        pipeline = redis.pipeline(transaction=False)
+        for name in names:
+            pipeline.incr(search_version_key(name))
+        pipeline.execute()
+
+    if names:
+        send_update(increment_versions)
+
+
+def get_search_versions(names: List[str]) -> List[int]:
+    """
+    :param names: Names of version counters, such as "user:<username>" or "all"
+    :return: Current value of each counter
+    """
+    return [int(version or 0) for version in redis.mget([search_version_key(name) for name in names])]
@@ -0,0 +1,67 @@
+"""
+Benchmark of the concurrent request capacity of a single server process on its async routes. Sends requests to each
+route from a growing number of concurrent clients, and reports the throughput and latency percentiles at each level.
+Throughput that keeps rising with concurrency, and latency that stays flat until then, shows that the routes do not
+block the event loop.
+
+Run from the server directory against a server started with a single worker, using an account with the admin role:
+
+    PYTHONPATH=. python test/benchmark_async_routes.py http://localhost:5000 admin password 1 10 50 100
+"""
+import asyncio
+import sys
+import time
+
+import httpx
+
+ROUTES = [('GET', '/model/all'), ('GET', '/training/detail'), ('GET', '/training/results?limit=10'),
+          ('POST', '/model/results')]
+DURATION = 10  # Seconds that requests are sent for at each concurrency level
+
+
+async def run_client(client: httpx.AsyncClient, method: str, route: str, deadline: float, latencies: list) -> int:
+    """
+    Sends requests one after another until the deadline.
+
+    :return: Number of requests that failed
+    """
+    failures = 0
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        response = await client.request(method, route, json=[] if method == 'POST' else None)
+        latencies.append(time.perf_counter() - started)
+        failures += response.status_code != 200
+    return failures
+
+
+async def measure(client: httpx.AsyncClient, method: str, route: str, concurrency: int) -> (float, float, float, int):
+    """
+    :return: Requests per second, median and 99th percentile latency in seconds, and the number of failed requests
+    """
+    latencies = []
+    deadline = time.perf_counter() + DURATION
+    failures = await asyncio.gather(*[run_client(client, method, route, deadline, latencies)
+                                      for _ in range(concurrency)])
+
+    latencies.sort()
+    return (len(latencies) / DURATION, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)],
+            sum(failures))
+
+
+async def main(url: str, username: str, password: str, levels):
+    async with httpx.AsyncClient(base_url=url, timeout=60,
+                                 limits=httpx.Limits(max_connections=max(levels))) as client:
+        login = await client.post('/auth/login', data={'username': username, 'password': password})
+        login.raise_for_status()
+        client.headers['Authorization'] = 'Bearer ' + login.json()['access_token']
+
+        print('%-30s %12s %10s %10s %10s %9s' % ('route', 'concurrency', 'req/s', 'p50', 'p99', 'failures'))
+        for method, route in ROUTES:
+            for concurrency in sorted(levels):
+                rate, p50, p99, failures = await measure(client, method, route, concurrency)
+                print('%-30s %12d %10.1f %8.1fms %8.1fms %9d' % (method + ' ' + route, concurrency, rate, p50 * 1000,
+                                                                 p99 * 1000, failures))
+
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1], sys.argv[2], sys.argv[3], [int(level) for level in sys.argv[4:]] or [1, 10, 50, 100]))
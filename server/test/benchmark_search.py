@@ -0,0 +1,90 @@
+"""
+Benchmark of model-class search filters against the size of the image collection. Compares the old filter, an $or
+over 'models.<model>.<class>' paths that no index can cover, with the $elemMatch filter on the labels index.
+
+Synthetic images are written to a separate benchmark database, which is dropped afterwards. Run from the server
+directory with a database available at DB_HOST:
+
+    PYTHONPATH=. python test/benchmark_search.py 10000 100000 1000000
+"""
+import random
+import sys
+import time
+
+from dependency import client
+from db_connection import get_image_labels, get_search_filter_query
+
+MODELS = {'model_' + str(m): ['class_' + str(c) for c in range(50)] for m in range(5)}
+SEARCH_FILTER = {'model_0': ['class_1', 'class_2'], 'model_3': ['class_7']}
+REPEATS = 5
+
+
+def create_images(collection, count: int, start: int):
+    """
+    Inserts synthetic images with a random result from every model. Each model gives a positive score to three of
+    its classes.
+    """
+    batch = []
+    for i in range(start, start + count):
+        models = {model: {model_class: 0 for model_class in classes} for model, classes in MODELS.items()}
+        for model, classes in MODELS.items():
+            for model_class in random.sample(classes, 3):
+                models[model][model_class] = round(random.random(), 3)
+
+        batch.append({
+            'hash_md5': '%032x' % i,
+            'users': ['benchmark'],
+            'models': models,
+            'labels': [label for model, result in models.items() for label in get_image_labels(model, result)]
+        })
+        if len(batch) == 10000:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+
+
+def time_query(collection, query: dict) -> (float, str):
+    """
+    :return: Median seconds to find the hashes of every matching image, and the winning plan stage of the query
+    """
+    durations = []
+    for _ in range(REPEATS):
+        started = time.time()
+        list(collection.find(query, {'hash_md5': 1}))
+        durations.append(time.time() - started)
+
+    plan = collection.find(query).explain()['queryPlanner']['winningPlan']
+    stages = []
+    while plan:
+        stages.append(plan.get('stage'))
+        plan = plan.get('inputStage') or (plan.get('inputStages') or [None])[0]
+    return sorted(durations)[len(durations) // 2], ' > '.join(stages)
+
+
+def main(sizes):
+    database = client['benchmark_database']
+    collection = database['images']
+    collection.drop()
+    collection.create_index([('labels.model', 1), ('labels.class', 1), ('labels.score', -1)])
+
+    old_query = {'$or': [{'models.' + model + '.' + model_class: {'$gt': 0}}
+                         for model in SEARCH_FILTER for model_class in SEARCH_FILTER[model]]}
+    new_query = get_search_filter_query(SEARCH_FILTER)
+
+    print('%12s %14s %14s   %s' % ('images', 'models paths', 'labels index', 'labels plan'))
+    try:
+        size = 0
+        for target in sorted(sizes):
+            create_images(collection, target - size, size)
+            size = target
+
+            old_time, _ = time_query(collection, old_query)
+            new_time, new_plan = time_query(collection, new_query)
+            print('%12d %12.1fms %12.1fms   %s' % (size, old_time * 1000, new_time * 1000, new_plan))
+    finally:
+        client.drop_database('benchmark_database')
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or [10000, 100000, 1000000])
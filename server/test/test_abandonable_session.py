@@ -0,0 +1,43 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+
+from abandonable_session import AbandonableSession
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(5)  # Longer than the test waits for the request to fail
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_abandon_drops_running_request():
+    server = HTTPServer(('127.0.0.1', 0), SlowHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    session = AbandonableSession()
+    errors = []
+
+    def request():
+        try:
+            session.get('http://127.0.0.1:' + str(server.server_port), timeout=10)
+        except requests.exceptions.ConnectionError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=request)
+    started = time.time()
+    thread.start()
+    time.sleep(0.5)  # Let the request reach the server
+    session.abandon()
+    thread.join(timeout=3)
+
+    assert not thread.is_alive()
+    assert len(errors) == 1
+    assert time.time() - started < 3
+    assert session.abandoned.is_set()
+    server.server_close()
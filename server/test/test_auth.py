@@ -6,7 +6,8 @@ from main import app
 from routers.auth import get_current_active_user
 
 # from test.conftest import override_logged_in_user
-from db_connection import get_user_by_name_db
+from db_connection import get_user_by_name_db, add_user_db, set_user_roles_db, set_api_key_enabled_db
+from dependency import APIKeyData
 
 client = TestClient(app)
 
@@ -230,4 +231,16 @@ def test_login():
 @pytest.mark.timeout(5)
 def test_login_bad_username():
     login_response = client.post("/auth/login", data={'username': 'testing', 'password': 'bad'})
-    assert login_response.status_code == 401
\ No newline at end of file
+    assert login_response.status_code == 401
+
+
+@pytest.mark.timeout(5)
+def test_user_db_writes():
+    existing_user = get_user_by_name_db('testing')
+    assert not add_user_db(existing_user)  # Users are only added once
+    assert get_user_by_name_db('testing') == existing_user
+
+    assert not set_user_roles_db('testing_missing_user', [])
+    assert get_user_by_name_db('testing_missing_user') is None
+    missing_key = APIKeyData(key='testing_missing_key', type='prediction', user='testing', enabled=True)
+    assert not set_api_key_enabled_db(missing_key, False)
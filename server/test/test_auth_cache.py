@@ -0,0 +1,84 @@
+import time
+
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+import auth_cache
+from auth_cache import get_cached_user, invalidate_user, handle_invalidation, user_cache, CLEAR_ALL_MESSAGE, \
+    get_cached_api_key, secret_digest, clear_auth_caches, get_cached_token_claims, cache_token_claims, token_cache
+from dependency import User, APIKeyData
+
+
+def test_cached_user(monkeypatch):
+    lookups = []
+
+    def get_user_by_name_db(username):
+        lookups.append(username)
+        return User(username=username, password='', roles=[]) if username == 'testing' else None
+
+    monkeypatch.setattr(auth_cache, 'get_user_by_name_db', get_user_by_name_db)
+    clear_auth_caches()
+
+    assert get_cached_user('testing').username == 'testing'
+    assert get_cached_user('testing').username == 'testing'
+    assert lookups == ['testing']
+
+    # Users that do not exist are looked up again, since they may be created at any time
+    assert get_cached_user('testing_missing') is None
+    assert get_cached_user('testing_missing') is None
+    assert lookups == ['testing', 'testing_missing', 'testing_missing']
+
+    handle_invalidation({'type': 'message', 'data': b'user:testing'})
+    get_cached_user('testing')
+    assert lookups[-1] == 'testing' and len(lookups) == 4
+
+    handle_invalidation({'type': 'message', 'data': CLEAR_ALL_MESSAGE.encode()})
+    assert user_cache.get('testing') is None
+
+
+def test_cached_api_key(monkeypatch):
+    lookups = []
+
+    def get_api_key_by_key_db(key):
+        lookups.append(key)
+        if key != 'valid':
+            return None
+        return APIKeyData(key=key, type='predict_microservice', user='testing', enabled=True)
+
+    monkeypatch.setattr(auth_cache, 'get_api_key_by_key_db', get_api_key_by_key_db)
+    clear_auth_caches()
+
+    assert get_cached_api_key('valid').user == 'testing'
+    assert get_cached_api_key('valid').user == 'testing'
+
+    # Unknown keys are also cached
+    assert get_cached_api_key('unknown') is None
+    assert get_cached_api_key('unknown') is None
+    assert lookups == ['valid', 'unknown']
+
+    handle_invalidation({'type': 'message', 'data': ('key:' + secret_digest('unknown')).encode()})
+    assert get_cached_api_key('unknown') is None
+    assert lookups == ['valid', 'unknown', 'unknown']
+
+
+def test_cached_token_claims():
+    token_cache.clear()
+    cache_token_claims('valid', {'sub': 'testing', 'exp': time.time() + 60})
+    assert get_cached_token_claims('valid')['sub'] == 'testing'
+    assert get_cached_token_claims('unknown') is None
+
+    # Expired tokens are never returned
+    cache_token_claims('expired', {'sub': 'testing', 'exp': time.time() - 1})
+    assert get_cached_token_claims('expired') is None
+    token_cache.set(secret_digest('expiring'), {'sub': 'testing', 'exp': time.time() - 1})
+    assert get_cached_token_claims('expiring') is None
+
+
+def test_invalidate_user_without_redis(monkeypatch):
+    class UnavailableRedis:
+        def publish(self, channel, message):
+            raise RedisConnectionError('Redis is unavailable')
+
+    monkeypatch.setattr(auth_cache, 'redis', UnavailableRedis())
+    user_cache.set('testing', User(username='testing', password='', roles=[]))
+    invalidate_user('testing')  # The change was already saved, so this must not fail
+    assert user_cache.get('testing') is None
@@ -0,0 +1,40 @@
+import time
+
+from cache import TTLCache
+
+
+def test_cache_eviction():
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1  # 'b' is now the least recently used entry
+
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+
+    stats = cache.stats()
+    assert stats['entries'] == 2 and stats['evictions'] == 1
+    assert stats['hits'] == 3 and stats['misses'] == 1 and stats['hit_rate'] == 0.75
+
+
+def test_cache_size():
+    cache = TTLCache(max_size=5, ttl=60, get_size=len)
+    cache.set('a', [1, 2, 3])
+    cache.set('b', [1, 2, 3])
+    assert cache.get('a') is None and cache.stats()['size'] == 3
+
+    cache.set('c', [1] * 6)  # Larger than the whole cache
+    assert cache.get('c') is None and cache.get('b') == [1, 2, 3]
+
+
+def test_cache_expiry():
+    cache = TTLCache(max_size=10, ttl=60)
+    cache.set('a', 1, ttl=0.01)
+    cache.set('b', None)
+    time.sleep(0.02)
+
+    missing = object()
+    assert cache.get('a', missing) is missing
+    assert cache.get('b', missing) is None  # Cached None values can be told apart from misses
+    assert cache.stats()['expirations'] == 1
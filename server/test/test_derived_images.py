@@ -0,0 +1,92 @@
+import os
+
+import pytest
+from PIL import Image
+
+import dependency
+import derived_images
+from dependency import redis
+from derived_images import get_image_spec, get_target_format, derive_image, derived_image_name, open_image_for_model
+
+
+def test_image_spec():
+    assert get_image_spec({}) is None  # Model accepts any image
+    assert get_image_spec({'accepted_formats': ['JPG']}) == {'resolution': None, 'formats': ['jpeg']}
+
+
+def test_target_format(tmp_path):
+    Image.new('RGB', (400, 200)).save(tmp_path / 'image.png', format='PNG')
+    image = Image.open(tmp_path / 'image.png')
+
+    assert get_target_format(image, get_image_spec({'input_resolution': [400, 400]})) is None  # Already fits
+    assert get_target_format(image, get_image_spec({'input_resolution': [100, 100]})) == 'png'
+    assert get_target_format(image, get_image_spec({'accepted_formats': ['jpeg', 'png']})) is None
+    assert get_target_format(image, get_image_spec({'accepted_formats': ['jpeg']})) == 'jpeg'
+
+
+def test_derive_image(tmp_path):
+    Image.new('RGBA', (400, 200)).save(tmp_path / 'image.png', format='PNG')
+
+    # Images are scaled down to fit the input resolution, keeping their aspect ratio
+    spec = get_image_spec({'input_resolution': [100, 100], 'accepted_formats': ['jpeg']})
+    (tmp_path / 'derived.jpeg').write_bytes(derive_image(Image.open(tmp_path / 'image.png'), 'jpeg', spec))
+    derived = Image.open(tmp_path / 'derived.jpeg')
+    assert derived.format == 'JPEG' and derived.size == (100, 50)
+
+    # Raw images are scaled to exactly the input resolution, with three bytes per pixel
+    spec = get_image_spec({'input_resolution': [32, 16], 'accepted_formats': ['raw']})
+    assert len(derive_image(Image.open(tmp_path / 'image.png'), 'raw', spec)) == 32 * 16 * 3
+
+
+def test_derived_image_name():
+    spec = get_image_spec({'input_resolution': [224, 224], 'accepted_formats': ['jpeg']})
+    other_spec = get_image_spec({'input_resolution': [640, 640], 'accepted_formats': ['jpeg']})
+    assert derived_image_name('image_hash', spec, 'jpeg') == derived_image_name('image_hash', dict(spec), 'jpeg')
+    assert derived_image_name('image_hash', spec, 'jpeg') != derived_image_name('image_hash', other_spec, 'jpeg')
+    assert derived_image_name('image_hash', spec, 'jpeg').endswith('.jpeg')
+
+
+@pytest.mark.timeout(5)
+def test_open_image_for_model(tmp_path, monkeypatch):
+    monkeypatch.setattr(dependency, 'IMAGE_STORE_PATH', str(tmp_path) + '/')
+    monkeypatch.setattr(dependency, 'DERIVED_IMAGE_PATH', str(tmp_path / 'derived') + '/')
+    monkeypatch.setattr(derived_images, 'DERIVED_IMAGES_KEY', 'testing:images:derived')
+    monkeypatch.setattr(derived_images, 'DERIVED_IMAGE_SIZES_KEY', 'testing:images:derived:sizes')
+    monkeypatch.setattr(derived_images, 'DERIVED_IMAGES_BYTES_KEY', 'testing:images:derived:bytes')
+    Image.new('RGBA', (400, 200)).save(tmp_path / 'image_hash', format='PNG')
+
+    try:
+        # Images that the model accepts are sent as they were uploaded
+        file_name, image_file = open_image_for_model('image_hash', 'image.png', {'accepted_formats': ['png']})
+        assert file_name == 'image.png' and image_file.read() == (tmp_path / 'image_hash').read_bytes()
+        image_file.close()
+
+        # Other images are scaled down to fit the input resolution, converted to an accepted format and cached
+        capacity = {'input_resolution': [100, 100], 'accepted_formats': ['jpg']}
+        file_name, image_file = open_image_for_model('image_hash', 'image.png', capacity)
+        converted = Image.open(image_file)
+        assert file_name == 'image.jpeg'
+        assert converted.format == 'JPEG' and converted.size == (100, 50)
+        image_file.close()
+
+        derived_name = derived_image_name('image_hash', get_image_spec(capacity), 'jpeg')
+        derived_path = dependency.DERIVED_IMAGE_PATH + derived_name
+        assert os.path.exists(derived_path)
+        assert int(redis.get('testing:images:derived:bytes')) == os.path.getsize(derived_path)
+
+        # The cached image is used again rather than converted again
+        derived_inode = os.stat(derived_path).st_ino
+        file_name, image_file = open_image_for_model('image_hash', 'image.png', capacity)
+        assert file_name == 'image.jpeg' and Image.open(image_file).size == (100, 50)
+        image_file.close()
+        assert os.stat(derived_path).st_ino == derived_inode
+
+        # Least recently used images are deleted once the cache is over its size, even if they are being sent
+        monkeypatch.setattr(derived_images, 'DERIVED_IMAGE_CACHE_BYTES', 0)
+        file_name, image_file = open_image_for_model('image_hash', 'image.png', {'accepted_formats': ['bmp']})
+        assert Image.open(image_file).format == 'BMP'
+        image_file.close()
+        assert not os.listdir(dependency.DERIVED_IMAGE_PATH)
+        assert int(redis.get('testing:images:derived:bytes')) == 0
+    finally:
+        redis.delete('testing:images:derived', 'testing:images:derived:sizes', 'testing:images:derived:bytes')
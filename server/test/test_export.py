@@ -0,0 +1,48 @@
+import gzip
+import json
+
+import pytest
+
+from export import get_field_value, ndjson_rows, csv_rows, encode_chunks, get_export_schema, get_export_batch
+
+IMAGES = [
+    {'hash_md5': 'a', 'models': {'testing_model': {'cat': 0.5, 'boxes': [1, 2]}}},
+    {'hash_md5': 'b', 'models': {}}
+]
+
+
+def test_field_value():
+    assert get_field_value(IMAGES[0]['models'], 'testing_model.cat') == 0.5
+    assert get_field_value(IMAGES[0]['models'], 'testing_model.dog') is None
+    assert get_field_value(IMAGES[1]['models'], 'testing_model') is None
+
+
+def test_export_rows():
+    assert [json.loads(row) for row in ndjson_rows(IMAGES)] == IMAGES
+    assert ''.join(csv_rows(IMAGES, ['testing_model.cat', 'testing_model.boxes'])).splitlines() == [
+        'hash_md5,testing_model.cat,testing_model.boxes',
+        'a,0.5,"[1, 2]"',
+        'b,,'
+    ]
+
+
+def test_encode_chunks():
+    rows = [str(i) + '\n' for i in range(100000)]
+    assert b''.join(encode_chunks(rows)) == ''.join(rows).encode()
+
+    # Chunks of a compressed export form a single gzip stream
+    compressed = list(encode_chunks(rows, compress=True))
+    assert len(compressed) > 1
+    assert gzip.decompress(b''.join(compressed)) == ''.join(rows).encode()
+
+
+def test_export_batch():
+    pyarrow = pytest.importorskip('pyarrow')
+    models = {'testing_model': ['cat', 'dog']}
+    schema = get_export_schema(models)
+    images = [dict(image, file_names=['image.png'], users=['testing']) for image in IMAGES]
+
+    batch = get_export_batch(images, models, schema)
+    assert batch.schema.names == ['hash_md5', 'file_names', 'users', 'testing_model.cat', 'testing_model.dog']
+    assert batch.column(3).to_pylist() == [0.5, None]
+    assert batch.column(3).type == pyarrow.float64()
@@ -0,0 +1,25 @@
+import io
+
+from multipart_stream import MultipartFileStream
+
+
+def test_multipart_file_stream():
+    data = bytes(range(256)) * 1000
+    file = io.BytesIO(b'skipped' + data)
+    file.seek(len(b'skipped'))  # Only the rest of the file is sent
+    stream = MultipartFileStream('file', 'image "1".jpg', file)
+
+    # Read in small chunks, the way the body is sent
+    body = b''
+    chunk = stream.read(8192)
+    while chunk:
+        assert len(chunk) <= 8192
+        body += chunk
+        chunk = stream.read(8192)
+
+    assert len(body) == len(stream)
+    assert stream.content_type == 'multipart/form-data; boundary=' + stream.boundary
+    assert body == (b'--' + stream.boundary.encode() + b'\r\n' +
+                    b'Content-Disposition: form-data; name="file"; filename="image %221%22.jpg"\r\n\r\n' +
+                    data +
+                    b'\r\n--' + stream.boundary.encode() + b'--\r\n')
@@ -0,0 +1,37 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from passlib.context import CryptContext
+
+import passwords
+
+
+@pytest.fixture
+def password_pool(monkeypatch):
+    # Hash in threads with a fast scheme, since pool workers are separate processes that would not see the patches
+    monkeypatch.setattr(passwords, 'pwd_context', CryptContext(schemes=['sha256_crypt'], sha256_crypt__rounds=1000))
+    monkeypatch.setattr(passwords, '_executor', ThreadPoolExecutor(1))
+    yield
+    passwords._executor.shutdown()
+
+
+def test_hash_and_verify(password_pool, monkeypatch):
+    hashed_password = asyncio.run(passwords.hash_password('testing'))
+    assert asyncio.run(passwords.verify_password('testing', hashed_password)) == (True, None)
+    assert asyncio.run(passwords.verify_password('wrong', hashed_password)) == (False, None)
+
+    # Hashes with an outdated cost are replaced on a successful check
+    monkeypatch.setattr(passwords, 'pwd_context', CryptContext(schemes=['sha256_crypt'], sha256_crypt__rounds=2000))
+    verified, new_hash = asyncio.run(passwords.verify_password('testing', hashed_password))
+    assert verified and new_hash and new_hash != hashed_password
+
+    stats = passwords.get_password_pool_stats()
+    assert stats['pending'] == 0 and stats['completed'] >= 4
+
+
+def test_pool_full(password_pool, monkeypatch):
+    monkeypatch.setattr(passwords, 'PASSWORD_HASH_QUEUE_LIMIT', 0)
+    monkeypatch.setitem(passwords._stats, 'pending', passwords.PASSWORD_HASH_WORKERS)
+    with pytest.raises(passwords.PasswordPoolFull):
+        asyncio.run(passwords.hash_password('testing'))
@@ -1,9 +1,15 @@
 import pytest
+from bson import ObjectId
 from fastapi.testclient import TestClient
 import glob
 from main import app
 from fastapi import Depends
-from db_connection import get_user_by_name_db
+from db_connection import get_user_by_name_db, set_model_socket_db, get_model_sockets_db, remove_model_socket_db, \
+    get_models_db, get_image_labels, get_search_terms, get_label_search_terms, add_image_db, add_filename_to_image, \
+    add_model_to_image_db, get_image_by_md5_hash_db, get_search_string_query, \
+    get_search_filter_query, encode_search_cursor, decode_search_cursor, add_user_to_image
+from dependency import UniversalMLImage, image_collection, redis
+from search_counts import image_count_key
 
 from main import app
 
@@ -26,6 +32,90 @@ def test_register_model():
     assert register_model.status_code == 200
     
     
+@pytest.mark.timeout(5)
+def test_persist_model_socket():
+    set_model_socket_db("testing_persist", "http://host.docker.internal:5005")
+    assert get_model_sockets_db()["testing_persist"] == "http://host.docker.internal:5005"
+
+    # Persisted sockets should not show up as models with known fields
+    assert "testing_persist" not in get_models_db()
+
+    remove_model_socket_db("testing_persist")
+    assert "testing_persist" not in get_model_sockets_db()
+
+
+def test_image_labels():
+    labels = get_image_labels('testing_model', {'cat': 0.9, 'dog': 0, 'Bird': 1, 'flag': True, 'box': [1, 2]})
+    assert labels == [{'model': 'testing_model', 'class': 'cat', 'score': 0.9},
+                      {'model': 'testing_model', 'class': 'Bird', 'score': 1}]
+    assert get_image_labels('testing_model', 'not a dict') == []
+
+    assert get_search_terms('Dog_01.JPG') == ['01', 'dog', 'dog_01.jpg', 'jpg']
+    assert 'testing_model:bird' in get_label_search_terms(labels)
+
+
+def test_search_string_query():
+    assert get_search_string_query('Dog  yolo:cat') == [{'search_terms': {'$regex': '^dog'}},
+                                                        {'search_terms': {'$regex': '^yolo:cat'}}]
+    assert get_search_string_query('a.b') == [{'search_terms': {'$regex': '^a\\.b'}}]  # Words are not patterns
+
+
+def test_search_filter_query():
+    assert get_search_filter_query({'testing_model': ['cat', 1]}, 0.5) == {'$or': [
+        {'labels': {'$elemMatch': {'model': 'testing_model', 'class': {'$in': ['cat', '1']}, 'score': {'$gt': 0.5}}}}
+    ]}
+
+
+def test_search_cursor():
+    image_id = ObjectId()
+    assert decode_search_cursor(encode_search_cursor(image_id)) == image_id
+
+    with pytest.raises(ValueError):
+        decode_search_cursor('not a cursor')
+
+
+@pytest.mark.timeout(5)
+def test_add_model_to_image():
+    image = UniversalMLImage(hash_md5='testing_labels', hash_sha1='', hash_perceptual='')
+    add_image_db(image)
+    add_filename_to_image(image, 'Testing_Image.png')
+
+    # Results of a model that is run again replace its previous labels
+    add_model_to_image_db(image, 'testing_model', {'cat': 0.9, 'dog': 0.1})
+    add_model_to_image_db(image, 'testing_other', {'car': 0.5})
+    add_model_to_image_db(image, 'testing_model', {'cat': 0.8, 'dog': 0})
+
+    stored = get_image_by_md5_hash_db('testing_labels')
+    assert sorted(stored.labels, key=lambda label: label['model']) == [
+        {'model': 'testing_model', 'class': 'cat', 'score': 0.8},
+        {'model': 'testing_other', 'class': 'car', 'score': 0.5}
+    ]
+    assert stored.models['testing_model'] == {'cat': 0.8, 'dog': 0}
+    assert {'testing_image', 'cat', 'testing_model:cat', 'car'}.issubset(stored.search_terms)
+
+    image_collection.delete_one({'hash_md5': 'testing_labels'})
+
+
+@pytest.mark.timeout(5)
+def test_shared_image_counted_once():
+    label = {'model': 'testing_counts', 'class': 'cat', 'score': 0.9}
+    keys = [image_count_key(username, 'testing_counts', 'cat') for username in [None, 'testing', 'testing_other']]
+    for key in keys:
+        redis.set(key, 0)  # Counts are only updated once they have been counted from the database
+
+    # Two users upload the same image
+    image = UniversalMLImage(hash_md5='testing_counts', hash_sha1='', hash_perceptual='', users=['testing'],
+                             labels=[label])
+    add_image_db(image)
+    add_user_to_image(image, 'testing_other')
+    add_user_to_image(image, 'testing_other')  # Adding a user again changes nothing
+
+    assert [int(redis.get(key)) for key in keys] == [1, 1, 1]
+
+    image_collection.delete_one({'hash_md5': 'testing_counts'})
+    redis.delete(*keys)
+
+
 # --------------
 # Failing Tests
 # --------------
@@ -0,0 +1,66 @@
+import time
+
+import scheduler
+from scheduler import estimate_wait, get_job_deadline, get_queue_priority, track_enqueued_job, track_finished_job, \
+    get_model_queue_depth, get_user_outstanding_jobs, model_jobs_key, user_jobs_key, model_completions_key, \
+    track_job_submitter, remove_job_submitter, job_submitters_key
+from dependency import DEFAULT_RETRY_AFTER, DEFAULT_PREDICTION_DEADLINE, redis
+
+
+def test_estimate_wait():
+    assert estimate_wait(100, 10.0) == 10
+    assert estimate_wait(1, 10.0) == 1  # Never estimate less than one second
+    assert estimate_wait(5, 0) == DEFAULT_RETRY_AFTER  # No recent throughput for the model
+
+
+def test_job_deadline():
+    # A deadline given with the request is always used
+    assert abs(get_job_deadline('testing_model', 30) - (time.time() + 30)) < 1
+
+    if DEFAULT_PREDICTION_DEADLINE <= 0:
+        assert get_job_deadline('testing_model') is None
+
+
+def test_queue_priority():
+    assert get_queue_priority('model_prediction:interactive:testing') == 'interactive'
+    assert get_queue_priority('model_prediction:backfill:testing') == 'backfill'
+    assert get_queue_priority('model_prediction') == 'normal'  # Shared queue has no lane
+
+
+def test_in_flight_jobs_expire(monkeypatch):
+    monkeypatch.setattr(scheduler, 'IN_FLIGHT_JOB_TTL', 60)
+    redis.delete(model_jobs_key('testing_model'), user_jobs_key('testing'))
+
+    track_enqueued_job('testing-job-1', 'testing', 'testing_model')
+    track_enqueued_job('testing-job-2', 'testing', 'testing_model')
+    assert get_model_queue_depth('testing_model') == 2
+    assert get_user_outstanding_jobs('testing') == 2
+
+    # A job that was enqueued before the TTL and never finished no longer counts
+    redis.zadd(model_jobs_key('testing_model'), {'testing-job-1': time.time() - 120})
+    redis.zadd(user_jobs_key('testing'), {'testing-job-1': time.time() - 120})
+    assert get_model_queue_depth('testing_model') == 1
+    assert get_user_outstanding_jobs('testing') == 1
+
+    track_finished_job('testing-job-2', 'testing', 'testing_model')
+    assert get_model_queue_depth('testing_model') == 0
+    assert get_user_outstanding_jobs('testing') == 0
+    redis.delete(model_jobs_key('testing_model'), user_jobs_key('testing'), model_completions_key('testing_model'))
+
+
+def test_job_submitters():
+    redis.delete(job_submitters_key('testing-job'))
+
+    # Two users submit the same image to the same model
+    track_job_submitter('testing-job', 'testing', new_job=True)
+    track_job_submitter('testing-job', 'testing_other')
+
+    assert remove_job_submitter('testing-job', 'testing') == 1  # Still needed by the other user
+    assert remove_job_submitter('testing-job', 'testing') is None  # Already withdrawn
+    assert remove_job_submitter('testing-job', 'testing_other') == 0
+
+    # A job that is queued again starts without the submitters of its previous run
+    track_job_submitter('testing-job', 'testing_other')
+    track_job_submitter('testing-job', 'testing', new_job=True)
+    assert remove_job_submitter('testing-job', 'testing_other') is None
+    redis.delete(job_submitters_key('testing-job'))
@@ -0,0 +1,48 @@
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+import search_cache as search_cache_module
+from dependency import User
+from search_cache import get_search_version_names
+
+
+def test_search_version_names():
+    investigator = User(username='testing', password='', roles=['investigator'])
+    assert get_search_version_names(investigator, {'testing_model': ['cat']}, 'dog') == ['user:testing']
+
+    admin = User(username='testing', password='', roles=['admin'])
+    assert get_search_version_names(admin, {}, '') == ['all']
+    assert get_search_version_names(admin, {'testing_model': ['cat']}, 'dog') == ['all', 'model:testing_model',
+                                                                                 'labels']
+
+
+def test_search_count_shared_between_pages(monkeypatch):
+    counts = []
+    monkeypatch.setattr(search_cache_module, 'get_search_versions', lambda names: [0] * len(names))
+    monkeypatch.setattr(search_cache_module, 'get_images_from_user_db',
+                        lambda *args, **kwargs: {'hashes': ['testing'], 'next_cursor': 'testing'})
+    monkeypatch.setattr(search_cache_module, 'count_search_db', lambda *args: counts.append(args) or (30, False))
+    search_cache_module.search_cache.clear()
+
+    user = User(username='testing', password='', roles=['investigator'])
+    first_page = search_cache_module.search_images_cached(user, search_string='dog', cursor='')
+    next_page = search_cache_module.search_images_cached(user, search_string='dog', cursor='testing')
+    assert first_page['num_images'] == next_page['num_images'] == 30
+    assert next_page['num_pages'] == 2
+    assert len(counts) == 1  # Only counted for the first page
+
+
+def test_search_without_redis(monkeypatch):
+    def unavailable(names):
+        raise RedisConnectionError('Redis is unavailable')
+
+    searches = []
+    monkeypatch.setattr(search_cache_module, 'get_search_versions', unavailable)
+    monkeypatch.setattr(search_cache_module, 'get_images_from_user_db',
+                        lambda *args: searches.append(args) or {'hashes': ['testing'], 'num_images': 1})
+    search_cache_module.search_cache.clear()
+
+    # The database is searched directly, and nothing is cached
+    user = User(username='testing', password='', roles=['investigator'])
+    assert search_cache_module.search_images_cached(user, search_string='dog')['hashes'] == ['testing']
+    assert search_cache_module.search_images_cached(user, search_string='dog')['num_images'] == 1
+    assert len(searches) == 2
@@ -0,0 +1,30 @@
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+import search_counts
+from search_counts import image_count_key, send_update
+
+
+def test_image_count_key():
+    assert image_count_key() == 'images:count:all'
+    assert image_count_key('testing') == 'images:count:user:testing'
+    assert image_count_key('testing', 'testing_model', 1) == 'images:count:user:testing:label:testing_model:1'
+    assert image_count_key(None, 'testing_model', 'cat') == 'images:count:all:label:testing_model:cat'
+
+
+def test_send_update_without_redis(monkeypatch):
+    reconciles = []
+    monkeypatch.setattr(search_counts, 'reconcile_search_counts', lambda: reconciles.append(True))
+    monkeypatch.setattr(search_counts, '_stale', False)
+
+    def unavailable():
+        raise RedisConnectionError('Redis is unavailable')
+
+    send_update(unavailable)  # Image writes must not fail while redis is down
+    assert not reconciles
+
+    updates = []
+    send_update(lambda: updates.append(True))
+    assert reconciles == [True] and updates == [True]  # Reconciled before the first update after the outage
+
+    send_update(lambda: updates.append(True))
+    assert reconciles == [True] and len(updates) == 2
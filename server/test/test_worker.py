@@ -0,0 +1,69 @@
+from rq import Queue, Worker
+from rq.job import Job
+from rq.registry import StartedJobRegistry
+
+from dependency import redis
+from worker import DeficitRoundRobin, resume_interrupted_jobs
+
+
+def serve(order: DeficitRoundRobin, pending: dict, weights: dict, jobs: int) -> str:
+    served = ''
+    for _ in range(jobs):
+        name = next(name for name in order.order if pending[name] > 0)
+        pending[name] -= 1
+        order.served(name, weights.get(name, 1))
+        served += name
+    return served
+
+
+def test_round_robin_equal_weights():
+    order = DeficitRoundRobin(['a', 'b', 'c'])
+    assert serve(order, {'a': 100, 'b': 100, 'c': 100}, {}, 6) == 'abcabc'
+
+
+def test_round_robin_weighted():
+    order = DeficitRoundRobin(['a', 'b'])
+    assert serve(order, {'a': 100, 'b': 100}, {'b': 3}, 8) == 'abbbabbb'
+
+
+def test_small_submission_is_not_starved():
+    # A large submission in 'a' must not delay the single job submitted to 'b' by more than one turn
+    order = DeficitRoundRobin(['a', 'b'])
+    pending = {'a': 1000, 'b': 0}
+    serve(order, pending, {}, 50)
+    pending['b'] = 1
+    assert 'b' in serve(order, pending, {}, 2)
+
+
+def start_job(worker: Worker, job_id: str) -> Job:
+    """
+    Records a job as started by a worker, the way the worker does before running it.
+    """
+    job = Job.create('time.sleep', args=(0,), id=job_id, origin=worker.queues[0].name, connection=redis)
+    job.save()
+    if hasattr(worker, 'prepare_execution'):  # rq 2 records every run of a job as an execution
+        worker.prepare_execution(job)
+    worker.prepare_job_execution(job)
+    return job
+
+
+def test_resume_interrupted_jobs():
+    queue = Queue('testing_resume', connection=redis)
+    registry = StartedJobRegistry(queue=queue)
+    live_worker = Worker([queue], connection=redis, name='testing-live-worker')
+    dead_worker = Worker([queue], connection=redis, name='testing-dead-worker')  # Never registered, as if it died
+    live_worker.register_birth()
+    try:
+        start_job(live_worker, 'testing-running-job')
+        start_job(dead_worker, 'testing-interrupted-job')
+
+        resume_interrupted_jobs([queue])
+        resume_interrupted_jobs([queue])  # Jobs are only requeued once
+
+        assert queue.job_ids == ['testing-interrupted-job']
+        assert registry.get_job_ids() == ['testing-running-job']
+    finally:
+        live_worker.register_death()
+        queue.empty()
+        for key in redis.scan_iter(match='rq:*testing*'):
+            redis.delete(key)
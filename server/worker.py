@@ -1,11 +1,149 @@
-from redis import Redis
+import os
+import signal
+import uuid
+from typing import List
+
 from rq import Queue, Worker
+from rq.registry import StartedJobRegistry
+
+from dependency import redis, PredictionPriority, LANE_SCHEDULING, LANE_WEIGHTS
+from scheduler import get_prediction_queues, get_prediction_queue_weights, get_queue_priority
+
+WORKER_NAME = 'model_prediction'  # Prefix of worker names. Every worker adds a unique suffix, as rq requires
+SHUTDOWN_DEADLINE = int(os.getenv('SHUTDOWN_DEADLINE', default=30))  # Seconds a running job has to finish on stop
+QUEUE_REFRESH_INTERVAL = 5  # Seconds between checks for newly created prediction queues while idle
+
+
+class DeficitRoundRobin:
+    """
+    Serving order for a group of named items using deficit round-robin. The item at the front keeps its turn until
+    it has been served as many times as its weight, and then moves to the back of the order. Items that are skipped
+    because they had nothing to serve lose their turn and any credit left over.
+    """
+
+    def __init__(self, order=None):
+        self.order = list(order or [])
+        self.deficits = {}  # Number of times each item may still be served in its current turn
+        self.turn = None  # Item that currently has its turn
+
+    def served(self, name: str, weight: float):
+        """
+        Updates the serving order after an item has been served once.
+
+        :param name: Name of item that was served
+        :param weight: Number of times the item may be served per turn
+        """
+        position = self.order.index(name)
+
+        # Items ahead of the one that was served were empty, so they lose their turn
+        for skipped in self.order[:position]:
+            self.deficits[skipped] = 0
+        self.order = self.order[position:] + self.order[:position]
+
+        if self.turn != name:  # Start of a new turn for the item
+            self.turn = name
+            self.deficits[name] = self.deficits.get(name, 0) + weight
+
+        self.deficits[name] -= 1
+        if self.deficits[name] < 1:  # Turn is over, move item to the back
+            self.turn = None
+            self.order = self.order[1:] + self.order[:1]
+
+
+class PredictionWorker(Worker):
+    """
+    Worker used for model prediction jobs. Prediction queues are grouped by priority lane. Lanes are drained in
+    strict priority order, or with deficit round-robin by LANE_WEIGHTS if LANE_SCHEDULING is "weighted". Within a
+    lane, every user has their own queue, and these queues are served with deficit round-robin by their fair-share
+    weight. This keeps every worker busy while bounding how long a small submission waits behind a large one.
+
+    When asked to stop, the job that is currently running is given SHUTDOWN_DEADLINE seconds to finish before it is
+    interrupted. Interrupted jobs are left in the started job registry and are requeued by resume_interrupted_jobs
+    the next time a worker starts.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.weights = {}  # Fair-share weight of each queue
+        self.lanes = DeficitRoundRobin(PredictionPriority.__members__)
+        self.lane_queues = {priority: DeficitRoundRobin() for priority in PredictionPriority.__members__}
+        for queue in self.queues:
+            self.lane_queues[get_queue_priority(queue.name)].order.append(queue.name)
+        self.order_queues()
+
+    @property
+    def dequeue_timeout(self):
+        return QUEUE_REFRESH_INTERVAL
+
+    def heartbeat(self, *args, **kwargs):
+        super().heartbeat(*args, **kwargs)
+        self.refresh_queues()
+
+    def refresh_queues(self):
+        """
+        Adds any prediction queues created since the last refresh to the back of their lane, and updates the
+        fair-share weight of every queue.
+        """
+        self.weights = get_prediction_queue_weights()
+        known_queues = self.queue_names()
+        for queue in get_prediction_queues():
+            if queue.name not in known_queues:
+                self.queues.append(queue)
+                self.lane_queues[get_queue_priority(queue.name)].order.append(queue.name)
+        self.order_queues()
+
+    def order_queues(self):
+        """
+        Sets the order queues are checked for jobs in: every queue of the first lane, then the next lane, and so on.
+        """
+        queues = {queue.name: queue for queue in self.queues}
+        self._ordered_queues = [queues[name] for priority in self.lanes.order
+                                for name in self.lane_queues[priority].order]
+
+    def reorder_queues(self, reference_queue):
+        priority = get_queue_priority(reference_queue.name)
+        self.lane_queues[priority].served(reference_queue.name, self.weights.get(reference_queue.name, 1))
+        if LANE_SCHEDULING == 'weighted':
+            self.lanes.served(priority, LANE_WEIGHTS.get(priority, 1))
+        self.order_queues()
+
+    def request_stop(self, signum, frame):
+        signal.signal(signal.SIGALRM, self.request_force_stop)
+        signal.alarm(SHUTDOWN_DEADLINE)
+        super().request_stop(signum, frame)
+
+
+def resume_interrupted_jobs(queues: List[Queue] = None):
+    """
+    Requeues every prediction job that was started by a worker which is no longer running. A worker is running while
+    it is registered and its heartbeat has not expired. Prediction jobs are idempotent, so a job that was interrupted
+    after its result was saved will not write the result again.
+
+    :param queues: Queues to resume the jobs of. Every prediction queue by default
+    """
+    running_workers = {w.name for w in Worker.all(connection=redis)}
+    for queue in queues if queues is not None else get_prediction_queues():
+        registry = StartedJobRegistry(queue=queue)
+        for entry in redis.zrange(registry.key, 0, -1):
+            # Since rq 2, entries are job_id:execution_id so that every run of a job is tracked separately
+            job_id = entry.decode().split(':')[0]
+            job = queue.fetch_job(job_id)
+            if job is not None and job.worker_name in running_workers:
+                continue
+
+            # Removing the entry claims the job, so that workers starting at the same time do not both requeue it
+            if not redis.zrem(registry.key, entry) or job is None:
+                continue
+            print('Resuming Job ' + job_id)
+            job.started_at = None
+            job.ended_at = None
+            job.save()
+            queue._enqueue_job(job, at_front=True)
 
-redis = Redis(host='redis', port=6379)
-queue = Queue('model_prediction', connection=redis)
 
 if __name__ == '__main__':
     print('Starting Worker')
-    worker = Worker([queue], connection=redis, name='model_prediction')
+    resume_interrupted_jobs()
+    worker = PredictionWorker(get_prediction_queues(), connection=redis, name=WORKER_NAME + '-' + uuid.uuid4().hex)
     worker.work()
     print('Ending Worker')